@@ -0,0 +1,529 @@
+"""Нагрузочный тест бота целиком: main.py запускается как в проде, но Bot API
+заменён заглушкой в этом же процессе, а база — одноразовой PostgreSQL.
+
+Сценарии:
+  storm         — утренний шторм /schedule и /homework от зарегистрированных
+  registration  — волна новых пользователей: /start, затем ФИО
+  announce      — /announce от старшего админа всем пользователям
+
+Задержка считается от отправки апдейта в webhook до того, как заглушка
+получила sendMessage в этот чат. Результаты пишутся в JSON, два файла
+можно сравнить через --compare.
+
+Примеры:
+  python bench/run.py --users 1000 --output bench/results/new.json
+  python bench/run.py --database-url postgresql://postgres@127.0.0.1/postgres --workers 2
+  python bench/run.py --compare bench/results/old.json bench/results/new.json
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict, deque
+
+import psycopg
+from aiohttp import ClientSession, ClientTimeout, web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_TOKEN = "123456:BENCHMARK"
+SUPER_ADMIN = 7450525550  # совпадает с SUPER_ADMINS в main.py
+FIRST_USER_ID = 100_000_000
+REPLY_TIMEOUT = 60  # сек ожидания ответа бота
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def percentile(values, p: float) -> float:
+    if not values:
+        return 0.0
+    # Ближайший ранг: не интерполируем, берём реально наблюдённое значение
+    ordered = sorted(values)
+    index = max(0, math.ceil(p / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+# ОДНОРАЗОВАЯ POSTGRESQL
+class DisposableDatabase:
+    """Временная база на указанном сервере (--database-url) или отдельный
+    кластер во временном каталоге (initdb/pg_ctl из --pg-bin или PATH).
+    После теста удаляется в любом случае."""
+
+    def __init__(self, server_url=None, pg_bin=None):
+        self.server_url = server_url
+        self.pg_bin = pg_bin
+        self.url = None
+        self._name = None
+        self._datadir = None
+
+    def _tool(self, name: str) -> str:
+        path = os.path.join(self.pg_bin, name) if self.pg_bin else shutil.which(name)
+        if not path or not os.path.exists(path):
+            raise SystemExit(f"Не найден {name}: укажите --pg-bin или --database-url")
+        return path
+
+    async def __aenter__(self):
+        if self.server_url:
+            self._name = f"school_bot_bench_{os.getpid()}"
+            async with await psycopg.AsyncConnection.connect(self.server_url, autocommit=True) as conn:
+                await conn.execute(f"CREATE DATABASE {self._name}")
+            self.url = psycopg.conninfo.make_conninfo(self.server_url, dbname=self._name)
+            return self
+
+        if hasattr(os, "geteuid") and os.geteuid() == 0:
+            raise SystemExit("PostgreSQL не запускается от root: используйте --database-url")
+        self._datadir = tempfile.mkdtemp(prefix="school_bot_pg_")
+        port = free_port()
+        subprocess.run(
+            [self._tool("initdb"), "-D", self._datadir, "-U", "postgres", "--auth=trust",
+             "-E", "UTF8", "--no-sync"],
+            check=True, stdout=subprocess.DEVNULL,
+        )
+        options = (
+            f"-p {port} -k {self._datadir} -c listen_addresses=127.0.0.1 "
+            "-c max_connections=300 -c fsync=off -c synchronous_commit=off"
+        )
+        subprocess.run(
+            [self._tool("pg_ctl"), "-D", self._datadir, "-o", options, "-w", "-l",
+             os.path.join(self._datadir, "postgres.log"), "start"],
+            check=True, stdout=subprocess.DEVNULL,
+        )
+        self.url = f"postgresql://postgres@127.0.0.1:{port}/postgres"
+        return self
+
+    async def __aexit__(self, *exc):
+        if self._name:
+            async with await psycopg.AsyncConnection.connect(self.server_url, autocommit=True) as conn:
+                await conn.execute(f"DROP DATABASE IF EXISTS {self._name} WITH (FORCE)")
+        if self._datadir:
+            subprocess.run([self._tool("pg_ctl"), "-D", self._datadir, "-m", "fast", "-w", "stop"],
+                           stdout=subprocess.DEVNULL)
+            shutil.rmtree(self._datadir, ignore_errors=True)
+
+# ЗАГЛУШКА BOT API
+class FakeBotAPI:
+    """Отвечает на методы Bot API как Telegram и отмечает доставку sendMessage.
+
+    Перед отправкой апдейта тест вызывает expect(chat_id) и ждёт future:
+    она завершится временем, когда бот прислал в этот чат сообщение."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = defaultdict(int)
+        self._waiters = defaultdict(deque)
+        self._message_id = 0
+
+    def expect(self, chat_id: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[chat_id].append(future)
+        return future
+
+    def _deliver(self, chat_id: int):
+        waiters = self._waiters.get(chat_id)
+        while waiters:
+            future = waiters.popleft()
+            if not future.done():
+                future.set_result(time.perf_counter())
+                return
+
+    def _message(self, chat_id: int, text: str):
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": text,
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            data = await request.json()
+        else:
+            data = dict(await request.post())
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method in ("sendMessage", "editMessageText", "sendDocument"):
+            chat_id = int(data.get("chat_id", 0))
+            if method == "sendMessage":
+                self._deliver(chat_id)
+            result = self._message(chat_id, data.get("text", ""))
+        elif method == "getMe":
+            result = {"id": int(BOT_TOKEN.split(":")[0]), "is_bot": True, "first_name": "Bench"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self) -> str:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        port = free_port()
+        await web.TCPSite(self._runner, "127.0.0.1", port).start()
+        return f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+# БОТ
+class BotProcess:
+    def __init__(self, database_url: str, api_url: str, workers: int, extra_env, log_path: str):
+        self.port = free_port()
+        self.env = dict(os.environ)
+        self.env.update({
+            "BOT_TOKEN": BOT_TOKEN,
+            "DATABASE_URL": database_url,
+            "DB_SSLMODE": "disable",
+            "TELEGRAM_API_URL": api_url,
+            "PORT": str(self.port),
+            "WEB_WORKERS": str(workers),
+            "RENDER_EXTERNAL_HOSTNAME": f"127.0.0.1:{self.port}",
+        })
+        self.env.update(extra_env)
+        self.log_path = log_path
+        self.process = None
+
+    @property
+    def webhook_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/webhook/{BOT_TOKEN}"
+
+    async def start(self, session: ClientSession):
+        self._log = open(self.log_path, "w")
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "main.py")],
+            env=self.env, cwd=ROOT, stdout=self._log, stderr=subprocess.STDOUT,
+        )
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise SystemExit(f"Бот завершился при запуске, лог: {self.log_path}")
+            try:
+                async with session.get(f"http://127.0.0.1:{self.port}/") as response:
+                    if response.status == 200:
+                        return
+            except OSError:
+                pass
+            await asyncio.sleep(0.2)
+        raise SystemExit(f"Бот не запустился за 60 секунд, лог: {self.log_path}")
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            try:
+                self.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self._log.close()
+
+# ДАННЫЕ
+# Все данные теста живут в группе по умолчанию, которую создаёт init_db бота
+GROUP_ID = 1
+
+async def seed(database_url: str, users: int, homework: int):
+    today = datetime.date.today()
+    names = ["Иванов", "Петров", "Сидорова", "Кузнецов", "Смирнова", "Попов", "Васильева", "Фёдоров"]
+    async with await psycopg.AsyncConnection.connect(database_url) as conn:
+        async with conn.cursor().copy(
+            "COPY users (telegram_id, full_name, birth_date, digest_enabled, group_id) FROM STDIN"
+        ) as copy:
+            for i in range(users):
+                await copy.write_row((
+                    FIRST_USER_ID + i,
+                    f"{random.choice(names)} Студент {i}",
+                    datetime.date(2004, 1, 1) + datetime.timedelta(days=random.randrange(1500)),
+                    i % 3 == 0,
+                    GROUP_ID,
+                ))
+        # /announce доступна админам из таблицы users
+        await conn.execute(
+            "INSERT INTO users (telegram_id, full_name, is_admin, group_id) "
+            "VALUES (%s, 'Админ Нагрузочного Теста', TRUE, %s)",
+            (SUPER_ADMIN, GROUP_ID),
+        )
+        for day in (today, today + datetime.timedelta(days=1)):
+            for number, (subject, start) in enumerate(
+                [("Математика", "08:30"), ("Физика", "10:10"), ("История", "11:50"), ("Информатика", "13:30")], 1
+            ):
+                await conn.execute(
+                    "INSERT INTO schedule (group_id, date, lesson_number, subject, classroom, start_time, end_time, "
+                    "lesson_type, teacher) VALUES (%s, %s, %s, %s, %s, %s::time, %s::time + INTERVAL '80 minutes', "
+                    "'Лекция', 'Иванов И.И.') ON CONFLICT DO NOTHING",
+                    (GROUP_ID, day, number, subject, f"{100 + number}", start, start),
+                )
+        await conn.cursor().executemany(
+            "INSERT INTO homework (group_id, subject, description, due_date, added_by) VALUES (%s, %s, %s, %s, %s)",
+            [
+                (GROUP_ID, random.choice(["Математика", "Физика", "История"]), f"Задание {i}: упражнения 1-{i % 10 + 3}",
+                 today + datetime.timedelta(days=i % 14), SUPER_ADMIN)
+                for i in range(homework)
+            ],
+        )
+        # Бот уже прогрел кэши пустой базой — сбрасываем их так же, как это делают другие воркеры
+        for cache in ("users", "schedule", "homework"):
+            await conn.execute(
+                "SELECT pg_notify('school_bot_cache', %s)",
+                (json.dumps({"from": "bench", "cache": cache, "keys": []}),),
+            )
+        await conn.commit()
+    await asyncio.sleep(1)
+
+# НАГРУЗКА
+class Load:
+    def __init__(self, session: ClientSession, api: FakeBotAPI, bot: BotProcess):
+        self.session = session
+        self.api = api
+        self.bot = bot
+        self._update_id = 0
+
+    def update(self, user_id: int, text: str) -> dict:
+        self._update_id += 1
+        return {
+            "update_id": self._update_id,
+            "message": {
+                "message_id": self._update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+                "text": text,
+            },
+        }
+
+    async def post(self, update: dict, result: dict) -> bool:
+        # 503 — очередь бота заполнена, Telegram повторил бы доставку позже
+        for _ in range(5):
+            async with self.session.post(self.bot.webhook_url, json=update) as response:
+                if response.status == 200:
+                    return True
+                if response.status != 503:
+                    break
+            result["rejected"] += 1
+            await asyncio.sleep(0.5)
+        result["errors"] += 1
+        return False
+
+    async def request(self, user_id: int, text: str, result: dict):
+        """Один апдейт и ожидание ответа бота в этот чат."""
+        reply = self.api.expect(user_id)
+        sent = time.perf_counter()
+        if not await self.post(self.update(user_id, text), result):
+            reply.cancel()
+            return False
+        try:
+            delivered = await asyncio.wait_for(reply, REPLY_TIMEOUT)
+        except asyncio.TimeoutError:
+            result["errors"] += 1
+            return False
+        result["latencies"].append(delivered - sent)
+        return True
+
+async def open_loop(rate: float, count: int, make):
+    """Запускает count запросов с заданной частотой, не дожидаясь ответов."""
+    tasks = []
+    started = time.perf_counter()
+    for i in range(count):
+        delay = started + i / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(make(i)))
+    await asyncio.gather(*tasks)
+
+async def scenario_storm(load: Load, users: int, requests: int, rate: float, result: dict):
+    async def one(i):
+        user_id = FIRST_USER_ID + random.randrange(users)
+        await load.request(user_id, "/schedule" if random.random() < 0.7 else "/homework", result)
+    await open_loop(rate, requests, one)
+
+async def scenario_registration(load: Load, count: int, rate: float, result: dict):
+    async def one(i):
+        user_id = FIRST_USER_ID + 10_000_000 + i
+        if await load.request(user_id, "/start", result):
+            await load.request(user_id, f"Новиков Новый Студент{i}", result)
+    await open_loop(rate, count, one)
+
+async def scenario_announce(load: Load, users: int, result: dict):
+    # Ответ админу (статус) и по сообщению каждому пользователю
+    replies = [load.api.expect(FIRST_USER_ID + i) for i in range(users)]
+    await load.request(SUPER_ADMIN, "/announce Нагрузочный тест", result)
+    sent = time.perf_counter()
+    done, pending = await asyncio.wait(replies, timeout=max(REPLY_TIMEOUT, users / 5))
+    for future in pending:
+        future.cancel()
+    result["errors"] += len(pending)
+    result["latencies"].extend(future.result() - sent for future in done)
+
+# Соединения с базой во время сценария
+async def sample_connections(database_url: str, samples: list, stop: asyncio.Event):
+    async with await psycopg.AsyncConnection.connect(database_url, autocommit=True) as conn:
+        while not stop.is_set():
+            cursor = await conn.execute(
+                "SELECT count(*), count(*) FILTER (WHERE state = 'active') FROM pg_stat_activity "
+                "WHERE datname = current_database() AND pid <> pg_backend_pid()"
+            )
+            samples.append(await cursor.fetchone())
+            try:
+                await asyncio.wait_for(stop.wait(), 0.25)
+            except asyncio.TimeoutError:
+                pass
+
+async def measure(name: str, database_url: str, scenario) -> dict:
+    result = {"latencies": [], "errors": 0, "rejected": 0}
+    samples = []
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(sample_connections(database_url, samples, stop))
+    started = time.perf_counter()
+    await scenario(result)
+    duration = time.perf_counter() - started
+    stop.set()
+    await sampler
+
+    latencies = [value * 1000 for value in result["latencies"]]
+    summary = {
+        "completed": len(latencies),
+        "errors": result["errors"],
+        "rejected": result["rejected"],
+        "duration_s": round(duration, 3),
+        "throughput_per_s": round(len(latencies) / duration, 2) if duration else 0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50), 2),
+            "p95": round(percentile(latencies, 95), 2),
+            "p99": round(percentile(latencies, 99), 2),
+            "max": round(max(latencies, default=0), 2),
+            "mean": round(sum(latencies) / len(latencies), 2) if latencies else 0,
+        },
+        "db_connections": {
+            "max": max((total for total, _ in samples), default=0),
+            "mean": round(sum(total for total, _ in samples) / len(samples), 2) if samples else 0,
+            "active_max": max((active for _, active in samples), default=0),
+        },
+    }
+    print(
+        f"{name:13} {summary['completed']:6} ок, ошибок {summary['errors']:4}, "
+        f"{summary['throughput_per_s']:8.1f}/с, p50 {summary['latency_ms']['p50']:7.1f} мс, "
+        f"p95 {summary['latency_ms']['p95']:7.1f} мс, p99 {summary['latency_ms']['p99']:7.1f} мс, "
+        f"соединений до {summary['db_connections']['max']}"
+    )
+    return summary
+
+def git_version() -> dict:
+    def git(*args):
+        try:
+            return subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+        except OSError:
+            return ""
+    return {"commit": git("rev-parse", "HEAD"), "dirty": bool(git("status", "--porcelain", "main.py"))}
+
+async def run(args) -> dict:
+    extra_env = dict(item.split("=", 1) for item in args.env)
+    api = FakeBotAPI(args.api_latency / 1000)
+    api_url = await api.start()
+    log_path = os.path.join(tempfile.gettempdir(), f"school_bot_bench_{os.getpid()}.log")
+    scenarios = {}
+    try:
+        async with DisposableDatabase(args.database_url, args.pg_bin) as database:
+            async with ClientSession(timeout=ClientTimeout(total=REPLY_TIMEOUT)) as session:
+                bot = BotProcess(database.url, api_url, args.workers, extra_env, log_path)
+                await bot.start(session)
+                try:
+                    await seed(database.url, args.users, args.homework)
+                    load = Load(session, api, bot)
+                    selected = args.scenarios.split(",")
+                    if "storm" in selected:
+                        scenarios["storm"] = await measure("storm", database.url, lambda r: scenario_storm(
+                            load, args.users, args.requests, args.rate, r))
+                    if "registration" in selected:
+                        scenarios["registration"] = await measure("registration", database.url, lambda r: (
+                            scenario_registration(load, args.registrations, args.rate / 2, r)))
+                    if "announce" in selected:
+                        scenarios["announce"] = await measure("announce", database.url, lambda r: (
+                            scenario_announce(load, args.users, r)))
+                finally:
+                    bot.stop()
+    finally:
+        await api.stop()
+    print(f"Лог бота: {log_path}")
+
+    return {
+        "version": git_version(),
+        "finished_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "host": {"python": platform.python_version(), "cpus": os.cpu_count(), "platform": platform.platform()},
+        "config": {
+            "users": args.users, "homework": args.homework, "requests": args.requests,
+            "registrations": args.registrations, "rate": args.rate, "workers": args.workers,
+            "api_latency_ms": args.api_latency, "env": extra_env,
+        },
+        "scenarios": scenarios,
+        "bot_api_calls": dict(api.calls),
+    }
+
+def compare(old_path: str, new_path: str, threshold: float) -> int:
+    """Сравнивает два файла результатов. Код выхода 1 — есть регрессия."""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    regressions = 0
+    print(f"{old['version']['commit'][:8]} → {new['version']['commit'][:8]}")
+    for name, after in new["scenarios"].items():
+        before = old["scenarios"].get(name)
+        if not before:
+            continue
+        rows = [
+            ("throughput_per_s", before["throughput_per_s"], after["throughput_per_s"], True),
+            ("p50 мс", before["latency_ms"]["p50"], after["latency_ms"]["p50"], False),
+            ("p95 мс", before["latency_ms"]["p95"], after["latency_ms"]["p95"], False),
+            ("p99 мс", before["latency_ms"]["p99"], after["latency_ms"]["p99"], False),
+            ("соединений", before["db_connections"]["max"], after["db_connections"]["max"], False),
+        ]
+        print(f"\n{name}")
+        for label, a, b, higher_is_better in rows:
+            change = (b - a) / a * 100 if a else 0.0
+            worse = change < -threshold if higher_is_better else change > threshold
+            if worse and label != "соединений":
+                regressions += 1
+            print(f"  {label:17} {a:10.2f} → {b:10.2f} ({change:+6.1f}%){'  ⚠️' if worse else ''}")
+    return 1 if regressions else 0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", help="сервер PostgreSQL для временной базы (иначе initdb)")
+    parser.add_argument("--pg-bin", help="каталог с initdb и pg_ctl")
+    parser.add_argument("--users", type=int, default=500, help="зарегистрированных пользователей")
+    parser.add_argument("--homework", type=int, default=200, help="домашних заданий")
+    parser.add_argument("--requests", type=int, default=2000, help="запросов в шторме /schedule")
+    parser.add_argument("--registrations", type=int, default=200, help="новых пользователей")
+    parser.add_argument("--rate", type=float, default=200, help="апдейтов в секунду")
+    parser.add_argument("--workers", type=int, default=1, help="WEB_WORKERS бота")
+    parser.add_argument("--api-latency", type=float, default=20, help="задержка ответа Bot API, мс")
+    parser.add_argument("--scenarios", default="storm,registration,announce")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="переменная окружения бота, например BROADCAST_RATE=1000")
+    parser.add_argument("--output", default=os.path.join(ROOT, "bench", "results", "latest.json"))
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="сравнить два файла результатов")
+    parser.add_argument("--threshold", type=float, default=20, help="допустимое ухудшение при сравнении, %%")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(compare(*args.compare, args.threshold))
+
+    results = asyncio.run(run(args))
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"Результаты: {args.output}")
+
+if __name__ == "__main__":
+    main()
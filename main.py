@@ -4,17 +4,43 @@ import logging
 import datetime
 import re
 import signal
-import psycopg2
 import json
-import io
+import html
+import string
+import csv
+import gzip
+import hashlib
+import tempfile
+import sys
+import time
+import bisect
+import random
+import uuid
+import multiprocessing
+import contextvars
+from collections import OrderedDict, deque
+from zoneinfo import ZoneInfo
+
+import psycopg
+from psycopg_pool import AsyncConnectionPool
 
 from aiohttp import web
-from aiogram import Bot, Dispatcher, types
+from aiogram import Bot, Dispatcher, F, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError,
+    TelegramNotFound, TelegramRetryAfter, TelegramServerError,
+)
 from aiogram.filters import Command
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, FSInputFile
+from aiogram.types import (
+    ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile,
+)
+from aiogram.methods import TelegramMethod
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
 # Логирование
@@ -27,6 +53,108 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "sunnatjalab")
 SUPER_ADMINS = [7450525550]  # Старший админ (ваш ID)
 
+# Пул соединений с PostgreSQL
+DB_SSLMODE = os.getenv("DB_SSLMODE", "require")
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 2))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10))  # ожидание свободного соединения, сек
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", 300))  # закрывать простаивающие соединения, сек
+DB_POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", 3600))  # пересоздавать соединения, сек
+DB_PREPARE_THRESHOLD = int(os.getenv("DB_PREPARE_THRESHOLD", 2))  # после N выполнений запрос готовится на сервере
+
+# Хранилище состояний диалогов: postgres или memory (для локального запуска)
+FSM_STORAGE = os.getenv("FSM_STORAGE", "postgres")
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", 1))  # сек между записями пачкой в базу
+FSM_STATE_TTL = float(os.getenv("FSM_STATE_TTL", 86400))  # сек: брошенные диалоги удаляются
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", 10000))
+
+# Несколько процессов-воркеров на одном порту (SO_REUSEPORT)
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", 1))
+LEADER_RETRY_INTERVAL = float(os.getenv("LEADER_RETRY_INTERVAL", 15))  # сек
+UPDATE_LEDGER_TTL = int(os.getenv("UPDATE_LEDGER_TTL", 86400))  # сек: сколько помнить обработанные update_id
+
+# Очередь входящих апдейтов: webhook отвечает сразу, обработка — в фоне
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 1000))  # апдейтов в очереди и в работе
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", 16))  # чатов обрабатываются параллельно
+UPDATE_QUEUE_WAIT = float(os.getenv("UPDATE_QUEUE_WAIT", 2))  # сек ждать места, потом 503
+UPDATE_DRAIN_TIMEOUT = float(os.getenv("UPDATE_DRAIN_TIMEOUT", 20))  # сек дообработки при остановке
+
+# Кэш пользователей (full_name, is_admin, group_id)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 300))  # сек
+
+# Кэш готовых ответов /schedule по датам
+SCHEDULE_CACHE_SIZE = int(os.getenv("SCHEDULE_CACHE_SIZE", 400))
+SCHEDULE_CACHE_TTL = float(os.getenv("SCHEDULE_CACHE_TTL", 86400))  # сек
+
+# Импорт расписания из CSV/ICS (/import_schedule)
+SCHEDULE_IMPORT_MAX_LESSONS = int(os.getenv("SCHEDULE_IMPORT_MAX_LESSONS", 5000))  # уроков в одном файле
+
+# Постраничные /users и /birthdays
+USERS_PAGE_SIZE = int(os.getenv("USERS_PAGE_SIZE", 25))
+
+# Поиск студента по ФИО (/birthday)
+NAME_SEARCH_LIMIT = int(os.getenv("NAME_SEARCH_LIMIT", 8))  # кандидатов в выборе
+
+# Сводка посещаемости
+ATTENDANCE_WINDOW_DAYS = int(os.getenv("ATTENDANCE_WINDOW_DAYS", 30))
+ATTENDANCE_CACHE_SIZE = int(os.getenv("ATTENDANCE_CACHE_SIZE", 5000))
+ATTENDANCE_CACHE_TTL = float(os.getenv("ATTENDANCE_CACHE_TTL", 3600))  # сек
+
+# Перекличка
+ROLLCALL_PAGE_SIZE = int(os.getenv("ROLLCALL_PAGE_SIZE", 20))  # студентов на странице клавиатуры
+
+# Резервные копии
+# Бот отправляет файлы до 50 МБ, но скачать через Bot API может только до 20 МБ,
+# поэтому части меньше 20 МБ — иначе их не получится отдать в /restore_db
+BACKUP_PART_SIZE = int(os.getenv("BACKUP_PART_SIZE", 19 * 1024 * 1024))
+BACKUP_BATCH_SIZE = int(os.getenv("BACKUP_BATCH_SIZE", 2000))  # строк за одну выборку из курсора
+
+# Планировщик задач
+BOT_TIMEZONE = os.getenv("BOT_TIMEZONE", "UTC")
+BIRTHDAY_CRON = os.getenv("BIRTHDAY_CRON", "0 9 * * *")
+SCHEDULER_CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", 2))
+JOB_STALE_AFTER = int(os.getenv("JOB_STALE_AFTER", 3600))  # сек: незавершённый запуск можно перезапустить
+JOB_RETRY_DELAY = int(os.getenv("JOB_RETRY_DELAY", 60))  # сек: первая пауза перед повтором упавшего запуска
+JOB_RETRY_MAX_DELAY = int(os.getenv("JOB_RETRY_MAX_DELAY", 1800))
+
+# Утренняя рассылка расписания и ДЗ подписчикам
+DIGEST_CRON = os.getenv("DIGEST_CRON", "0 7 * * 1-6")
+
+# Постраничный вывод /homework
+HOMEWORK_PAGE_SIZE = int(os.getenv("HOMEWORK_PAGE_SIZE", 10))  # заданий на странице
+MESSAGE_LIMIT = 3900  # запас до лимита Telegram в 4096 символов
+
+# Кэш отрисованных фрагментов ответов (строки уроков, заданий, списков)
+FRAGMENT_CACHE_SIZE = int(os.getenv("FRAGMENT_CACHE_SIZE", 5000))
+FRAGMENT_CACHE_TTL = float(os.getenv("FRAGMENT_CACHE_TTL", 3600))  # сек
+
+# Рассылки (Telegram: ~30 сообщений в секунду на бота)
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))  # сообщений в секунду
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 10))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", 3))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", 3))  # сек между правками статуса
+
+# Консоль /debug: только чтение, с таймаутом, выгрузка в файл
+DEBUG_STATEMENT_TIMEOUT = float(os.getenv("DEBUG_STATEMENT_TIMEOUT", 5))  # сек на просмотр и EXPLAIN
+DEBUG_EXPORT_TIMEOUT = float(os.getenv("DEBUG_EXPORT_TIMEOUT", 120))  # сек на выгрузку
+DEBUG_PREVIEW_ROWS = int(os.getenv("DEBUG_PREVIEW_ROWS", 10))
+DEBUG_EXPORT_MAX_ROWS = int(os.getenv("DEBUG_EXPORT_MAX_ROWS", 1_000_000))
+DEBUG_EXPORT_MAX_BYTES = int(os.getenv("DEBUG_EXPORT_MAX_BYTES", 45 * 1024 * 1024))  # бот отправляет до 50 МБ
+
+# Журнал медленных запросов (/slow_queries)
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 200))  # порог, мс
+SLOW_QUERY_EXPLAIN_RATE = float(os.getenv("SLOW_QUERY_EXPLAIN_RATE", 0.2))  # доля медленных с EXPLAIN
+SLOW_QUERY_EXPLAIN_INTERVAL = float(os.getenv("SLOW_QUERY_EXPLAIN_INTERVAL", 300))  # сек между EXPLAIN одного запроса
+SLOW_QUERY_LOG_SIZE = int(os.getenv("SLOW_QUERY_LOG_SIZE", 50))
+
+# Свой Bot API сервер (локальный telegram-bot-api или заглушка из bench/)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
+# Метрики Prometheus на /metrics. Если задан токен, нужен заголовок
+# Authorization: Bearer <токен>
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
 # Webhook настройки
 WEBHOOK_PATH = f"/webhook/{BOT_TOKEN}"
 WEBHOOK_URL = f"https://{os.getenv('RENDER_EXTERNAL_HOSTNAME', 'your-service.onrender.com')}{WEBHOOK_PATH}"
@@ -37,10 +165,203 @@ if not BOT_TOKEN:
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL не установлен! Проверьте настройки Render.")
 
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+class FSMRecord:
+    __slots__ = ("state", "data", "touched")
+
+    def __init__(self, state=None, data=None):
+        self.state = state
+        self.data = data or {}
+        self.touched = time.monotonic()
+
+class PostgresStorage(BaseStorage):
+    """FSM-хранилище в таблице fsm_states с кэшем в памяти.
+
+    Чтение идёт из памяти, при промахе — из базы. Запись сразу попадает
+    в память, а в базу уходит пачкой раз в flush_interval секунд одним
+    запросом. Состояния, не менявшиеся дольше ttl, считаются брошенными
+    и удаляются и из памяти, и из базы.
+
+    shared=True — режим нескольких процессов: апдейты одного чата могут
+    прийти в разные процессы, поэтому запись сразу уходит в базу, а
+    чтение всегда берёт актуальную версию из неё."""
+
+    def __init__(self, flush_interval: float, ttl: float, cache_size: int, shared: bool = False):
+        self.key_builder = DefaultKeyBuilder()
+        self.shared = shared
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self._records = OrderedDict()  # key -> FSMRecord
+        self._dirty = set()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def _record(self, key) -> tuple:
+        name = self.key_builder.build(key)
+        record = self._records.get(name)
+        if record is not None and self.shared and name not in self._dirty:
+            del self._records[name]
+            record = None
+        if record is not None:
+            if record.touched + self.ttl < time.monotonic():
+                # Брошенный диалог: начинаем с чистого состояния
+                record.state, record.data = None, {}
+                self._dirty.add(name)
+            self._records.move_to_end(name)
+            return name, record
+        
+        row = await execute_query(
+            "SELECT state, data FROM fsm_states WHERE key = %s "
+            "AND updated_at > CURRENT_TIMESTAMP - %s * INTERVAL '1 second'",
+            (name, self.ttl), fetch=True
+        )
+        # Пока ждали базу, запись могла появиться
+        record = self._records.get(name)
+        if record is None:
+            record = FSMRecord(*row[0]) if row else FSMRecord()
+            self._records[name] = record
+            self._evict()
+        return name, record
+
+    def _evict(self):
+        # Несохранённые записи не вытесняем
+        for name in list(self._records):
+            if len(self._records) <= self.cache_size:
+                break
+            if name not in self._dirty:
+                del self._records[name]
+
+    async def _touch(self, name: str, record: FSMRecord):
+        record.touched = time.monotonic()
+        self._dirty.add(name)
+        if self.shared:
+            await self.flush()
+
+    async def set_state(self, key, state=None):
+        name, record = await self._record(key)
+        record.state = state.state if isinstance(state, State) else state
+        await self._touch(name, record)
+
+    async def get_state(self, key):
+        _, record = await self._record(key)
+        return record.state
+
+    async def set_data(self, key, data):
+        name, record = await self._record(key)
+        record.data = data.copy()
+        await self._touch(name, record)
+
+    async def get_data(self, key):
+        _, record = await self._record(key)
+        return record.data.copy()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            names = list(self._dirty)
+            self._dirty.clear()
+            upserts = []
+            deletes = []
+            for name in names:
+                record = self._records.get(name)
+                if record is None:
+                    continue
+                if record.state is None and not record.data:
+                    deletes.append(name)
+                else:
+                    upserts.append((name, record.state, json.dumps(record.data, ensure_ascii=False)))
+            try:
+                async with db_pool.connection() as conn:
+                    if upserts:
+                        await conn.execute(
+                            "INSERT INTO fsm_states (key, state, data, updated_at) "
+                            "SELECT k, s, d::jsonb, CURRENT_TIMESTAMP FROM unnest(%s::text[], %s::text[], %s::text[]) AS t(k, s, d) "
+                            "ON CONFLICT (key) DO UPDATE SET state = EXCLUDED.state, data = EXCLUDED.data, "
+                            "updated_at = EXCLUDED.updated_at",
+                            [list(column) for column in zip(*upserts)]
+                        )
+                    if deletes:
+                        await conn.execute("DELETE FROM fsm_states WHERE key = ANY(%s)", (deletes,))
+            except Exception:
+                # Повторим при следующей записи пачкой
+                self._dirty.update(names)
+                raise
+
+    async def purge_expired(self):
+        now = time.monotonic()
+        for name, record in list(self._records.items()):
+            if record.touched + self.ttl < now and name not in self._dirty:
+                del self._records[name]
+        deleted = await execute_query(
+            "DELETE FROM fsm_states WHERE updated_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 second'",
+            (self.ttl,)
+        )
+        if deleted:
+            logger.info(f"🧹 Удалено брошенных FSM-состояний: {deleted}")
+
+    async def _flush_loop(self):
+        last_purge = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.monotonic() - last_purge > 600:
+                    await self.purge_expired()
+                    last_purge = time.monotonic()
+            except Exception as e:
+                logger.error(f"❌ Не удалось сохранить FSM-состояния: {e}")
+
+    def __len__(self):
+        return len(self._records)
+
+    def state_counts(self):
+        """Число диалогов в памяти по состояниям (для /metrics)."""
+        counts = {}
+        for record in self._records.values():
+            if record.state:
+                counts[record.state] = counts.get(record.state, 0) + 1
+        return counts
+
+if TELEGRAM_API_URL:
+    bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(token=BOT_TOKEN)
+if FSM_STORAGE == "memory":
+    storage = MemoryStorage()
+else:
+    storage = PostgresStorage(FSM_FLUSH_INTERVAL, FSM_STATE_TTL, FSM_CACHE_SIZE, shared=WEB_WORKERS > 1)
 dp = Dispatcher(storage=storage)
 
+# Открывается один раз в on_startup, закрывается в on_shutdown.
+# check_connection проверяет соединение перед выдачей, prepare_threshold
+# включает серверные prepared statements для повторяющихся запросов.
+db_pool = AsyncConnectionPool(
+    DATABASE_URL,
+    min_size=DB_POOL_MIN_SIZE,
+    max_size=DB_POOL_MAX_SIZE,
+    timeout=DB_POOL_TIMEOUT,
+    max_idle=DB_POOL_MAX_IDLE,
+    max_lifetime=DB_POOL_MAX_LIFETIME,
+    kwargs={
+        "sslmode": DB_SSLMODE,
+        "connect_timeout": 10,
+        "prepare_threshold": DB_PREPARE_THRESHOLD,
+    },
+    check=AsyncConnectionPool.check_connection,
+    name="school_bot",
+    open=False,
+)
+
 # Проверка прав супер-админа
 def is_super_admin(user_id: int) -> bool:
     return user_id in SUPER_ADMINS
@@ -50,74 +371,300 @@ async def is_admin(user_id: int) -> bool:
     result = await get_user(user_id)
     return result and result[1]  # result[1] = is_admin
 
+# Группа, в которую попадают данные, созданные до появления групп
+DEFAULT_GROUP_ID = 1
+DEFAULT_GROUP_NAME = "Основная группа"
+
+# Ключи advisory-блокировок PostgreSQL
+INIT_LOCK_ID = 7_450_525_001  # инициализация схемы: воркеры выполняют её по очереди
+LEADER_LOCK_ID = 7_450_525_002  # лидер: вебхук и задачи по расписанию
+
 # Инициализация PostgreSQL базы
-def init_db():
-    conn = psycopg2.connect(DATABASE_URL, sslmode='require')
+async def init_db():
+    async with db_pool.connection() as conn:
+        await conn.execute("SELECT pg_advisory_lock(%s)", (INIT_LOCK_ID,))
+        await conn.commit()
+        try:
+            await _create_schema(conn)
+        finally:
+            # После ошибки транзакция прервана и unlock бы тоже упал, скрыв её,
+            # а блокировка осталась бы на соединении в пуле
+            await conn.rollback()
+            await conn.execute("SELECT pg_advisory_unlock(%s)", (INIT_LOCK_ID,))
+            await conn.commit()
+    logger.info("✅ PostgreSQL база инициализирована")
+
+async def _create_schema(conn):
     cursor = conn.cursor()
-    
+
+    # Группы (классы): расписание, ДЗ, посещаемость и рассылки у каждой свои
+    await cursor.execute('''
+        CREATE TABLE IF NOT EXISTS groups (
+            id SERIAL PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    await cursor.execute(
+        "INSERT INTO groups (id, name) VALUES (%s, %s) ON CONFLICT DO NOTHING", (DEFAULT_GROUP_ID, DEFAULT_GROUP_NAME)
+    )
+    await cursor.execute("SELECT setval(pg_get_serial_sequence('groups', 'id'), MAX(id)) FROM groups")
+
     # Таблица пользователей
-    cursor.execute('''
+    await cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
             id SERIAL PRIMARY KEY,
             telegram_id BIGINT UNIQUE NOT NULL,
             full_name TEXT,
-            birth_date TEXT,
+            birth_date DATE,
             is_admin BOOLEAN DEFAULT FALSE,
             joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    
+    # Пользователь заблокировал бота — рассылки его пропускают до следующего /start
+    await cursor.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS is_active BOOLEAN NOT NULL DEFAULT TRUE')
+    # Подписка на утреннюю рассылку (/digest)
+    await cursor.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS digest_enabled BOOLEAN NOT NULL DEFAULT FALSE')
+
     # Расписание
-    cursor.execute('''
+    await cursor.execute('''
         CREATE TABLE IF NOT EXISTS schedule (
             id SERIAL PRIMARY KEY,
-            date TEXT NOT NULL,
+            group_id INTEGER NOT NULL REFERENCES groups(id),
+            date DATE NOT NULL,
             lesson_number INTEGER NOT NULL,
             subject TEXT NOT NULL,
             classroom TEXT,
-            start_time TEXT,
-            end_time TEXT,
+            start_time TIME,
+            end_time TIME,
             lesson_type TEXT,
             teacher TEXT,
-            UNIQUE(date, lesson_number)
+            UNIQUE(group_id, date, lesson_number)
         )
     ''')
-    
+
     # Домашние задания
-    cursor.execute('''
+    await cursor.execute('''
         CREATE TABLE IF NOT EXISTS homework (
             id SERIAL PRIMARY KEY,
+            group_id INTEGER NOT NULL REFERENCES groups(id),
             subject TEXT NOT NULL,
             description TEXT NOT NULL,
-            due_date TEXT NOT NULL CHECK(due_date ~ '^\\d{4}-\\d{2}-\\d{2}$'),
+            due_date DATE NOT NULL,
             added_by BIGINT NOT NULL,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    
+
     # Посещаемость
-    cursor.execute('''
+    await cursor.execute('''
         CREATE TABLE IF NOT EXISTS attendance (
             id SERIAL PRIMARY KEY,
             user_id BIGINT NOT NULL,
-            date TEXT NOT NULL,
+            date DATE NOT NULL,
             status TEXT NOT NULL DEFAULT 'present',
             reason TEXT,
             marked_by BIGINT NOT NULL,
             marked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            group_id INTEGER REFERENCES groups(id),
             UNIQUE(user_id, date)
         )
     ''')
+
+    # Базы, созданные до появления групп: всё переходит в группу по умолчанию
+    await migrate_groups(conn)
+
+    # Индексы: все выборки идут внутри группы, поэтому group_id — первым
+    await cursor.execute('DROP INDEX IF EXISTS idx_schedule_date')
+    await cursor.execute('DROP INDEX IF EXISTS idx_homework_due_date')
+    await cursor.execute('DROP INDEX IF EXISTS idx_attendance_date')
+    await cursor.execute('CREATE INDEX IF NOT EXISTS idx_homework_group_due_date ON homework(group_id, due_date, id)')
+    await cursor.execute('CREATE INDEX IF NOT EXISTS idx_attendance_group_date ON attendance(group_id, date)')
+
+    # Планировщик: задачи, их последний запуск и журнал запусков
+    await cursor.execute('''
+        CREATE TABLE IF NOT EXISTS scheduled_jobs (
+            name TEXT PRIMARY KEY,
+            spec TEXT NOT NULL,
+            timezone TEXT NOT NULL,
+            last_run_at TIMESTAMPTZ
+        )
+    ''')
+    await cursor.execute('''
+        CREATE TABLE IF NOT EXISTS job_runs (
+            job_name TEXT NOT NULL,
+            scheduled_for TIMESTAMPTZ NOT NULL,
+            started_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMPTZ,
+            error TEXT,
+            PRIMARY KEY (job_name, scheduled_for)
+        )
+    ''')
+
+    # Состояния диалогов (FSM)
+    await cursor.execute('''
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data JSONB NOT NULL DEFAULT '{}',
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    await cursor.execute('CREATE INDEX IF NOT EXISTS idx_fsm_states_updated_at ON fsm_states(updated_at)')
+
+    # Кого уже поздравили — чтобы повторный запуск не поздравил дважды
+    await cursor.execute('''
+        CREATE TABLE IF NOT EXISTS birthday_greetings (
+            telegram_id BIGINT NOT NULL,
+            greeted_on DATE NOT NULL,
+            PRIMARY KEY (telegram_id, greeted_on)
+        )
+    ''')
+
+    # Журнал обработанных апдейтов: Telegram может прислать один update_id повторно
+    await cursor.execute('''
+        CREATE TABLE IF NOT EXISTS processed_updates (
+            update_id BIGINT PRIMARY KEY,
+            received_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    await cursor.execute('CREATE INDEX IF NOT EXISTS idx_processed_updates_received_at ON processed_updates(received_at)')
+
+    # Базы, созданные до перехода на DATE/TIME
+    await migrate_date_columns(conn)
+
+    # Поздравления: поиск по месяцу и дню рождения
+    await cursor.execute(
+        'CREATE INDEX IF NOT EXISTS idx_users_birthday ON users '
+        '((EXTRACT(MONTH FROM birth_date)), (EXTRACT(DAY FROM birth_date))) WHERE birth_date IS NOT NULL'
+    )
+    # Постраничные /users и /birthdays и перекличка: поиск по ключу страницы внутри группы
+    await cursor.execute('DROP INDEX IF EXISTS idx_users_joined_at')
+    await cursor.execute('DROP INDEX IF EXISTS idx_users_full_name')
+    await cursor.execute(
+        'CREATE INDEX IF NOT EXISTS idx_users_group_joined_at ON users(group_id, joined_at, telegram_id)'
+    )
+    await cursor.execute(
+        'CREATE INDEX IF NOT EXISTS idx_users_group_full_name ON users(group_id, full_name, telegram_id) '
+        'WHERE full_name IS NOT NULL'
+    )
+    # Поиск по ФИО: без учёта регистра, ё/е и лишних пробелов, нечёткий — через pg_trgm
+    await cursor.execute(
+        "SELECT prosrc FROM pg_proc WHERE proname = 'name_norm' AND pronamespace = current_schema()::regnamespace"
+    )
+    current = await cursor.fetchone()
+    if current is None or current[0].strip() != NAME_NORM_SQL:
+        await cursor.execute(
+            "CREATE OR REPLACE FUNCTION name_norm(text) RETURNS text LANGUAGE sql IMMUTABLE PARALLEL SAFE "
+            f"AS $$ {NAME_NORM_SQL} $$"
+        )
+        # Индекс построен по старому определению — пересоздаётся ниже
+        await cursor.execute('DROP INDEX IF EXISTS idx_users_name_trgm')
+    global name_search_trgm
+    try:
+        async with conn.transaction():
+            await cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            await cursor.execute(
+                'CREATE INDEX IF NOT EXISTS idx_users_name_trgm ON users '
+                'USING gin (name_norm(full_name) gin_trgm_ops) WHERE full_name IS NOT NULL'
+            )
+        name_search_trgm = True
+    except psycopg.Error as e:
+        logger.warning(f"⚠️ pg_trgm недоступен, поиск по ФИО будет без индекса: {e}")
+    # /attendance и перекличка: index-only scan по пользователю и периоду
+    await cursor.execute(
+        'CREATE INDEX IF NOT EXISTS idx_attendance_user_date ON attendance(user_id, date) INCLUDE (status)'
+    )
+    await conn.commit()
+
+# Тело name_norm(): то же, что normalize_name()
+NAME_NORM_SQL = r"SELECT btrim(regexp_replace(replace(lower($1), 'ё', 'е'), '\s+', ' ', 'g'))"
+
+# Таблицы с колонкой group_id
+GROUP_TABLES = ["users", "schedule", "homework", "attendance"]
+
+# Колонки, которые раньше хранились как TEXT
+DATE_COLUMNS = [
+    ("users", "birth_date", "DATE"),
+    ("schedule", "date", "DATE"),
+    ("schedule", "start_time", "TIME"),
+    ("schedule", "end_time", "TIME"),
+    ("homework", "due_date", "DATE"),
+    ("attendance", "date", "DATE"),
+]
+
+async def migrate_date_columns(conn):
+    """Переводит TEXT-колонки дат и времени в DATE/TIME.
+    Каждая таблица меняется в своей короткой транзакции с lock_timeout,
+    чтобы не держать блокировку, если таблица занята запросами."""
+    cursor = await conn.execute(
+        "SELECT table_name, column_name FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND data_type = 'text' "
+        "AND (table_name, column_name) IN (SELECT * FROM unnest(%s::text[], %s::text[]))",
+        ([t for t, _, _ in DATE_COLUMNS], [c for _, c, _ in DATE_COLUMNS])
+    )
+    pending = {(table, column) for table, column in await cursor.fetchall()}
+    await conn.commit()
     
-    # Индексы
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_schedule_date ON schedule(date)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_homework_due_date ON homework(due_date)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_attendance_date ON attendance(date)')
+    for table in dict.fromkeys(t for t, _, _ in DATE_COLUMNS):
+        changes = [
+            f"ALTER COLUMN {column} TYPE {sql_type} USING NULLIF({column}, '')::{sql_type.lower()}"
+            for t, column, sql_type in DATE_COLUMNS if t == table and (table, column) in pending
+        ]
+        if not changes:
+            continue
+        async with conn.transaction():
+            await conn.execute("SET LOCAL lock_timeout = '10s'")
+            if table == "homework":
+                # Проверка формата строки не нужна для DATE
+                await conn.execute("ALTER TABLE homework DROP CONSTRAINT IF EXISTS homework_due_date_check")
+            await conn.execute(f"ALTER TABLE {table} {', '.join(changes)}")
+        logger.info(f"✅ {table}: колонки дат переведены в DATE/TIME")
+
+async def migrate_groups(conn):
+    """Добавляет group_id в таблицы, созданные до появления групп.
+    Как и migrate_date_columns, меняет только то, что ещё не переведено:
+    ALTER TABLE берёт ACCESS EXCLUSIVE, и при каждом запуске воркера
+    он бы вставал в очередь за долгими выгрузками и держал все чтения."""
+    cursor = await conn.execute(
+        "SELECT t.table_name, c.is_nullable, k.constraint_name IS NOT NULL "
+        "FROM information_schema.tables t "
+        "LEFT JOIN information_schema.columns c ON c.table_schema = t.table_schema "
+        "AND c.table_name = t.table_name AND c.column_name = 'group_id' "
+        "LEFT JOIN information_schema.table_constraints k ON k.table_schema = t.table_schema "
+        "AND k.table_name = t.table_name AND k.constraint_name = 'schedule_date_lesson_number_key' "
+        "WHERE t.table_schema = current_schema() AND t.table_name = ANY(%s)",
+        (GROUP_TABLES,)
+    )
+    pending = {table: (nullable, old_unique) for table, nullable, old_unique in await cursor.fetchall()}
+    await conn.commit()
     
-    conn.commit()
-    cursor.close()
-    conn.close()
-    logger.info("✅ PostgreSQL база инициализирована")
+    for table in GROUP_TABLES:
+        nullable, old_unique = pending[table]
+        changes = []
+        if nullable is None:
+            # DEFAULT нужен только для заполнения существующих строк, новые строки
+            # всегда пишутся с группой (у пользователей — после выбора через /group)
+            changes += [
+                f"ADD COLUMN group_id INTEGER REFERENCES groups(id) DEFAULT {DEFAULT_GROUP_ID}",
+                "ALTER COLUMN group_id DROP DEFAULT",
+            ]
+        if table in ("schedule", "homework") and nullable != "NO":
+            changes.append("ALTER COLUMN group_id SET NOT NULL")
+        if old_unique:
+            changes.append("DROP CONSTRAINT schedule_date_lesson_number_key")
+        if not changes:
+            continue
+        async with conn.transaction():
+            await conn.execute("SET LOCAL lock_timeout = '10s'")
+            for change in changes:
+                await conn.execute(f"ALTER TABLE {table} {change}")
+            if old_unique:
+                await conn.execute(
+                    "CREATE UNIQUE INDEX schedule_group_id_date_lesson_number_key "
+                    "ON schedule(group_id, date, lesson_number)"
+                )
+        logger.info(f"✅ {table}: данные перенесены в группу по умолчанию")
 
 # Состояния
 class Form(StatesGroup):
@@ -147,34 +694,807 @@ class RevokeAdmin(StatesGroup):
 class ChangePassword(StatesGroup):
     waiting_for_new_password = State()
 
-# Утилиты для PostgreSQL
-def execute_query_sync(query, params=(), fetch=False):
-    conn = psycopg2.connect(DATABASE_URL, sslmode='require', connect_timeout=10)
-    cursor = conn.cursor()
-    cursor.execute(query, params)
-    if fetch:
-        result = cursor.fetchall() if "SELECT" in query.upper() else cursor.fetchone()
+class RollCall(StatesGroup):
+    marking = State()
+
+class RestoreDB(StatesGroup):
+    waiting_for_files = State()
+
+class ScheduleImport(StatesGroup):
+    waiting_for_file = State()
+    confirming = State()
+
+# МЕТРИКИ
+# Счётчики и гистограммы в памяти процесса, текстовый формат Prometheus.
+# На горячем пути — только поиск в словаре и bisect по границам корзин
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values = {}  # значения меток -> число
+
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for label_values, value in self.values.items():
+            yield f"{self.name}{_format_labels(self.labels, label_values)} {value}"
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}  # значения меток -> [счётчики корзин..., +Inf, сумма]
+
+    def observe(self, value: float, *label_values):
+        series = self.values.get(label_values)
+        if series is None:
+            series = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        names = self.labels + ("le",)
+        for label_values, series in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                yield f"{self.name}_bucket{_format_labels(names, label_values + (bound,))} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, label_values)} {series[-1]}"
+            yield f"{self.name}_count{_format_labels(self.labels, label_values)} {cumulative}"
+
+handler_latency = Histogram(
+    "bot_handler_duration_seconds", "Время работы обработчика", ("handler", "status")
+)
+db_query_latency = Histogram(
+    "bot_db_query_duration_seconds", "Время запроса execute_query по месту вызова", ("site",)
+)
+telegram_latency = Histogram(
+    "bot_telegram_request_duration_seconds", "Время запроса к Bot API", ("method",)
+)
+telegram_errors = Counter(
+    "bot_telegram_errors_total", "Ошибки запросов к Bot API", ("method", "error")
+)
+metrics = [handler_latency, db_query_latency, telegram_latency, telegram_errors]
+
+def gauge(name: str, help_text: str, samples, labels=(), kind: str = "gauge"):
+    """Значения, которые считаются в момент запроса /metrics."""
+    yield f"# HELP {name} {help_text}"
+    yield f"# TYPE {name} {kind}"
+    for label_values, value in samples:
+        yield f"{name}{_format_labels(labels, label_values)} {value}"
+
+def render_metrics() -> str:
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+
+    if isinstance(storage, PostgresStorage):
+        states = storage.state_counts()
     else:
-        result = cursor.rowcount
-    conn.commit()
-    cursor.close()
-    conn.close()
-    return result
+        states = {}
+        for record in storage.storage.values():
+            if record.state:
+                states[record.state] = states.get(record.state, 0) + 1
+    lines.extend(gauge("bot_fsm_states", "Диалоги в памяти по состояниям",
+                       (((state,), count) for state, count in states.items()), ("state",)))
+
+    q = update_queue
+    lines.extend(gauge("bot_update_queue_depth", "Апдейтов в очереди и в работе", [((), q.depth)]))
+    lines.extend(gauge("bot_update_queue_active", "Апдейтов в работе", [((), q.active)]))
+    lines.extend(gauge("bot_update_queue_max_depth", "Наибольшая глубина очереди", [((), q.max_depth)]))
+    lines.extend(gauge("bot_updates_total", "Апдейты по итогу", [
+        (("accepted",), q.accepted), (("rejected",), q.rejected),
+        (("processed",), q.processed), (("failed",), q.failed),
+    ], ("result",), kind="counter"))
+
+    lines.extend(gauge("bot_cache_entries", "Записей в кэше",
+                       (((name,), len(cache)) for name, cache in caches.items()), ("cache",)))
+    lines.extend(gauge("bot_cache_hits_total", "Попадания в кэш",
+                       (((name,), cache.hits) for name, cache in caches.items()), ("cache",), kind="counter"))
+    lines.extend(gauge("bot_cache_misses_total", "Промахи кэша",
+                       (((name,), cache.misses) for name, cache in caches.items()), ("cache",), kind="counter"))
+    lines.extend(gauge("bot_cache_hit_ratio", "Доля попаданий в кэш",
+                       (((name,), cache.hit_rate / 100) for name, cache in caches.items()), ("cache",)))
+
+    pool = db_pool.get_stats()
+    lines.extend(gauge("bot_db_pool_connections", "Соединения пула", [
+        (("size",), pool.get("pool_size", 0)), (("available",), pool.get("pool_available", 0)),
+        (("waiting",), pool.get("requests_waiting", 0)),
+    ], ("kind",)))
+    return "\n".join(lines) + "\n"
+
+async def metrics_endpoint(request: web.Request) -> web.Response:
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return web.Response(text="Unauthorized", status=401)
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Worker-Pid": str(os.getpid())})
+
+# Обработчик, внутри которого выполняется код (для журнала медленных запросов)
+current_handler = contextvars.ContextVar("current_handler", default=None)
+
+# Время обработчиков: inner-middleware вызывается, только когда обработчик найден
+async def handler_metrics(handler, event, data):
+    name = data["handler"].callback.__name__
+    token = current_handler.set(name)
+    started = time.perf_counter()
+    status = "error"
+    try:
+        result = await handler(event, data)
+        status = "ok"
+        return result
+    finally:
+        handler_latency.observe(time.perf_counter() - started, name, status)
+        current_handler.reset(token)
+
+dp.message.middleware(handler_metrics)
+dp.callback_query.middleware(handler_metrics)
+
+# Запросы к Bot API
+async def telegram_metrics(make_request, bot, method):
+    name = method.__api_method__
+    started = time.perf_counter()
+    try:
+        return await make_request(bot, method)
+    except Exception as e:
+        telegram_errors.inc(name, type(e).__name__)
+        raise
+    finally:
+        telegram_latency.observe(time.perf_counter() - started, name)
+
+bot.session.middleware(telegram_metrics)
+
+# МЕДЛЕННЫЕ ЗАПРОСЫ
+class SlowQuery:
+    __slots__ = ("at", "duration", "query", "params", "site", "handler", "plan")
+
+    def __init__(self, duration, query, params, site, handler):
+        self.at = datetime.datetime.now(datetime.timezone.utc)
+        self.duration = duration
+        self.query = query
+        self.params = params
+        self.site = site
+        self.handler = handler
+        self.plan = None
+
+slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+slow_query_count = Counter("bot_db_slow_queries_total", "Запросы дольше SLOW_QUERY_MS", ("site",))
+metrics.append(slow_query_count)
+_last_explained = {}  # текст запроса -> время последнего EXPLAIN
 
+def record_slow_query(duration, query, params, site):
+    handler = current_handler.get()
+    params_text = repr(params)
+    if len(params_text) > 200:
+        params_text = params_text[:197] + "..."
+    logger.warning(
+        f"🐢 Медленный запрос {duration * 1000:.0f} мс в {site}"
+        f"{f' ({handler})' if handler else ''}: {' '.join(query.split())} {params_text}"
+    )
+    slow_query_count.inc(site)
+    entry = SlowQuery(duration, query, params_text, site, handler)
+    slow_queries.append(entry)
+    
+    # План строится только для выборки медленных запросов
+    # и не чаще раза в SLOW_QUERY_EXPLAIN_INTERVAL на один текст
+    now = time.monotonic()
+    if random.random() >= SLOW_QUERY_EXPLAIN_RATE:
+        return
+    if now - _last_explained.get(query, -SLOW_QUERY_EXPLAIN_INTERVAL) < SLOW_QUERY_EXPLAIN_INTERVAL:
+        return
+    if not re.match(r"\s*(SELECT|WITH|INSERT|UPDATE|DELETE)\b", query, re.IGNORECASE):
+        return
+    if len(_last_explained) > 1000:
+        _last_explained.clear()
+    _last_explained[query] = now
+    run_in_background(explain_slow_query(entry, params))
+
+def is_read_only_query(query: str) -> bool:
+    # WITH может содержать изменяющие CTE, SELECT — FOR UPDATE
+    return bool(re.match(r"\s*(SELECT|WITH)\b", query, re.IGNORECASE)) and not re.search(
+        r"\b(INSERT|UPDATE|DELETE|MERGE)\b", query, re.IGNORECASE
+    )
+
+async def explain_slow_query(entry: SlowQuery, params):
+    # ANALYZE выполняет запрос ещё раз. Для записи откат скрыл бы изменения,
+    # но не сдвиг последовательностей и блокировки строк — ей только план
+    explain = "EXPLAIN (ANALYZE, BUFFERS) " if is_read_only_query(entry.query) else "EXPLAIN "
+    try:
+        async with db_pool.connection() as conn:
+            # Транзакция откатывается в любом случае
+            async with conn.transaction(force_rollback=True):
+                await conn.execute(f"SET LOCAL statement_timeout = {int(max(entry.duration * 4, 1) * 1000)}")
+                cursor = await conn.execute(explain + entry.query, params or None)
+                entry.plan = "\n".join(row[0] for row in await cursor.fetchall())
+    except Exception as e:
+        entry.plan = f"EXPLAIN не удался: {e}"
+
+# Утилиты для PostgreSQL
+# Соединение берётся из пула и возвращается в него после запроса;
+# выход из db_pool.connection() без исключения фиксирует транзакцию.
 async def execute_query(query, params=(), fetch=False):
-    return await asyncio.to_thread(execute_query_sync, query, params, fetch)
+    started = time.perf_counter()
+    try:
+        async with db_pool.connection() as conn:
+            cursor = await conn.execute(query, params or None)
+            if fetch:
+                result = await cursor.fetchall() if "SELECT" in query.upper() else await cursor.fetchone()
+            else:
+                result = cursor.rowcount
+        return result
+    finally:
+        # Место вызова — имя вызывающей функции (с классом для методов)
+        code = sys._getframe(1).f_code
+        site = getattr(code, "co_qualname", code.co_name)
+        duration = time.perf_counter() - started
+        db_query_latency.observe(duration, site)
+        if duration * 1000 >= SLOW_QUERY_MS:
+            record_slow_query(duration, query, params, site)
 
-def get_user_sync(user_id: int):
-    conn = psycopg2.connect(DATABASE_URL, sslmode='require', connect_timeout=5)
-    cursor = conn.cursor()
-    cursor.execute("SELECT full_name, is_admin FROM users WHERE telegram_id = %s", (user_id,))
-    result = cursor.fetchone()
-    cursor.close()
-    conn.close()
+# Кэш в памяти процесса
+class TTLCache:
+    """Ограниченный LRU-кэш: старые записи вытесняются при переполнении,
+    устаревшие (старше ttl секунд) считаются промахом."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        # Поколения: инвалидация увеличивает счётчик ключа (clear — общий),
+        # чтобы значение, посчитанное до инвалидации, не попало в кэш после неё
+        self._epoch = 0
+        self._generations = {}
+
+    def generation(self, key):
+        return self._epoch, self._generations.get(key, 0)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def peek(self, key, default=None):
+        """Значение без учёта в статистике и порядке вытеснения."""
+        item = self._data.get(key)
+        return item[1] if item is not None and item[0] >= time.monotonic() else default
+
+    def set(self, key, value, generation=None):
+        """generation — снимок generation(key) до чтения из базы: если ключ
+        с тех пор инвалидировали, значение устарело и не сохраняется."""
+        if generation is not None and generation != self.generation(key):
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+        if len(self._generations) >= self.maxsize:
+            self._new_epoch()
+        self._generations[key] = self._generations.get(key, 0) + 1
+
+    def invalidate_where(self, predicate):
+        for key in [key for key in self._data if predicate(key)]:
+            del self._data[key]
+        self._new_epoch()
+
+    def clear(self):
+        self._data.clear()
+        self._new_epoch()
+
+    def _new_epoch(self):
+        self._epoch += 1
+        self._generations.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total * 100 if total else 0.0
+
+    def memory_usage(self) -> int:
+        """Примерный объём ключей и значений в байтах."""
+        return sum(_sizeof(key) + _sizeof(value) for key, (_, value) in self._data.items())
+
+def _sizeof(obj) -> int:
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (tuple, list)):
+        size += sum(_sizeof(item) for item in obj)
+    elif isinstance(obj, dict):
+        size += sum(_sizeof(key) + _sizeof(value) for key, value in obj.items())
+    elif isinstance(obj, MessageBuilder):
+        size += _sizeof(obj.header) + _sizeof(obj.blocks)
+    return size
+
+# ОТРИСОВКА СООБЩЕНИЙ
+# Все ответы собираются здесь: шаблоны экранируют подставляемые значения
+# под parse_mode, готовые фрагменты кэшируются, а длинный текст режется
+# на сообщения только по границам строк, не разрывая разметку
+class Markup(str):
+    """Готовая разметка: шаблон вставляет её как есть."""
+
+def escape_markdown(text: str) -> str:
+    # Legacy Markdown: вне сущностей экранируются только _ * ` [
+    return re.sub(r"([_*`\[])", r"\\\1", text)
+
+def escape_markdown_entity(text: str) -> str:
+    # Внутри *жирного* экранирование не работает: убираем символы, которые закроют сущность
+    return text.replace("*", "∗").replace("`", "'")
+
+ESCAPERS = {"Markdown": escape_markdown, "HTML": html.escape, None: str}
+# {value!e} — значение внутри сущности (*{subject!e}*)
+ENTITY_ESCAPERS = {"Markdown": escape_markdown_entity, "HTML": html.escape, None: str}
+
+class Template:
+    """Шаблон в синтаксисе str.format, разобранный один раз при создании.
+    Значения после форматирования ({date:%d.%m}) экранируются, кроме Markup."""
+
+    def __init__(self, fmt: str, parse_mode="Markdown"):
+        self.parse_mode = parse_mode
+        self._escape = ESCAPERS[parse_mode]
+        self._escape_entity = ENTITY_ESCAPERS[parse_mode]
+        self._parts = [
+            (literal, field, spec or "", conversion)
+            for literal, field, spec, conversion in string.Formatter().parse(fmt)
+        ]
+
+    def __call__(self, **values) -> Markup:
+        out = []
+        for literal, field, spec, conversion in self._parts:
+            out.append(literal)
+            if field is None:
+                continue
+            value = values[field]
+            if isinstance(value, Markup):
+                out.append(value)
+                continue
+            if conversion == "r":
+                value = repr(value)
+            text = format(value, spec)
+            out.append(self._escape_entity(text) if conversion == "e" else self._escape(text))
+        return Markup("".join(out))
+
+def code_block(text: str, language: str = "") -> Markup:
+    # Внутри ``` экранирование не работает, мешает только сама обратная кавычка
+    return Markup(f"```{language}\n{text.replace('`', chr(39))}\n```")
+
+# Фрагменты (строка урока, задания, пользователя) по аргументам отрисовки
+fragment_cache = TTLCache(FRAGMENT_CACHE_SIZE, FRAGMENT_CACHE_TTL)
+
+def fragment(func):
+    """Кэширует результат отрисовки по аргументам: они должны быть хешируемыми
+    и полностью определять текст."""
+    name = func.__name__
+
+    def wrapper(*args):
+        key = (name, args)
+        text = fragment_cache.get(key)
+        if text is None:
+            text = func(*args)
+            fragment_cache.set(key, text)
+        return text
+    return wrapper
+
+def _cut_line(line: str, room: int) -> str:
+    cut = line[:room - 1]
+    # Не оставляем экранирующий \ без символа
+    if (len(cut) - len(cut.rstrip("\\"))) % 2:
+        cut = cut[:-1]
+    return cut + "…"
+
+def paginate(blocks, limit: int = MESSAGE_LIMIT, max_blocks: int = None):
+    """Раскладывает блоки по страницам не длиннее limit. Блок (урок, задание,
+    строка списка) переносится целиком; слишком длинный — по строкам, а
+    строка длиннее limit обрезается. Возвращает список списков блоков."""
+    pages = []
+    current = []
+    size = 0
+    for block in blocks:
+        if len(block) > limit:
+            lines = block.split("\n")
+            parts = [line + "\n" for line in lines[:-1]] + ([lines[-1]] if lines[-1] else [])
+            parts = [part if len(part) <= limit else _cut_line(part, limit - 1) + "\n" for part in parts]
+        else:
+            parts = [block]
+        for part in parts:
+            if current and (size + len(part) > limit or (max_blocks and len(current) >= max_blocks)):
+                pages.append(current)
+                current, size = [], 0
+            current.append(part)
+            size += len(part)
+    if current:
+        pages.append(current)
+    return pages
+
+def split_message(blocks, header: str = "", limit: int = MESSAGE_LIMIT):
+    """Готовые тексты сообщений: header в начале каждого. Блоки кода
+    ``` закрываются в конце сообщения и открываются в следующем."""
+    chunks = []
+    reopen = ""
+    if not blocks:
+        return [header] if header else []
+    for page in paginate(blocks, limit - len(header) - 8):
+        text = header + reopen + "".join(page)
+        reopen = ""
+        if text.count("```") % 2:
+            text = text.rstrip("\n") + "\n```"
+            reopen = "```\n"
+        chunks.append(text)
+    return chunks
+
+class MessageBuilder:
+    """Ответ из блоков: собирается списком, склеивается один раз."""
+
+    def __init__(self, header: str = ""):
+        self.header = header
+        self.blocks = []
+
+    def add(self, block: str):
+        self.blocks.append(block)
+        return self
+
+    def extend(self, blocks):
+        self.blocks.extend(blocks)
+        return self
+
+    def __bool__(self):
+        return bool(self.blocks)
+
+    def chunks(self, limit: int = MESSAGE_LIMIT):
+        return split_message(self.blocks, self.header, limit)
+
+    def first(self, more: str = "", limit: int = MESSAGE_LIMIT) -> str:
+        """Только первое сообщение; more дописывается, если текст не поместился."""
+        chunks = self.chunks(limit - len(more))
+        return chunks[0] + (more if len(chunks) > 1 else "")
+
+async def answer_chunks(message: types.Message, chunks, parse_mode="Markdown", reply_markup=None):
+    """Отправляет сообщения по порядку, клавиатура — у последнего."""
+    for i, chunk in enumerate(chunks):
+        last = i == len(chunks) - 1
+        await message.answer(chunk, parse_mode=parse_mode, reply_markup=reply_markup if last else None)
+
+_MISSING = object()
+
+# telegram_id -> (full_name, is_admin, group_id, is_active) или None для незарегистрированных
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+# (group_id, "users" / "birthdays") -> число строк, для "стр. N из M"
+user_count_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+# (group_id, date) -> MessageBuilder готового ответа /schedule
+schedule_cache = TTLCache(SCHEDULE_CACHE_SIZE, SCHEDULE_CACHE_TTL)
+
+HOMEWORK_TITLE = Template("📚 **Домашние задания**{page}\n\n")
+HOMEWORK_ENTRY = Template("📌 *{subject!e}* (до {due:%Y-%m-%d})\n{description}\n\n")
+
+@fragment
+def render_homework_entry(due, hw_id, subject, description) -> str:
+    return HOMEWORK_ENTRY(subject=subject, due=due, description=description)
+
+class HomeworkView:
+    """Актуальные ДЗ группы в памяти, отсортированные по due_date.
+
+    Загружается из базы один раз, дальше обновляется через add()/clear().
+    Просроченные задания отбрасываются при первом обращении в новый день.
+    Готовые страницы кэшируются до следующего изменения."""
+
+    def __init__(self, group_id: int):
+        self.group_id = group_id
+        self._items = []  # (due_date, id, subject, description)
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
+        # Изменения, пришедшие во время загрузки: снимок запроса мог их не увидеть
+        self._pending = None
+        self._cleared = False
+        self._today = None
+        self._pages = None
+        self.hits = 0
+        self.misses = 0
+
+    async def load(self):
+        today = datetime.date.today()
+        self._pending, self._cleared = [], False
+        try:
+            rows = await execute_query(
+                "SELECT due_date, id, subject, description FROM homework "
+                "WHERE group_id = %s AND due_date >= %s ORDER BY due_date, id",
+                (self.group_id, today), fetch=True
+            )
+            items = [] if self._cleared else [tuple(row) for row in rows]
+            known = {item[1] for item in items}
+            items.extend(item for item in self._pending if item[1] not in known and item[0] >= today)
+            items.sort()
+        finally:
+            self._pending = None
+        self._items = items
+        self._today = today
+        self._pages = None
+        self._loaded = True
+
+    async def _ensure_loaded(self):
+        async with self._load_lock:
+            if not self._loaded:
+                await self.load()
+
+    def add(self, hw_id: int, subject: str, description: str, due_date: datetime.date):
+        item = (due_date, hw_id, subject, description)
+        if self._pending is not None:
+            self._pending.append(item)
+        elif self._loaded and due_date >= self._today:
+            bisect.insort(self._items, item)
+            self._pages = None
+
+    def clear(self):
+        self._items = []
+        self._pages = None
+        if self._pending is not None:
+            self._pending.clear()
+            self._cleared = True
+
+    def _expire(self):
+        today = datetime.date.today()
+        if today != self._today:
+            del self._items[:bisect.bisect_left(self._items, (today,))]
+            self._today = today
+            self._pages = None
+
+    async def pages(self):
+        await self._ensure_loaded()
+        self._expire()
+        if self._pages is not None:
+            self.hits += 1
+            return self._pages
+        self.misses += 1
+        self._pages = self._render()
+        return self._pages
+
+    async def due_on(self, day: datetime.date):
+        """Отрендеренные задания со сроком day."""
+        await self._ensure_loaded()
+        self._expire()
+        lo = bisect.bisect_left(self._items, (day,))
+        hi = bisect.bisect_left(self._items, (day + datetime.timedelta(days=1),))
+        return [self._entry(item) for item in self._items[lo:hi]]
+
+    @staticmethod
+    def _entry(item) -> str:
+        return render_homework_entry(*item)
+
+    def _render(self):
+        pages = paginate((self._entry(item) for item in self._items), MESSAGE_LIMIT - 100, HOMEWORK_PAGE_SIZE)
+        total = len(pages)
+        return [
+            HOMEWORK_TITLE(page=Markup(f" ({i}/{total})" if total > 1 else "")) + "".join(entries)
+            for i, entries in enumerate(pages, 1)
+        ]
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total * 100 if total else 0.0
+
+    def memory_usage(self) -> int:
+        return _sizeof(self._items) + _sizeof(self._pages or [])
+
+class GroupHomework:
+    """HomeworkView каждой группы. Представление создаётся при первом
+    обращении и держит только задания своей группы, поэтому чтение
+    не зависит от числа групп."""
+
+    def __init__(self):
+        self._views = {}
+
+    def __getitem__(self, group_id: int) -> HomeworkView:
+        view = self._views.get(group_id)
+        if view is None:
+            view = self._views[group_id] = HomeworkView(group_id)
+        return view
+
+    def drop(self, *group_ids):
+        """Забыть представления: перечитаются из базы при следующем обращении."""
+        if not group_ids:
+            self._views.clear()
+        for group_id in group_ids:
+            self._views.pop(group_id, None)
+
+    def __len__(self):
+        return sum(len(view) for view in self._views.values())
+
+    @property
+    def hits(self) -> int:
+        return sum(view.hits for view in self._views.values())
+
+    @property
+    def misses(self) -> int:
+        return sum(view.misses for view in self._views.values())
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total * 100 if total else 0.0
+
+    def memory_usage(self) -> int:
+        return sum(view.memory_usage() for view in self._views.values())
+
+homework_views = GroupHomework()
+
+# user_id -> {(start, end): (present, absent, late, total)}
+attendance_cache = TTLCache(ATTENDANCE_CACHE_SIZE, ATTENDANCE_CACHE_TTL)
+
+# Отображаются в /cache_stats
+caches = {
+    "Пользователи": user_cache,
+    "Расписание": schedule_cache,
+    "ДЗ": homework_views,
+    "Посещаемость": attendance_cache,
+    "Число пользователей": user_count_cache,
+    "Фрагменты ответов": fragment_cache,
+}
+
+# Сброс кэшей во всех процессах: локально и через NOTIFY остальным
+# воркерам и экземплярам бота (см. cache_listener)
+CACHE_CHANNEL = "school_bot_cache"
+INSTANCE_ID = uuid.uuid4().hex
+
+def apply_invalidation(cache: str, keys, remote: bool = False):
+    """keys пустой — сбросить кэш целиком."""
+    if cache == "users":
+        target = user_cache
+        # Любое изменение пользователей может поменять размер списков
+        user_count_cache.clear()
+    elif cache == "attendance":
+        target = attendance_cache
+    elif cache == "schedule":
+        # Ключ — (group_id, date) или group_id: всё расписание группы
+        if not keys:
+            schedule_cache.clear()
+        for key in keys:
+            if isinstance(key, int):
+                schedule_cache.invalidate_where(lambda cached: cached[0] == key)
+            else:
+                group_id, day = key
+                schedule_cache.invalidate((group_id, datetime.date.fromisoformat(day) if isinstance(day, str) else day))
+        return
+    elif cache == "homework":
+        # Ключи — группы. Локально представление обновляется инкрементально,
+        # остальные перечитают его при следующем обращении
+        if remote:
+            homework_views.drop(*keys)
+        return
+    else:
+        return
+    if keys:
+        for key in keys:
+            target.invalidate(key)
+    else:
+        target.clear()
+
+async def invalidate(cache: str, *keys):
+    apply_invalidation(cache, keys)
+    payload = json.dumps({"from": INSTANCE_ID, "cache": cache, "keys": list(keys)}, default=_json_default)
+    if len(payload) > 7000:
+        # Лимит NOTIFY — 8000 байт: проще сбросить кэш целиком
+        payload = json.dumps({"from": INSTANCE_ID, "cache": cache, "keys": []})
+    try:
+        await execute_query("SELECT pg_notify(%s, %s)", (CACHE_CHANNEL, payload), fetch=True)
+    except Exception as e:
+        logger.warning(f"Не удалось разослать сброс кэша {cache}: {e}")
+
+# Посещаемость
+# Все записи в attendance идут через upsert_attendance: одна вставка
+# любого числа строк через unnest и сброс сводок затронутых пользователей.
+async def upsert_attendance(rows):
+    """rows: [(user_id, date, status, reason, marked_by), ...]"""
+    if not rows:
+        return 0
+    user_ids, dates, statuses, reasons, marked_by = (list(column) for column in zip(*rows))
+    # Отметка относится к группе, в которой студент был в этот момент
+    result = await execute_query(
+        "INSERT INTO attendance (user_id, date, status, reason, marked_by, group_id) "
+        "SELECT r.*, u.group_id FROM unnest(%s::bigint[], %s::date[], %s::text[], %s::text[], %s::bigint[]) "
+        "AS r(user_id, date, status, reason, marked_by) LEFT JOIN users u ON u.telegram_id = r.user_id "
+        "ON CONFLICT (user_id, date) DO UPDATE SET status = EXCLUDED.status, group_id = EXCLUDED.group_id, "
+        # причина, которую студент указал через /reason, сохраняется при повторной отметке «отсутствовал»
+        "reason = CASE WHEN EXCLUDED.status = 'absent' THEN COALESCE(EXCLUDED.reason, attendance.reason) END, "
+        "marked_by = EXCLUDED.marked_by, marked_at = CURRENT_TIMESTAMP",
+        (user_ids, dates, statuses, reasons, marked_by)
+    )
+    await invalidate("attendance", *set(user_ids))
     return result
 
+async def attendance_summary(user_id: int, start: datetime.date, end: datetime.date):
+    """(present, absent, late, total) за период одним агрегирующим запросом."""
+    summaries = attendance_cache.get(user_id)
+    window = (start, end)
+    if summaries is not None and window in summaries:
+        return summaries[window]
+    
+    generation = attendance_cache.generation(user_id)
+    row = await execute_query(
+        "SELECT COUNT(*) FILTER (WHERE status = 'present'), "
+        "COUNT(*) FILTER (WHERE status = 'absent'), "
+        "COUNT(*) FILTER (WHERE status = 'late'), "
+        "COUNT(*) "
+        "FROM attendance WHERE user_id = %s AND date BETWEEN %s AND %s",
+        (user_id, start, end), fetch=True
+    )
+    summary = tuple(row[0])
+    # Отметки изменились, пока шёл запрос: сводка уже устарела
+    if attendance_cache.generation(user_id) != generation:
+        return summary
+    # Словарь, полученный до запроса, мог быть вытеснен — берём текущий
+    summaries = attendance_cache.peek(user_id)
+    if summaries is None:
+        summaries = {}
+        attendance_cache.set(user_id, summaries)
+    summaries[window] = summary
+    return summary
+
+# Начало текущего семестра: 1 сентября или 1 февраля
+def semester_start(today: datetime.date) -> datetime.date:
+    if today.month >= 9:
+        return today.replace(month=9, day=1)
+    if today.month >= 2:
+        return today.replace(month=2, day=1)
+    return today.replace(year=today.year - 1, month=9, day=1)
+
 async def get_user(user_id: int):
-    return await asyncio.to_thread(get_user_sync, user_id)
+    cached = user_cache.get(user_id, _MISSING)
+    if cached is not _MISSING:
+        return cached
+    # Снимок до запроса: если права успели отозвать, старая строка не попадёт в кэш
+    generation = user_cache.generation(user_id)
+    async with db_pool.connection() as conn:
+        cursor = await conn.execute(
+            "SELECT full_name, is_admin, group_id, is_active FROM users WHERE telegram_id = %s", (user_id,)
+        )
+        result = await cursor.fetchone()
+    user_cache.set(user_id, result, generation)
+    return result
+
+NO_GROUP = "❌ Сначала выберите группу: /group"
+
+async def user_group(user_id: int):
+    """Группа пользователя или None, если он не зарегистрирован или не выбрал группу."""
+    user = await get_user(user_id)
+    return user[2] if user else None
+
+async def group_ids():
+    rows = await execute_query("SELECT id FROM groups ORDER BY id", fetch=True)
+    return [group_id for (group_id,) in rows]
 
 # Клавиатура причин
 reason_keyboard = ReplyKeyboardMarkup(
@@ -199,6 +1519,147 @@ confirm_keyboard = ReplyKeyboardMarkup(
     one_time_keyboard=True
 )
 
+# РАССЫЛКИ
+
+class TokenBucket:
+    """Глобальный лимит скорости: не больше rate операций в секунду
+    с запасом capacity. pause() останавливает всех ожидающих, например
+    после 429 Too Many Requests."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+broadcast_bucket = TokenBucket(BROADCAST_RATE, BROADCAST_RATE)
+
+# Фоновые рассылки: храним ссылки, чтобы задачи не собрал GC
+background_tasks = set()
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+class BroadcastStats:
+    def __init__(self, total: int):
+        self.total = total
+        self.sent = 0
+        self.failed = 0
+        self.blocked = []  # telegram_id, недоступные навсегда
+        self.started = time.monotonic()
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.failed + len(self.blocked)
+
+    def progress_text(self, title: str) -> str:
+        elapsed = time.monotonic() - self.started
+        return (
+            f"{title}: {self.done}/{self.total}\n"
+            f"✅ Отправлено: {self.sent}\n"
+            f"🚫 Заблокировали бота: {len(self.blocked)}\n"
+            f"❌ Ошибок: {self.failed}\n"
+            f"⏱ {elapsed:.0f} сек"
+        )
+
+async def _deliver(chat_id: int, text: str, parse_mode, stats: BroadcastStats):
+    for attempt in range(BROADCAST_MAX_RETRIES + 1):
+        await broadcast_bucket.acquire()
+        try:
+            await bot.send_message(chat_id, text, parse_mode=parse_mode)
+            stats.sent += 1
+            return
+        except TelegramRetryAfter as e:
+            # Лимит общий для бота — притормаживаем всех отправителей
+            logger.warning(f"Рассылка: 429, пауза {e.retry_after} сек")
+            broadcast_bucket.pause(e.retry_after)
+        except (TelegramForbiddenError, TelegramNotFound):
+            stats.blocked.append(chat_id)
+            return
+        except TelegramBadRequest as e:
+            if "chat not found" in str(e).lower() or "user is deactivated" in str(e).lower():
+                stats.blocked.append(chat_id)
+            else:
+                logger.warning(f"Не удалось отправить {chat_id}: {e}")
+                stats.failed += 1
+            return
+        except (TelegramNetworkError, TelegramServerError) as e:
+            logger.warning(f"Временная ошибка при отправке {chat_id} (попытка {attempt + 1}): {e}")
+            await asyncio.sleep(2 ** attempt)
+        except Exception as e:
+            logger.warning(f"Не удалось отправить {chat_id}: {e}")
+            stats.failed += 1
+            return
+    stats.failed += 1
+
+async def broadcast(messages, parse_mode=None, on_progress=None) -> BroadcastStats:
+    """Отправляет список (chat_id, text) с ограниченной параллельностью и
+    общим лимитом скорости. on_progress(stats) вызывается периодически
+    во время рассылки и один раз в конце. Заблокировавшие бота
+    пользователи помечаются is_active = FALSE."""
+    stats = BroadcastStats(len(messages))
+    pending = iter(messages)
+
+    async def worker():
+        for chat_id, text in pending:
+            await _deliver(chat_id, text, parse_mode, stats)
+
+    async def reporter():
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            await on_progress(stats)
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(BROADCAST_CONCURRENCY, len(messages)))]
+    progress_task = asyncio.create_task(reporter()) if on_progress else None
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        if progress_task:
+            progress_task.cancel()
+
+    if stats.blocked:
+        await execute_query(
+            "UPDATE users SET is_active = FALSE WHERE telegram_id = ANY(%s)",
+            (stats.blocked,)
+        )
+        await invalidate("users", *stats.blocked)
+    if on_progress:
+        await on_progress(stats)
+    return stats
+
+def status_updater(status_message: types.Message, title: str):
+    """Колбэк прогресса, который правит одно сообщение со статусом."""
+    async def update(stats: BroadcastStats):
+        try:
+            await status_message.edit_text(stats.progress_text(title))
+        except TelegramBadRequest:
+            pass  # message is not modified
+        except Exception as e:
+            logger.warning(f"Не удалось обновить статус рассылки: {e}")
+    return update
+
 # ХЕНДЛЕРЫ ДЛЯ СТУДЕНТОВ
 
 @dp.message(Command("start"))
@@ -206,22 +1667,38 @@ async def cmd_start(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     result = await get_user(user_id)
     
+    # Вернувшийся пользователь снова получает рассылки. Флаг берётся из кэша,
+    # поэтому у активных /start обходится без запроса к базе
+    if result and not result[3]:
+        await execute_query(
+            "UPDATE users SET is_active = TRUE WHERE telegram_id = %s AND NOT is_active",
+            (user_id,)
+        )
+        await invalidate("users", user_id)
+    
     if result and result[0]:
         await message.answer(
             f"Привет, {result[0]}! 👋\n\n"
             "/schedule — Расписание\n"
             "/homework — ДЗ\n"
             "/attendance — Посещаемость\n"
+            "/digest — Утренняя рассылка расписания и ДЗ\n"
+            "/group — Сменить группу\n"
             "/support — Помощь"
         )
+        if result[2] is None:
+            await ask_group(message)
     else:
         await execute_query(
             "INSERT INTO users (telegram_id, full_name) VALUES (%s, %s) ON CONFLICT (telegram_id) DO NOTHING",
             (user_id, None)
         )
+        await invalidate("users", user_id)
         await message.answer("👋 Привет! Напиши **ФИО полностью**")
         await state.set_state(Form.waiting_for_fio)
 
+FIO_SAVED = Template("✅ ФИО сохранено: **{fio}**")
+
 @dp.message(Form.waiting_for_fio)
 async def process_fio(message: types.Message, state: FSMContext):
     fio = message.text.strip()
@@ -233,9 +1710,64 @@ async def process_fio(message: types.Message, state: FSMContext):
         "UPDATE users SET full_name = %s WHERE telegram_id = %s",
         (fio, message.from_user.id)
     )
+    await invalidate("users", message.from_user.id)
     
-    await message.answer(f"✅ ФИО сохранено: **{fio}**", parse_mode="Markdown")
+    await message.answer(FIO_SAVED(fio=fio), parse_mode="Markdown")
     await state.clear()
+    if await user_group(message.from_user.id) is None:
+        await ask_group(message)
+
+# Группы. Студент выбирает свою группу сам; админ группы управляет только ею,
+# поэтому при переходе в другую группу права админа снимаются
+async def set_user_group(user_id: int, group_id: int):
+    row = await execute_query(
+        # Права админа привязаны к группе: при переходе в другую они снимаются
+        "UPDATE users SET group_id = g.id, is_admin = users.is_admin AND (%s OR users.group_id = g.id) "
+        "FROM groups g WHERE g.id = %s AND users.telegram_id = %s RETURNING g.name",
+        (is_super_admin(user_id), group_id, user_id), fetch=True
+    )
+    await invalidate("users", user_id)
+    return row[0] if row else None
+
+def group_picker(groups, current=None):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"{'✅ ' if group_id == current else ''}{name}", callback_data=f"grp:{group_id}")]
+        for group_id, name in groups
+    ])
+
+async def ask_group(message: types.Message, current=None):
+    groups = await execute_query("SELECT id, name FROM groups ORDER BY name", fetch=True)
+    if len(groups) == 1 and current is None:
+        # Единственная группа — выбирать нечего
+        await set_user_group(message.from_user.id, groups[0][0])
+        return
+    await message.answer("👥 Выбери свою группу:", reply_markup=group_picker(groups, current))
+
+@dp.message(Command("group"))
+async def cmd_group(message: types.Message):
+    user = await get_user(message.from_user.id)
+    if not user:
+        await message.answer("❌ Вы не зарегистрированы. Напишите /start")
+        return
+    await ask_group(message, user[2])
+
+@dp.callback_query(F.data.startswith("grp:"))
+async def group_pick(callback: types.CallbackQuery):
+    group_id = int(callback.data.split(":", 1)[1])
+    user = await get_user(callback.from_user.id)
+    if user and user[2] == group_id:
+        await callback.message.edit_text("👥 Группа не изменилась")
+        await callback.answer()
+        return
+    
+    name = await set_user_group(callback.from_user.id, group_id)
+    if name is None:
+        await callback.message.edit_text("❌ Группа не найдена, выберите заново: /group")
+    else:
+        note = "\nПрава админа прежней группы сняты" if user and user[1] and not is_super_admin(callback.from_user.id) else ""
+        await callback.message.edit_text(f"✅ Ваша группа: {name}{note}")
+        logger.info(f"👥 {callback.from_user.id} перешёл в группу {group_id}")
+    await callback.answer()
 
 @dp.message(Command("support"))
 async def cmd_support(message: types.Message):
@@ -246,103 +1778,177 @@ async def cmd_support(message: types.Message):
         parse_mode="Markdown"
     )
 
-@dp.message(Command("schedule"))
-async def cmd_schedule(message: types.Message):
-    raw = message.text.replace("/schedule", "", 1).strip()
+WEEKDAYS = {
+    1: "Понедельник", 2: "Вторник", 3: "Среда", 4: "Четверг",
+    5: "Пятница", 6: "Суббота", 7: "Воскресенье"
+}
+
+SCHEDULE_TITLE = Template("📅 **{day} ({date:%d.%m.%Y})**\n\n")
+SCHEDULE_EMPTY = Template("📅 На {day} ({date:%d.%m.%Y}) — расписание не задано")
+LESSON_TITLE = Template("{num}. **{subject}**")
+LESSON_TYPE = Template(" ({lesson_type})")
+LESSON_TIME = Template("🕗 {start:%H:%M}-{end:%H:%M}")
+LESSON_ROOM = Template("📍 {room}")
+LESSON_TEACHER = Template("👩‍🏫 {teacher}")
+
+@fragment
+def render_lesson(num, subject, room, start, end, ltype, teacher) -> str:
+    text = LESSON_TITLE(num=num, subject=subject)
+    if ltype:
+        text += LESSON_TYPE(lesson_type=ltype)
     
-    try:
-        if raw:
-            target_date = datetime.datetime.strptime(raw, "%d.%m.%Y").date()
-        else:
-            target_date = datetime.date.today()
-    except ValueError:
-        await message.answer("❌ Формат: /schedule 01.12.2025")
-        return
+    details = []
+    if start and end:
+        details.append(LESSON_TIME(start=start, end=end))
+    if room:
+        details.append(LESSON_ROOM(room=room))
+    if teacher:
+        details.append(LESSON_TEACHER(teacher=teacher))
+    
+    if details:
+        text += "\n   • " + "\n   • ".join(details)
+    return text + "\n\n"
 
-    DAYS = {
-        1: "Понедельник", 2: "Вторник", 3: "Среда", 4: "Четверг",
-        5: "Пятница", 6: "Суббота", 7: "Воскресенье"
-    }
-    day_name = DAYS.get(target_date.isoweekday(), "Неизвестный день")
+async def render_schedule(group_id: int, target_date: datetime.date) -> MessageBuilder:
+    day_name = WEEKDAYS.get(target_date.isoweekday(), "Неизвестный день")
     
     lessons = await execute_query(
         "SELECT lesson_number, subject, classroom, start_time, end_time, lesson_type, teacher "
-        "FROM schedule WHERE date = %s ORDER BY lesson_number",
-        (target_date.strftime("%Y-%m-%d"),), fetch=True
+        "FROM schedule WHERE group_id = %s AND date = %s ORDER BY lesson_number",
+        (group_id, target_date), fetch=True
     )
     
     if not lessons:
-        await message.answer(f"📅 На {day_name.lower()} ({target_date:%d.%m.%Y}) — расписание не задано")
+        return MessageBuilder(SCHEDULE_EMPTY(day=day_name.lower(), date=target_date))
+    return MessageBuilder(SCHEDULE_TITLE(day=day_name, date=target_date)).extend(
+        render_lesson(*row) for row in lessons
+    )
+
+# Готовый ответ из кэша или из базы
+async def get_schedule(group_id: int, target_date: datetime.date) -> MessageBuilder:
+    cached = schedule_cache.get((group_id, target_date))
+    if cached is not None:
+        return cached
+    generation = schedule_cache.generation((group_id, target_date))
+    result = await render_schedule(group_id, target_date)
+    schedule_cache.set((group_id, target_date), result, generation)
+    return result
+
+async def warm_schedule_cache():
+    today = datetime.date.today()
+    groups = await group_ids()
+    for group_id in groups:
+        for target_date in (today, today + datetime.timedelta(days=1)):
+            generation = schedule_cache.generation((group_id, target_date))
+            schedule_cache.set((group_id, target_date), await render_schedule(group_id, target_date), generation)
+    logger.info(f"✅ Кэш расписания прогрет на сегодня и завтра ({len(groups)} групп)")
+
+@dp.message(Command("schedule"))
+async def cmd_schedule(message: types.Message):
+    group_id = await user_group(message.from_user.id)
+    if group_id is None:
+        await message.answer(NO_GROUP)
         return
     
-    text = f"📅 **{day_name} ({target_date:%d.%m.%Y})**\n\n"
-    for row in lessons:
-        num, subject, room, start, end, ltype, teacher = row
-        
-        lesson_str = f"{num}. **{subject}**"
-        if ltype:
-            lesson_str += f" ({ltype})"
-        
-        details = []
-        if start and end:
-            details.append(f"🕗 {start}-{end}")
-        if room:
-            details.append(f"📍 {room}")
-        if teacher:
-            details.append(f"👩‍🏫 {teacher}")
-        
-        if details:
-            lesson_str += "\n   • " + "\n   • ".join(details)
-        
-        text += lesson_str + "\n\n"
-    
-    if len(text) > 4000:
-        text = text[:3997] + "..."
+    raw = message.text.replace("/schedule", "", 1).strip()
+    
+    try:
+        if raw:
+            target_date = datetime.datetime.strptime(raw, "%d.%m.%Y").date()
+        else:
+            target_date = datetime.date.today()
+    except ValueError:
+        await message.answer("❌ Формат: /schedule 01.12.2025")
+        return
     
-    await message.answer(text, parse_mode="Markdown")
+    schedule = await get_schedule(group_id, target_date)
+    await answer_chunks(message, schedule.chunks())
+
+def homework_keyboard(page: int, total: int):
+    if total <= 1:
+        return None
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton(text="◀️", callback_data=f"hw:{page - 1}"))
+    if page < total - 1:
+        buttons.append(InlineKeyboardButton(text="▶️", callback_data=f"hw:{page + 1}"))
+    return InlineKeyboardMarkup(inline_keyboard=[buttons])
 
 @dp.message(Command("homework"))
 async def cmd_homework(message: types.Message):
-    today = datetime.date.today().strftime("%Y-%m-%d")
-    hw_list = await execute_query(
-        "SELECT subject, description, due_date FROM homework WHERE due_date >= %s ORDER BY due_date",
-        (today,), fetch=True
-    )
+    group_id = await user_group(message.from_user.id)
+    if group_id is None:
+        await message.answer(NO_GROUP)
+        return
+    
+    pages = await homework_views[group_id].pages()
     
-    if not hw_list:
+    if not pages:
         await message.answer("📚 Нет ДЗ")
         return
     
-    text = "📚 **Домашние задания**\n\n"
-    for subject, desc, due in hw_list:
-        text += f"📌 *{subject}* (до {due})\n{desc}\n\n"
+    await message.answer(pages[0], parse_mode="Markdown", reply_markup=homework_keyboard(0, len(pages)))
+
+@dp.callback_query(F.data.startswith("hw:"))
+async def homework_page(callback: types.CallbackQuery):
+    group_id = await user_group(callback.from_user.id)
+    if group_id is None:
+        await callback.answer(NO_GROUP, show_alert=True)
+        return
+    
+    pages = await homework_views[group_id].pages()
+    if not pages:
+        await callback.message.edit_text("📚 Нет ДЗ")
+        await callback.answer()
+        return
     
-    await message.answer(text, parse_mode="Markdown")
+    page = min(int(callback.data.split(":", 1)[1]), len(pages) - 1)
+    try:
+        await callback.message.edit_text(
+            pages[page], parse_mode="Markdown", reply_markup=homework_keyboard(page, len(pages))
+        )
+    except TelegramBadRequest:
+        pass  # message is not modified
+    await callback.answer()
+
+ATTENDANCE_SUMMARY = Template(
+    "**Посещаемость ({title})**\n\n"
+    "Присутствовал: {present}/{total}\n"
+    "Отсутствовал: {absent}\n"
+    "Опоздал: {late}\n"
+    "**{percentage}%**\n\n"
+    "Напиши дату: 17.11.2025"
+)
 
 @dp.message(Command("attendance"))
 async def cmd_attendance(message: types.Message):
+    raw = message.text.replace("/attendance", "", 1).strip().lower()
     today = datetime.date.today()
-    month_ago = today - datetime.timedelta(days=30)
     
-    total_rows = await execute_query(
-        "SELECT COUNT(*) FROM attendance WHERE user_id = %s AND date BETWEEN %s AND %s",
-        (message.from_user.id, month_ago.strftime("%Y-%m-%d"), today.strftime("%Y-%m-%d")), fetch=True
-    )
-    total = total_rows[0][0] if total_rows else 0
-
-    present_rows = await execute_query(
-        "SELECT COUNT(*) FROM attendance WHERE user_id = %s AND date BETWEEN %s AND %s AND status = 'present'",
-        (message.from_user.id, month_ago.strftime("%Y-%m-%d"), today.strftime("%Y-%m-%d")), fetch=True
-    )
-    present = present_rows[0][0] if present_rows else 0
+    if not raw:
+        days = ATTENDANCE_WINDOW_DAYS
+    elif raw in ("семестр", "semester"):
+        days = None
+    elif raw.isdigit() and 0 < int(raw) <= 366:
+        days = int(raw)
+    else:
+        await message.answer("❌ Формат: /attendance, /attendance 7, /attendance 90 или /attendance семестр")
+        return
     
+    if days is None:
+        start = semester_start(today)
+        title = "семестр"
+    else:
+        start = today - datetime.timedelta(days=days)
+        title = f"{days} дней"
+    
+    present, absent, late, total = await attendance_summary(message.from_user.id, start, today)
     percentage = round((present / total * 100) if total > 0 else 0, 1)
     
     await message.answer(
-        f"**Посещаемость (30 дней)**\n\n"
-        f"Присутствовал: {present}/{total}\n"
-        f"**{percentage}%**\n\n"
-        "Напиши дату: 17.11.2025",
+        ATTENDANCE_SUMMARY(
+            title=title, present=present, total=total, absent=absent, late=late, percentage=percentage
+        ),
         parse_mode="Markdown"
     )
 
@@ -352,7 +1958,7 @@ async def handle_date(message: types.Message):
         date = datetime.datetime.strptime(message.text, "%d.%m.%Y").date()
         result = await execute_query(
             "SELECT status, reason FROM attendance WHERE user_id = %s AND date = %s",
-            (message.from_user.id, date.strftime("%Y-%m-%d")), fetch=True
+            (message.from_user.id, date), fetch=True
         )
         
         if not result:
@@ -376,6 +1982,8 @@ async def cmd_reason(message: types.Message, state: FSMContext):
     await message.answer("Выбери причину:", reply_markup=reason_keyboard)
     await state.set_state(AttendanceForm.choosing_reason)
 
+REASON_SAVED = Template("✅ Причина: **{reason}**")
+
 @dp.message(AttendanceForm.choosing_reason)
 async def process_reason(message: types.Message, state: FSMContext):
     if message.text == "Отменить":
@@ -384,15 +1992,24 @@ async def process_reason(message: types.Message, state: FSMContext):
         return
     
     today = datetime.date.today()
-    await execute_query(
-        "INSERT INTO attendance (user_id, date, status, reason, marked_by) VALUES (%s, %s, %s, %s, %s) "
-        "ON CONFLICT (user_id, date) DO UPDATE SET status = EXCLUDED.status, reason = EXCLUDED.reason, marked_by = EXCLUDED.marked_by",
-        (message.from_user.id, today.strftime("%Y-%m-%d"), 'absent', message.text, message.from_user.id)
-    )
+    await upsert_attendance([
+        (message.from_user.id, today, 'absent', message.text, message.from_user.id)
+    ])
     
-    await message.answer(f"✅ Причина: **{message.text}**", reply_markup=types.ReplyKeyboardRemove(), parse_mode="Markdown")
+    await message.answer(
+        REASON_SAVED(reason=message.text),
+        reply_markup=types.ReplyKeyboardRemove(), parse_mode="Markdown"
+    )
     await state.clear()
 
+WHOAMI = Template(
+    "👤 **Ваша информация**\n\n"
+    "🔹 ID: `{user_id}`\n"
+    "🔹 ФИО: {full_name}\n"
+    "🔹 Группа: {group}\n"
+    "🔹 Статус: {status}"
+)
+
 @dp.message(Command("whoami"))
 async def cmd_whoami(message: types.Message):
     user_id = message.from_user.id
@@ -402,17 +2019,44 @@ async def cmd_whoami(message: types.Message):
         await message.answer("❌ Вы не зарегистрированы. Напишите /start")
         return
 
-    full_name, is_admin = user
-    admin_status = "✅ Админ" if is_admin else "❌ Не админ"
+    full_name, is_admin, group_id, _ = user
+    admin_status = "✅ Админ группы" if is_admin else "❌ Не админ"
+    group = await execute_query("SELECT name FROM groups WHERE id = %s", (group_id,), fetch=True)
     
     await message.answer(
-        f"👤 **Ваша информация**\n\n"
-        f"🔹 ID: `{user_id}`\n"
-        f"🔹 ФИО: {full_name or 'не указано'}\n"
-        f"🔹 Статус: {admin_status}",
+        WHOAMI(
+            user_id=user_id, full_name=full_name or "не указано",
+            group=group[0][0] if group else "не выбрана", status=admin_status
+        ),
         parse_mode="Markdown"
     )
 
+@dp.message(Command("digest"))
+async def cmd_digest(message: types.Message):
+    arg = message.text.replace("/digest", "", 1).strip().lower()
+    if arg not in ("", "on", "off", "вкл", "выкл"):
+        await message.answer("Использование: /digest, /digest on или /digest off")
+        return
+    
+    # Без аргумента — переключаем подписку
+    if arg:
+        enabled = await execute_query(
+            "UPDATE users SET digest_enabled = %s WHERE telegram_id = %s RETURNING digest_enabled",
+            (arg in ("on", "вкл"), message.from_user.id), fetch=True
+        )
+    else:
+        enabled = await execute_query(
+            "UPDATE users SET digest_enabled = NOT digest_enabled WHERE telegram_id = %s RETURNING digest_enabled",
+            (message.from_user.id,), fetch=True
+        )
+    
+    if enabled is None:
+        await message.answer("❌ Вы не зарегистрированы. Напишите /start")
+    elif enabled[0]:
+        await message.answer("🔔 Утренняя рассылка включена: расписание на день и ДЗ на завтра")
+    else:
+        await message.answer("🔕 Утренняя рассылка выключена")
+
 # ХЕНДЛЕРЫ ДЛЯ АДМИНОВ
 
 @dp.message(Command("make_admin"))
@@ -421,6 +2065,10 @@ async def make_admin_start(message: types.Message, state: FSMContext):
     if user and user[1]:
         await message.answer("✅ Вы уже админ!")
         return
+    if not user or user[2] is None:
+        # Админ управляет своей группой — без группы назначать нечего
+        await message.answer(NO_GROUP)
+        return
     
     await message.answer(
         "🔐 Введите секретный пароль для получения прав админа:\n\n"
@@ -433,15 +2081,18 @@ async def make_admin_start(message: types.Message, state: FSMContext):
 async def process_admin_password(message: types.Message, state: FSMContext):
     if message.text == ADMIN_PASSWORD:
         await execute_query(
-            "UPDATE users SET is_admin = TRUE WHERE telegram_id = %s",
+            "UPDATE users SET is_admin = TRUE WHERE telegram_id = %s AND group_id IS NOT NULL",
             (message.from_user.id,)
         )
+        await invalidate("users", message.from_user.id)
         await message.answer(
-            "✅ <b>Вы теперь админ!</b>\n\n"
+            "✅ <b>Вы теперь админ своей группы!</b>\n\n"
             "Доступные команды:\n"
             "/add_schedule — добавить расписание\n"
+            "/import_schedule — загрузить расписание из CSV/ICS\n"
             "/add_hw — добавить ДЗ\n"
             "/announce — отправить объявление\n"
+            "/rollcall — перекличка\n"
             "/users — список пользователей",
             parse_mode="HTML",
             reply_markup=types.ReplyKeyboardRemove()
@@ -458,11 +2109,14 @@ async def process_admin_password(message: types.Message, state: FSMContext):
     
     await state.clear()
 
+HOMEWORK_ADDED = Template("✅ ДЗ по **{subject}** добавлено до {due:%d.%m}")
+
 @dp.message(Command("add_hw"))
 async def cmd_add_hw(message: types.Message):
     if not await is_admin(message.from_user.id):
         await message.answer("🚫 Только админ")
         return
+    group_id = await user_group(message.from_user.id)
     
     raw = message.text.replace("/add_hw", "", 1).strip()
     if ":" not in raw:
@@ -496,98 +2150,584 @@ async def cmd_add_hw(message: types.Message):
     else:
         desc_part = rest
 
-    due_date_str = due_date.strftime("%Y-%m-%d")
-
-    await execute_query(
-        "INSERT INTO homework (subject, description, due_date, added_by) VALUES (%s, %s, %s, %s)",
-        (subject, desc_part.strip(), due_date_str, message.from_user.id)
+    hw_id, = await execute_query(
+        "INSERT INTO homework (group_id, subject, description, due_date, added_by) "
+        "VALUES (%s, %s, %s, %s, %s) RETURNING id",
+        (group_id, subject, desc_part.strip(), due_date, message.from_user.id), fetch=True
+    )
+    homework_views[group_id].add(hw_id, subject, desc_part.strip(), due_date)
+    await invalidate("homework", group_id)
+    
+    await message.answer(
+        HOMEWORK_ADDED(subject=subject, due=due_date),
+        parse_mode="Markdown"
     )
+
+# Разбор одного урока: «1. 11:50-13:20 Предмет (тип) (кабинет) Преподаватель»
+def parse_lesson(lesson: str):
+    # Разбираем номер урока
+    num_part, dot, rest = lesson.partition(".")
+    if not dot or not num_part.strip().isdigit():
+        raise ValueError("нет номера урока («1. ...»)")
+    lesson_num = int(num_part.strip())
+    
+    # Извлекаем время
+    time_match = re.search(r"(\d{2}:\d{2})-(\d{2}:\d{2})", rest)
+    start_time = time_match.group(1) if time_match else None
+    end_time = time_match.group(2) if time_match else None
+    
+    if time_match:
+        rest = rest.replace(f"{start_time}-{end_time}", "").strip()
+    
+    # Извлекаем тип занятия
+    lesson_type = ""
+    if "(" in rest and ")" in rest:
+        lesson_type = rest.split("(", 1)[1].split(")", 1)[0].strip()
+        rest = rest.replace(f"({lesson_type})", "").strip()
+    
+    # Извлекаем кабинет
+    classroom = ""
+    if "(" in rest and ")" in rest:
+        classroom = rest.split("(", 1)[1].split(")", 1)[0].strip()
+        rest = rest.replace(f"({classroom})", "").strip()
+    
+    # Оставшееся — предмет и преподаватель («Фамилия И.О.» — два слова)
+    parts = rest.split()
+    if len(parts) >= 3 and re.fullmatch(r"\w\.(\s*\w\.)?", parts[-1]):
+        subject = " ".join(parts[:-2])
+        teacher = " ".join(parts[-2:])
+    elif len(parts) >= 2:
+        subject = " ".join(parts[:-1])
+        teacher = parts[-1]
+    else:
+        subject = rest
+        teacher = ""
+    
+    if not subject:
+        raise ValueError("не указан предмет")
+    
+    return lesson_num, subject, classroom, start_time, end_time, lesson_type, teacher
+
+# Разбор «ДД.ММ.ГГГГ: уроки» для одной или нескольких дат.
+# Возвращает ({date: [урок, ...]}, [ошибка, ...]).
+def parse_schedule_days(raw: str):
+    days = {}
+    errors = []
+    chunks = re.split(r"(\d{1,2}\.\d{1,2}\.\d{4})\s*:", raw)
+    if chunks[0].strip(" \n;"):
+        errors.append(f"Непонятный текст до первой даты: «{chunks[0].strip()}»")
     
-    await message.answer(f"✅ ДЗ по **{subject}** добавлено до {due_date:%d.%m}", parse_mode="Markdown")
+    for date_part, lessons_part in zip(chunks[1::2], chunks[2::2]):
+        try:
+            target_date = datetime.datetime.strptime(date_part, "%d.%m.%Y").date()
+        except ValueError:
+            errors.append(f"{date_part}: неверная дата")
+            continue
+        if target_date in days:
+            errors.append(f"{target_date:%d.%m.%Y}: дата указана дважды")
+            continue
+        
+        lessons = [lesson.strip(" \n;") for lesson in lessons_part.split(",")]
+        lessons = [lesson for lesson in lessons if lesson]
+        if not lessons:
+            errors.append(f"{target_date:%d.%m.%Y}: не найдено уроков")
+            continue
+        
+        parsed = []
+        numbers = set()
+        for lesson in lessons:
+            try:
+                row = parse_lesson(lesson)
+            except Exception as e:
+                errors.append(f"{target_date:%d.%m.%Y}, «{lesson}»: {e}")
+                continue
+            if row[0] in numbers:
+                errors.append(f"{target_date:%d.%m.%Y}, «{lesson}»: урок №{row[0]} уже есть")
+                continue
+            numbers.add(row[0])
+            parsed.append(row)
+        days[target_date] = parsed
+    
+    return days, errors
+
+# Импорт расписания из файла. Оба формата читаются построчно и дают
+# уроки в том же виде, что parse_lesson; ошибки собираются по всему файлу.
+# CSV: первая строка — названия колонок таблицы schedule.
+# ICS: урок — событие VEVENT, номер урока — по порядку начала в течение дня
+SCHEDULE_COLUMNS = ["date", "lesson_number", "subject", "classroom", "start_time", "end_time", "lesson_type", "teacher"]
+SCHEDULE_IMPORT_REQUIRED = {"date", "lesson_number", "subject"}
+SCHEDULE_SNAPSHOT = (
+    f"SELECT {', '.join(SCHEDULE_COLUMNS)} FROM schedule "
+    "WHERE group_id = %s AND date = ANY(%s) ORDER BY date, lesson_number"
+)
+
+class ScheduleImportError(Exception):
+    pass
+
+def _import_date(value: str) -> datetime.date:
+    value = value.strip()
+    for fmt in ("%d.%m.%Y", "%Y-%m-%d"):
+        try:
+            return datetime.datetime.strptime(value, fmt).date()
+        except ValueError:
+            pass
+    raise ValueError(f"неверная дата «{value}» (нужно ДД.ММ.ГГГГ)")
+
+def _import_time(value):
+    value = (value or "").strip()
+    if not value:
+        return None
+    try:
+        return datetime.datetime.strptime(value, "%H:%M").time()
+    except ValueError:
+        raise ValueError(f"неверное время «{value}» (нужно ЧЧ:ММ)") from None
+
+def read_schedule_csv(f, errors):
+    """(номер строки, дата, урок) из CSV; разделитель «,» или «;» (Excel)."""
+    header_line = f.readline()
+    delimiter = ";" if header_line.count(";") > header_line.count(",") else ","
+    header = [column.strip().lower() for column in next(csv.reader([header_line], delimiter=delimiter), [])]
+    unknown = [column for column in header if column not in SCHEDULE_COLUMNS]
+    if unknown:
+        raise ScheduleImportError(
+            f"неизвестные колонки: {', '.join(unknown)}. Допустимы: {', '.join(SCHEDULE_COLUMNS)}"
+        )
+    missing = SCHEDULE_IMPORT_REQUIRED - set(header)
+    if missing:
+        raise ScheduleImportError(f"нет обязательных колонок: {', '.join(sorted(missing))}")
+    
+    reader = csv.reader(f, delimiter=delimiter)
+    for values in reader:
+        line_no = reader.line_num + 1
+        if not any(value.strip() for value in values):
+            continue
+        if len(values) != len(header):
+            errors.append(f"строка {line_no}: полей {len(values)}, а колонок {len(header)}")
+            continue
+        row = dict(zip(header, values))
+        try:
+            number = row["lesson_number"].strip()
+            if not number.isdigit() or int(number) == 0:
+                raise ValueError(f"номер урока «{number}» — не натуральное число")
+            lesson = (
+                int(number),
+                row["subject"].strip(),
+                row.get("classroom", "").strip(),
+                _import_time(row.get("start_time")),
+                _import_time(row.get("end_time")),
+                row.get("lesson_type", "").strip(),
+                row.get("teacher", "").strip(),
+            )
+            yield line_no, _import_date(row["date"]), lesson
+        except ValueError as e:
+            errors.append(f"строка {line_no}: {e}")
+
+def _ics_lines(f):
+    """Строки ICS с развёрнутыми переносами (продолжение начинается с пробела)."""
+    current, start = None, 0
+    for line_no, line in enumerate(f, 1):
+        line = line.rstrip("\r\n")
+        if line[:1] in (" ", "\t") and current is not None:
+            current += line[1:]
+            continue
+        if current:
+            yield start, current
+        current, start = line, line_no
+    if current:
+        yield start, current
+
+def _ics_property(line: str):
+    name, _, value = line.partition(":")
+    name, *params = name.split(";")
+    params = {key.upper(): param.strip('"') for key, _, param in (p.partition("=") for p in params)}
+    return name.upper(), params, value
+
+def _ics_text(value: str) -> str:
+    return re.sub(r"\\([nN,;\\])", lambda m: "\n" if m.group(1) in "nN" else m.group(1), value).strip()
+
+def _ics_datetime(value: str, params) -> datetime.datetime:
+    """Время события в часовом поясе бота, без tzinfo."""
+    if params.get("VALUE") == "DATE" or len(value) == 8:
+        raise ValueError("событие на весь день, у урока должно быть время")
+    try:
+        moment = datetime.datetime.strptime(value.rstrip("Z"), "%Y%m%dT%H%M%S")
+        if value.endswith("Z"):
+            moment = moment.replace(tzinfo=datetime.timezone.utc)
+        elif "TZID" in params:
+            moment = moment.replace(tzinfo=ZoneInfo(params["TZID"]))
+        else:
+            return moment  # «плавающее» время — уже местное
+    except (ValueError, KeyError):
+        raise ValueError(f"неверное время «{value}» {params.get('TZID', '')}".rstrip()) from None
+    return moment.astimezone(ZoneInfo(BOT_TIMEZONE)).replace(tzinfo=None)
+
+def _ics_occurrences(start: datetime.datetime, rrule: str, excluded):
+    """Начала повторов события. Расписание повторяется по неделям,
+    поэтому поддерживается только FREQ=WEEKLY с UNTIL или COUNT."""
+    if not rrule:
+        return [start]
+    rule = {key.upper(): value for key, _, value in (part.partition("=") for part in rrule.split(";"))}
+    weekday = ["MO", "TU", "WE", "TH", "FR", "SA", "SU"][start.weekday()]
+    if (rule.get("FREQ") != "WEEKLY" or set(rule) - {"FREQ", "INTERVAL", "UNTIL", "COUNT", "WKST", "BYDAY"}
+            or rule.get("BYDAY", weekday) != weekday):
+        raise ValueError(f"повторение «{rrule}» не поддерживается (только еженедельное в день начала)")
+    if "UNTIL" not in rule and "COUNT" not in rule:
+        raise ValueError("бесконечное повторение: нужен UNTIL или COUNT")
+    step = datetime.timedelta(weeks=int(rule.get("INTERVAL", 1)))
+    until = datetime.datetime.strptime(rule["UNTIL"][:8], "%Y%m%d").date() if "UNTIL" in rule else None
+    count = int(rule.get("COUNT", SCHEDULE_IMPORT_MAX_LESSONS + 1))
+    
+    occurrences = []
+    moment = start
+    # COUNT считает и повторы, исключённые EXDATE
+    for _ in range(min(count, SCHEDULE_IMPORT_MAX_LESSONS + 1)):
+        if until and moment.date() > until:
+            break
+        if moment.date() not in excluded:
+            occurrences.append(moment)
+        moment += step
+    return occurrences
+
+def _ics_event(event):
+    """Уроки одного VEVENT: [(дата, урок без номера), ...]."""
+    if "DTSTART" not in event:
+        raise ValueError("у события нет DTSTART")
+    start = _ics_datetime(event["DTSTART"][1], event["DTSTART"][0])
+    if "DTEND" in event:
+        duration = _ics_datetime(event["DTEND"][1], event["DTEND"][0]) - start
+    elif "DURATION" in event:
+        match = re.fullmatch(r"PT(?:(\d+)H)?(?:(\d+)M)?", event["DURATION"][1])
+        if not match:
+            raise ValueError(f"длительность «{event['DURATION'][1]}» не поддерживается")
+        duration = datetime.timedelta(hours=int(match.group(1) or 0), minutes=int(match.group(2) or 0))
+    else:
+        duration = None
+    
+    # «Предмет (тип)» — как в /add_schedule
+    subject = _ics_text(event.get("SUMMARY", ({}, ""))[1])
+    lesson_type = ""
+    match = re.fullmatch(r"(.+?)\s*\(([^()]+)\)", subject)
+    if match:
+        subject, lesson_type = match.group(1), match.group(2).strip()
+    classroom = _ics_text(event.get("LOCATION", ({}, ""))[1])
+    teacher = event.get("ORGANIZER", ({}, ""))[0].get("CN") or _ics_text(event.get("DESCRIPTION", ({}, ""))[1])
+    
+    excluded = {_ics_datetime(value, params).date() for params, value in event["EXDATE"]}
+    return [
+        (
+            moment.date(),
+            (None, subject, classroom, moment.time(), (moment + duration).time() if duration else None,
+             lesson_type, teacher.split("\n", 1)[0].strip())
+        )
+        for moment in _ics_occurrences(start, event.get("RRULE", ({}, ""))[1], excluded)
+    ]
+
+def read_schedule_ics(f, errors):
+    """(номер строки, дата, урок) из календаря ICS; номер урока пока не задан."""
+    event = None
+    for line_no, line in _ics_lines(f):
+        name, params, value = _ics_property(line)
+        if name == "BEGIN" and value.upper() == "VEVENT":
+            event = {"line": line_no, "EXDATE": []}
+        elif name == "END" and value.upper() == "VEVENT" and event is not None:
+            try:
+                lessons = _ics_event(event)
+            except ValueError as e:
+                errors.append(f"строка {event['line']}: {e}")
+                lessons = []
+            for target_date, lesson in lessons:
+                yield event["line"], target_date, lesson
+            event = None
+        elif event is not None:
+            if name == "EXDATE":
+                event["EXDATE"].extend((params, item) for item in value.split(","))
+            else:
+                event[name] = (params, value)
+
+def parse_schedule_file(path: str, kind: str):
+    """Файл целиком: ({date: [урок, ...]}, [ошибка, ...]), как parse_schedule_days."""
+    errors = []
+    found = {}
+    count = 0
+    reader = read_schedule_csv if kind == "csv" else read_schedule_ics
+    try:
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            for line_no, target_date, lesson in reader(f, errors):
+                count += 1
+                if count > SCHEDULE_IMPORT_MAX_LESSONS:
+                    errors.append(f"в файле больше {SCHEDULE_IMPORT_MAX_LESSONS} уроков")
+                    break
+                found.setdefault(target_date, []).append((line_no, lesson))
+    except UnicodeDecodeError:
+        errors.append("файл не в кодировке UTF-8")
+    except (ScheduleImportError, csv.Error) as e:
+        errors.append(str(e))
+    
+    days = {}
+    for target_date, lessons in sorted(found.items()):
+        if kind == "ics":
+            lessons.sort(key=lambda item: item[1][3])
+            lessons = [(line_no, (number, *lesson[1:])) for number, (line_no, lesson) in enumerate(lessons, 1)]
+        numbers = {}
+        for line_no, lesson in lessons:
+            number, subject, _, start, end = lesson[:5]
+            where = f"строка {line_no}, {target_date:%d.%m.%Y}"
+            if not subject:
+                errors.append(f"{where}: не указан предмет")
+            elif start and end and start >= end:
+                errors.append(f"{where}: урок заканчивается раньше, чем начинается")
+            elif number in numbers:
+                errors.append(f"{where}: урок №{number} уже есть в строке {numbers[number]}")
+            else:
+                numbers[number] = line_no
+                days.setdefault(target_date, []).append(lesson)
+    return days, errors
+
+async def load_schedule_file(file_id: str, kind: str):
+    with tempfile.TemporaryDirectory(prefix="school_bot_import_") as directory:
+        path = os.path.join(directory, f"schedule.{kind}")
+        await bot.download(file_id, destination=path)
+        return await asyncio.to_thread(parse_schedule_file, path, kind)
+
+def schedule_fingerprint(rows) -> str:
+    return hashlib.sha256(repr([tuple(row) for row in rows]).encode("utf-8")).hexdigest()
+
+def _lesson_key(lesson):
+    # Пустые поля в базе бывают и NULL, и ""
+    return tuple(value or None for value in lesson[1:])
+
+async def diff_schedule(group_id: int, days):
+    """Сравнивает уроки из файла с расписанием группы на те же даты.
+    Возвращает {date: (добавлены, изменены, удалены, дата была)} с номерами
+    уроков и отпечаток текущих строк для проверки при записи."""
+    rows = await execute_query(SCHEDULE_SNAPSHOT, (group_id, list(days)), fetch=True)
+    current = {}
+    for target_date, *lesson in rows:
+        current.setdefault(target_date, {})[lesson[0]] = _lesson_key(lesson)
+    
+    diff = {}
+    for target_date, lessons in days.items():
+        old = current.get(target_date, {})
+        new = {lesson[0]: _lesson_key(lesson) for lesson in lessons}
+        diff[target_date] = (
+            sorted(new.keys() - old.keys()),
+            sorted(number for number in new.keys() & old.keys() if new[number] != old[number]),
+            sorted(old.keys() - new.keys()),
+            bool(old),
+        )
+    return diff, schedule_fingerprint(rows)
+
+# Заменяет расписание группы на указанные даты одной транзакцией:
+# DELETE по всем датам и загрузка уроков через COPY.
+# fingerprint — отпечаток из diff_schedule: если расписание на эти даты
+# с тех пор изменилось, ничего не записывается
+async def replace_schedule(group_id: int, days, fingerprint=None):
+    rows = [
+        (group_id, target_date, *lesson)
+        for target_date, lessons in days.items()
+        for lesson in lessons
+    ]
+    async with db_pool.connection() as conn:
+        async with conn.transaction():
+            cursor = conn.cursor()
+            if fingerprint is not None:
+                # Блокирует только запись: /schedule читает как обычно
+                await cursor.execute("LOCK TABLE schedule IN SHARE ROW EXCLUSIVE MODE")
+                await cursor.execute(SCHEDULE_SNAPSHOT, (group_id, list(days)))
+                if schedule_fingerprint(await cursor.fetchall()) != fingerprint:
+                    raise ScheduleImportError("расписание на эти даты изменилось после предпросмотра, загрузите файл ещё раз")
+            await cursor.execute(
+                "DELETE FROM schedule WHERE group_id = %s AND date = ANY(%s)",
+                (group_id, list(days))
+            )
+            async with cursor.copy(f"COPY schedule (group_id, {', '.join(SCHEDULE_COLUMNS)}) FROM STDIN") as copy:
+                for row in rows:
+                    await copy.write_row(row)
+    return len(rows)
 
 @dp.message(Command("add_schedule"))
 async def cmd_add_schedule(message: types.Message):
     if not await is_admin(message.from_user.id):
         await message.answer("🚫 Только админ")
         return
+    group_id = await user_group(message.from_user.id)
     
     raw = message.text.replace("/add_schedule", "", 1).strip()
     if ":" not in raw:
         await message.answer(
             "Формат: /add_schedule 01.12.2025: "
             "1. 11:50-13:20 Иностранный язык (семинар) (305к.1) Казакова Е.Д., "
-            "2. 13:50-15:20 Правовое обеспечение (семинар) (315к.1) Магомедрасулова Э.З."
+            "2. 13:50-15:20 Правовое обеспечение (семинар) (315к.1) Магомедрасулова Э.З.\n\n"
+            "Несколько дней — каждый с новой строки:\n"
+            "01.12.2025: 1. ..., 2. ...\n"
+            "02.12.2025: 1. ..."
         )
         return
     
-    date_part, lessons_part = raw.split(":", 1)
-    date_part = date_part.strip()
-    
-    try:
-        target_date = datetime.datetime.strptime(date_part, "%d.%m.%Y").date()
-    except ValueError:
+    days, errors = parse_schedule_days(raw)
+    if not days and not errors:
         await message.answer("❌ Формат даты: 01.12.2025")
         return
     
-    await execute_query("DELETE FROM schedule WHERE date = %s", (target_date.strftime("%Y-%m-%d"),))
+    # Всё или ничего: при любой ошибке разбора база не меняется
+    if errors:
+        report = "\n".join(f"• {error}" for error in errors[:30])
+        if len(errors) > 30:
+            report += f"\n... и ещё {len(errors) - 30}"
+        await message.answer(f"❌ Расписание не сохранено, исправьте ошибки:\n\n{report}")
+        return
     
-    lessons = [lesson.strip() for lesson in lessons_part.split(",") if lesson.strip()]
-    if not lessons:
-        await message.answer("⚠️ Не найдено уроков для добавления")
+    try:
+        total = await replace_schedule(group_id, days)
+    except Exception as e:
+        logger.error(f"Ошибка сохранения расписания: {e}")
+        await message.answer(f"❌ Ошибка сохранения расписания, ничего не изменено: {e}")
         return
     
-    success_count = 0
-    for lesson in lessons:
-        try:
-            # Разбираем номер урока
-            num_part, rest = lesson.split(".", 1)
-            lesson_num = int(num_part.strip())
-            
-            # Извлекаем время
-            time_match = re.search(r"(\d{2}:\d{2})-(\d{2}:\d{2})", rest)
-            start_time = time_match.group(1) if time_match else None
-            end_time = time_match.group(2) if time_match else None
-            
-            if time_match:
-                rest = rest.replace(f"{start_time}-{end_time}", "").strip()
-            
-            # Извлекаем тип занятия
-            lesson_type = ""
-            if "(" in rest and ")" in rest:
-                lesson_type = rest.split("(", 1)[1].split(")", 1)[0].strip()
-                rest = rest.replace(f"({lesson_type})", "").strip()
-            
-            # Извлекаем кабинет
-            classroom = ""
-            if "(" in rest and ")" in rest:
-                classroom = rest.split("(", 1)[1].split(")", 1)[0].strip()
-                rest = rest.replace(f"({classroom})", "").strip()
-            
-            # Оставшееся — предмет и преподаватель
-            parts = rest.split()
-            if len(parts) >= 2:
-                subject = " ".join(parts[:-1])
-                teacher = parts[-1]
-            else:
-                subject = rest
-                teacher = ""
-            
-            # Сохраняем
-            await execute_query(
-                "INSERT INTO schedule (date, lesson_number, subject, classroom, start_time, end_time, lesson_type, teacher) "
-                "VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
-                (target_date.strftime("%Y-%m-%d"), lesson_num, subject, classroom, start_time, end_time, lesson_type, teacher)
+    await invalidate("schedule", *((group_id, target_date) for target_date in days))
+    
+    summary = "\n".join(f"• {d:%d.%m.%Y} — {len(lessons)}" for d, lessons in sorted(days.items()))
+    await message.answer(f"✅ Добавлено {total} уроков:\n{summary}")
+
+IMPORT_USAGE = (
+    "📥 <b>Импорт расписания</b>\n\n"
+    "Отправьте файл:\n"
+    "• <b>CSV</b> (UTF-8, разделитель <code>,</code> или <code>;</code>) с первой строкой\n"
+    f"<code>{';'.join(SCHEDULE_COLUMNS)}</code>\n"
+    "Обязательны date, lesson_number и subject. Дата ДД.ММ.ГГГГ, время ЧЧ:ММ.\n"
+    "• <b>ICS</b> — календарь: событие — урок, «Предмет (тип)» в названии, "
+    "кабинет в месте проведения. Номера уроков — по порядку в течение дня, "
+    "еженедельные повторы разворачиваются.\n\n"
+    "Расписание вашей группы на даты из файла заменяется целиком, другие даты не меняются. "
+    "Перед записью покажу, что изменится.\n"
+    "Для отмены напишите «Отмена»."
+)
+IMPORT_PREVIEW_TITLE = Template(
+    "📥 **Импорт расписания** из {name}\n"
+    "Дней: {days} ({first:%d.%m.%Y} — {last:%d.%m.%Y}), уроков: {lessons}\n"
+    "Новых дней: {new}, изменённых: {changed}, без изменений: {same}\n"
+    "Уроков добавится: {added}, изменится: {modified}, удалится: {removed}\n\n"
+)
+IMPORT_DAY_LINE = Template("• {date:%d.%m.%Y}: {changes}\n")
+
+def render_import_preview(name: str, days, diff) -> str:
+    changed_days = {target_date: entry for target_date, entry in diff.items() if any(entry[:3])}
+    preview = MessageBuilder(IMPORT_PREVIEW_TITLE(
+        name=name, days=len(days), first=min(days), last=max(days),
+        lessons=sum(len(lessons) for lessons in days.values()),
+        new=sum(not existed for *_, existed in diff.values()),
+        changed=sum(existed for *_, existed in changed_days.values()),
+        same=len(diff) - len(changed_days),
+        added=sum(len(entry[0]) for entry in diff.values()),
+        modified=sum(len(entry[1]) for entry in diff.values()),
+        removed=sum(len(entry[2]) for entry in diff.values()),
+    ))
+    for target_date, (added, modified, removed, existed) in sorted(changed_days.items()):
+        if not existed:
+            changes = f"новый день, уроков: {len(added)}"
+        else:
+            changes = "; ".join(
+                f"{label} {', '.join(map(str, numbers))}"
+                for label, numbers in (("добавлены", added), ("изменены", modified), ("удалены", removed))
+                if numbers
             )
-            success_count += 1
-            
-        except Exception as e:
-            logger.error(f"Ошибка парсинга урока '{lesson}': {str(e)}")
-            continue
+        preview.add(IMPORT_DAY_LINE(date=target_date, changes=changes))
+    return preview.first(more="…\n", limit=MESSAGE_LIMIT - 100)
+
+@dp.message(Command("import_schedule"))
+async def import_schedule_start(message: types.Message, state: FSMContext):
+    if not await is_admin(message.from_user.id):
+        await message.answer("🚫 Только админ")
+        return
     
-    if success_count:
-        await message.answer(f"✅ Добавлено {success_count} уроков на {target_date:%d.%m.%Y}")
-    else:
-        await message.answer("❌ Не удалось добавить ни одного урока")
+    await state.set_state(ScheduleImport.waiting_for_file)
+    await message.answer(IMPORT_USAGE, parse_mode="HTML")
+
+@dp.message(ScheduleImport.waiting_for_file)
+async def import_schedule_file(message: types.Message, state: FSMContext):
+    if not await is_admin(message.from_user.id):
+        await state.clear()
+        return
+    
+    if not message.document:
+        if message.text == "Отмена":
+            await state.clear()
+            await message.answer("❌ Импорт отменён")
+        else:
+            await message.answer("Отправьте файл .csv или .ics или «Отмена»")
+        return
+    
+    document = message.document
+    name = document.file_name or ""
+    kind = os.path.splitext(name)[1].lower().lstrip(".")
+    if kind not in ("csv", "ics"):
+        await message.answer("❌ Ожидается файл .csv или .ics")
+        return
+    if document.file_size and document.file_size > TELEGRAM_DOWNLOAD_LIMIT:
+        await message.answer("❌ Файл больше 20 МБ — бот не может его скачать")
+        return
+    
+    status = await message.answer("⏳ Проверяю файл...")
+    days, errors = await load_schedule_file(document.file_id, kind)
+    # Всё или ничего: при любой ошибке можно сразу прислать исправленный файл
+    if errors:
+        report = MessageBuilder(f"❌ Расписание не загружено, исправьте ошибки ({len(errors)}):\n\n")
+        report.extend(f"• {error}\n" for error in errors)
+        await status.edit_text(report.first(more="…"))
+        return
+    if not days:
+        await status.edit_text("❌ В файле нет уроков")
+        return
+    
+    group_id = await user_group(message.from_user.id)
+    diff, fingerprint = await diff_schedule(group_id, days)
+    # В состоянии только file_id: при подтверждении файл читается заново,
+    # поэтому уроки не хранятся между сообщениями и подтверждать можно в любом воркере
+    await state.set_state(ScheduleImport.confirming)
+    await state.set_data({"file_id": document.file_id, "kind": kind, "group_id": group_id, "fingerprint": fingerprint})
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="✅ Записать", callback_data="si:apply"),
+        InlineKeyboardButton(text="❌ Отмена", callback_data="si:cancel"),
+    ]])
+    await status.edit_text(render_import_preview(name, days, diff), parse_mode="Markdown", reply_markup=keyboard)
+
+@dp.callback_query(ScheduleImport.confirming, F.data.startswith("si:"))
+async def import_schedule_confirm(callback: types.CallbackQuery, state: FSMContext):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("🚫 Только админ", show_alert=True)
+        return
+    
+    data = await state.get_data()
+    await state.clear()
+    await callback.answer()
+    if callback.data != "si:apply":
+        await callback.message.edit_text("❌ Импорт отменён")
+        return
+    
+    await callback.message.edit_text("⏳ Записываю расписание...")
+    try:
+        days, errors = await load_schedule_file(data["file_id"], data["kind"])
+        if errors:
+            raise ScheduleImportError(errors[0])
+        total = await replace_schedule(data["group_id"], days, data["fingerprint"])
+    except Exception as e:
+        logger.error(f"Ошибка импорта расписания: {e}")
+        await callback.message.edit_text(f"❌ Импорт не выполнен, расписание не изменено: {e}")
+        return
+    
+    # Все затронутые даты — одним сбросом
+    await invalidate("schedule", *((data["group_id"], target_date) for target_date in days))
+    await callback.message.edit_text(
+        f"✅ Импортировано уроков: {total}, дней: {len(days)} ({min(days):%d.%m.%Y} — {max(days):%d.%m.%Y})"
+    )
+    logger.info(f"📥 {callback.from_user.id} импортировал расписание: {total} уроков на {len(days)} дней")
+
+# Кнопки предпросмотра после отмены или завершения импорта
+@dp.callback_query(F.data.startswith("si:"))
+async def import_schedule_stale(callback: types.CallbackQuery):
+    await callback.answer("Предпросмотр устарел, начните заново: /import_schedule", show_alert=True)
+
+ANNOUNCEMENT = Template("**Объявление**\n\n{text}")
 
 @dp.message(Command("announce"))
 async def cmd_announce(message: types.Message):
@@ -600,17 +2740,210 @@ async def cmd_announce(message: types.Message):
         await message.answer("Использование: /announce Текст")
         return
 
-    users = await execute_query("SELECT telegram_id FROM users", fetch=True)
-    sent = failed = 0
-    for (tg_id,) in users:
-        try:
-            await bot.send_message(tg_id, f"**Объявление**\n\n{text}", parse_mode="Markdown")
-            sent += 1
-        except Exception as e:
-            logger.warning(f"Не удалось отправить {tg_id}: {e}")
-            failed += 1
+    # Объявление получает группа админа; старший админ может написать всем: /announce all Текст
+    if is_super_admin(message.from_user.id) and text.split(maxsplit=1)[0] == "all":
+        text = text[3:].strip()
+        users = await execute_query("SELECT telegram_id FROM users WHERE is_active", fetch=True)
+    else:
+        users = await execute_query(
+            "SELECT telegram_id FROM users WHERE group_id = %s AND is_active",
+            (await user_group(message.from_user.id),), fetch=True
+        )
+    if not text:
+        await message.answer("Использование: /announce Текст")
+        return
+    status = await message.answer(f"📤 Рассылка: 0/{len(users)}")
+    # Текст уходит как есть: разметку в объявлении админ пишет сам
+    messages = [(tg_id, ANNOUNCEMENT(text=Markup(text))) for (tg_id,) in users]
+    
+    async def run():
+        stats = await broadcast(messages, parse_mode="Markdown", on_progress=status_updater(status, "📤 Рассылка"))
+        logger.info(f"📤 Рассылка от {message.from_user.id}: отправлено {stats.sent}, "
+                    f"заблокировали {len(stats.blocked)}, ошибок {stats.failed}")
+    
+    # Рассылка идёт в фоне, статус обновляется в одном сообщении
+    run_in_background(run())
+
+# Перекличка: админ отмечает всю группу, сохранение — одним запросом
+ROLLCALL_ICONS = {"present": "✅", "absent": "❌", "late": "🕒"}
+ROLLCALL_NEXT = {"present": "absent", "absent": "late", "late": "present"}
+
+def rollcall_text(data) -> str:
+    counts = {status: 0 for status in ROLLCALL_ICONS}
+    for status in data["marks"].values():
+        counts[status] += 1
+    target_date = datetime.date.fromisoformat(data["date"])
+    return (
+        f"📋 Перекличка на {target_date:%d.%m.%Y}\n"
+        "Нажмите на студента, чтобы сменить отметку: ✅ → ❌ → 🕒\n\n"
+        + "  ".join(f"{ROLLCALL_ICONS[status]} {count}" for status, count in counts.items())
+    )
+
+def rollcall_keyboard(data):
+    students = data["students"]
+    page = data["page"]
+    pages = max(1, (len(students) + ROLLCALL_PAGE_SIZE - 1) // ROLLCALL_PAGE_SIZE)
+    rows = [
+        [InlineKeyboardButton(
+            text=f"{ROLLCALL_ICONS[data['marks'][str(tg_id)]]} {name}",
+            callback_data=f"rc:t:{tg_id}"
+        )]
+        for tg_id, name in students[page * ROLLCALL_PAGE_SIZE:(page + 1) * ROLLCALL_PAGE_SIZE]
+    ]
+    if pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton(text="◀️", callback_data=f"rc:p:{page - 1}"))
+        nav.append(InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data="rc:noop"))
+        if page < pages - 1:
+            nav.append(InlineKeyboardButton(text="▶️", callback_data=f"rc:p:{page + 1}"))
+        rows.append(nav)
+    rows.append([
+        InlineKeyboardButton(text="Все ✅", callback_data="rc:all"),
+        InlineKeyboardButton(text="💾 Сохранить", callback_data="rc:save"),
+        InlineKeyboardButton(text="Отмена", callback_data="rc:cancel"),
+    ])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+@dp.message(Command("rollcall"))
+async def cmd_rollcall(message: types.Message, state: FSMContext):
+    if not await is_admin(message.from_user.id):
+        await message.answer("🚫 Только админ")
+        return
+    
+    raw = message.text.replace("/rollcall", "", 1).strip()
+    try:
+        target_date = datetime.datetime.strptime(raw, "%d.%m.%Y").date() if raw else datetime.date.today()
+    except ValueError:
+        await message.answer("❌ Формат: /rollcall 01.12.2025")
+        return
+    
+    # Студенты группы и уже существующие отметки на дату — одним запросом
+    rows = await execute_query(
+        "SELECT u.telegram_id, u.full_name, a.status FROM users u "
+        "LEFT JOIN attendance a ON a.user_id = u.telegram_id AND a.date = %s "
+        "WHERE u.group_id = %s AND u.full_name IS NOT NULL ORDER BY u.full_name",
+        (target_date, await user_group(message.from_user.id)), fetch=True
+    )
+    if not rows:
+        await message.answer("Нет студентов в базе")
+        return
+    
+    data = {
+        "date": target_date.isoformat(),
+        "page": 0,
+        "students": [[tg_id, name] for tg_id, name, _ in rows],
+        "marks": {str(tg_id): status if status in ROLLCALL_ICONS else "present" for tg_id, _, status in rows},
+    }
+    await state.set_state(RollCall.marking)
+    await state.set_data(data)
+    await message.answer(rollcall_text(data), reply_markup=rollcall_keyboard(data))
+
+@dp.callback_query(RollCall.marking, F.data.startswith("rc:"))
+async def rollcall_callback(callback: types.CallbackQuery, state: FSMContext):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("🚫 Только админ")
+        return
+    
+    data = await state.get_data()
+    action, _, arg = callback.data[3:].partition(":")
+    
+    if action == "noop":
+        await callback.answer()
+        return
+    
+    if action == "cancel":
+        await state.clear()
+        await callback.message.edit_text("❌ Перекличка отменена")
+        await callback.answer()
+        return
+    
+    if action == "save":
+        rows = [
+            (int(tg_id), datetime.date.fromisoformat(data["date"]), status, None, callback.from_user.id)
+            for tg_id, status in data["marks"].items()
+        ]
+        await upsert_attendance(rows)
+        await state.clear()
+        await callback.message.edit_text(rollcall_text(data) + "\n\n💾 Сохранено")
+        await callback.answer("Сохранено")
+        logger.info(f"📋 Админ {callback.from_user.id} провёл перекличку на {data['date']} ({len(rows)} студентов)")
+        return
+    
+    if action == "t" and arg in data["marks"]:
+        data["marks"][arg] = ROLLCALL_NEXT[data["marks"][arg]]
+    elif action == "p":
+        data["page"] = int(arg)
+    elif action == "all":
+        data["marks"] = {tg_id: "present" for tg_id in data["marks"]}
+    
+    await state.set_data(data)
+    try:
+        await callback.message.edit_text(rollcall_text(data), reply_markup=rollcall_keyboard(data))
+    except TelegramBadRequest:
+        pass  # message is not modified
+    await callback.answer()
+
+# Кнопки переклички после её сохранения, отмены или истечения состояния
+@dp.callback_query(F.data.startswith("rc:"))
+async def rollcall_stale(callback: types.CallbackQuery):
+    await callback.answer("Перекличка устарела, начните заново: /rollcall", show_alert=True)
+
+# Поиск студентов по ФИО
+# Включается в init_db, если в базе есть pg_trgm
+name_search_trgm = False
+
+def normalize_name(name: str) -> str:
+    """Как name_norm() в базе: нижний регистр, ё → е, одиночные пробелы."""
+    return " ".join(name.lower().replace("ё", "е").split())
+
+async def find_students(group_id: int, query: str):
+    """Кандидаты группы (telegram_id, full_name), лучшие первыми: точное совпадение,
+    вхождение строки, затем похожие по триграммам (опечатки, порядок слов)."""
+    q = normalize_name(query)
+    pattern = "%" + q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    if name_search_trgm:
+        return await execute_query(
+            "SELECT telegram_id, full_name FROM users "
+            "WHERE group_id = %s AND full_name IS NOT NULL "
+            "AND (name_norm(full_name) LIKE %s OR %s <%% name_norm(full_name)) "
+            "ORDER BY name_norm(full_name) = %s DESC, name_norm(full_name) LIKE %s DESC, "
+            "word_similarity(%s, name_norm(full_name)) DESC, full_name LIMIT %s",
+            (group_id, pattern, q, q, pattern, q, NAME_SEARCH_LIMIT), fetch=True
+        )
+    return await execute_query(
+        "SELECT telegram_id, full_name FROM users "
+        "WHERE group_id = %s AND full_name IS NOT NULL AND name_norm(full_name) LIKE %s "
+        "ORDER BY name_norm(full_name) = %s DESC, full_name LIMIT %s",
+        (group_id, pattern, q, NAME_SEARCH_LIMIT), fetch=True
+    )
+
+def pick_student(candidates, query: str):
+    """Студент, которого можно выбрать без подтверждения, или None, если нужно выбирать.
+    Найденный только по триграммам (опечатка в запросе) подтверждается кнопкой."""
+    q = normalize_name(query)
+    exact = [row for row in candidates if normalize_name(row[1]) == q]
+    if len(exact) == 1:
+        return exact[0]
+    if len(candidates) == 1 and q in normalize_name(candidates[0][1]):
+        return candidates[0]
+    return None
+
+def student_picker(candidates, action: str, payload: str):
+    """Кнопки выбора студента: callback_data = action:telegram_id:payload."""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=name, callback_data=f"{action}:{tg_id}:{payload}")]
+        for tg_id, name in candidates
+    ])
+
+async def set_birthday(group_id: int, user_id: int, birth_date: datetime.date):
+    row = await execute_query(
+        "UPDATE users SET birth_date = %s WHERE telegram_id = %s AND group_id = %s RETURNING full_name",
+        (birth_date, user_id, group_id), fetch=True
+    )
+    return row[0] if row else None
 
-    await message.answer(f"✅ Отправлено: {sent}, ❌ ошибок: {failed}")
+BIRTHDAY_SET = Template("✅ ДР для **{name}** установлен: **{date:%d.%m}**")
 
 @dp.message(Command("birthday"))
 async def cmd_birthday(message: types.Message):
@@ -638,82 +2971,218 @@ async def cmd_birthday(message: types.Message):
         await message.answer("Неверный формат даты. Используй: ДД.ММ")
         return
 
-    matches = await execute_query(
-        "SELECT telegram_id FROM users WHERE full_name ILIKE %s",
-        (f"%{name}%",), fetch=True
-    )
-
-    if not matches:
+    group_id = await user_group(message.from_user.id)
+    candidates = await find_students(group_id, name)
+    if not candidates:
         await message.answer(f"Студент '{name}' не найден")
         return
-    if len(matches) > 1:
-        names_list = await execute_query(
-            "SELECT full_name FROM users WHERE full_name ILIKE %s", (f"%{name}%",), fetch=True
+    
+    student = pick_student(candidates, name)
+    if student is None:
+        await message.answer(
+            (f"Точного совпадения для '{name}' нет" if len(candidates) == 1 else f"Найдено несколько по запросу '{name}'")
+            + f". Кому установить ДР {birth_date:%d.%m}?",
+            reply_markup=student_picker(candidates, "bd", f"{birth_date:%d%m}")
         )
-        names = "\n".join([f"• {row[0]}" for row in names_list])
-        await message.answer(f"Найдено несколько:\n{names}\n\nУточни ФИО")
         return
 
-    user_id = matches[0][0]
-    await execute_query(
-        "UPDATE users SET birth_date = %s WHERE telegram_id = %s",
-        (birth_date.strftime("%Y-%m-%d"), user_id)
-    )
-    await message.answer(f"✅ ДР для **{name}** установлен: **{date_str}**", parse_mode="Markdown")
+    full_name = await set_birthday(group_id, student[0], birth_date)
+    await message.answer(BIRTHDAY_SET(name=full_name, date=birth_date), parse_mode="Markdown")
+
+@dp.callback_query(F.data.startswith("bd:"))
+async def birthday_pick(callback: types.CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("🚫 Только админ", show_alert=True)
+        return
+    
+    _, user_id, day_month = callback.data.split(":")
+    birth_date = datetime.date(2000, int(day_month[2:]), int(day_month[:2]))
+    full_name = await set_birthday(await user_group(callback.from_user.id), int(user_id), birth_date)
+    if full_name is None:
+        await callback.message.edit_text("❌ Студент больше не найден")
+    else:
+        await callback.message.edit_text(BIRTHDAY_SET(name=full_name, date=birth_date), parse_mode="Markdown")
+    await callback.answer()
+
+# Постраничные списки пользователей группы. Страница — один запрос по индексу:
+# строки группы после (или до) ключа (поле сортировки, telegram_id) последней
+# показанной строки. В кнопках хранится только telegram_id этой строки,
+# значение поля сортировки подставляется из базы в том же запросе
+# code — короткое имя списка в callback_data
+USER_LISTS = {
+    "users": {
+        "code": "u",
+        "title": "Пользователи группы",
+        "columns": "full_name, telegram_id, joined_at, is_admin",
+        "order": ("joined_at", "telegram_id"),
+        "where": "group_id = %s",
+    },
+    "birthdays": {
+        "code": "b",
+        "title": "Список студентов и ДР",
+        "columns": "full_name, telegram_id, birth_date",
+        "order": ("full_name", "telegram_id"),
+        "where": "group_id = %s AND full_name IS NOT NULL",
+    },
+    # Зарегистрировались, но ещё не выбрали группу — видны только старшему админу.
+    # Условие с параметром, как у остальных: group_id передаётся None
+    "unassigned": {
+        "code": "n",
+        "title": "Без группы (выбирают сами через /group)",
+        "columns": "full_name, telegram_id, joined_at, is_admin",
+        "order": ("joined_at", "telegram_id"),
+        "where": "group_id IS NULL AND %s::int IS NULL",
+    },
+}
+USER_LIST_CODES = {spec["code"]: kind for kind, spec in USER_LISTS.items()}
+
+async def user_list_count(group_id: int, kind: str) -> int:
+    count = user_count_cache.get((group_id, kind))
+    if count is None:
+        row = await execute_query(
+            f"SELECT count(*) FROM users WHERE {USER_LISTS[kind]['where']}", (group_id,), fetch=True
+        )
+        count = row[0][0]
+        user_count_cache.set((group_id, kind), count)
+    return count
+
+async def fetch_user_page(group_id: int, kind: str, direction: str = ">", after=None):
+    """Страница списка kind группы после (direction=">") или до ("<") пользователя after.
+    Возвращает строки и признак, что в этом направлении есть ещё."""
+    # direction попадает в текст запроса
+    if direction not in (">", "<"):
+        raise ValueError(f"неверное направление: {direction!r}")
+    spec = USER_LISTS[kind]
+    key = ", ".join(spec["order"])
+    descending = direction == "<"
+    order = ", ".join(f"{column} DESC" for column in spec["order"]) if descending else key
+    
+    if after is None:
+        rows = await execute_query(
+            f"SELECT {spec['columns']} FROM users WHERE {spec['where']} ORDER BY {order} LIMIT %s",
+            (group_id, USERS_PAGE_SIZE + 1), fetch=True
+        )
+    else:
+        # LATERAL: ключ курсора становится параметром условия по индексу
+        columns = ", ".join(f"u.{column.strip()}" for column in spec["columns"].split(","))
+        cursor_key = ", ".join(f"c.{column}" for column in spec["order"])
+        row_key = ", ".join(f"u.{column}" for column in spec["order"])
+        rows = await execute_query(
+            f"SELECT {columns} FROM (SELECT {key} FROM users WHERE telegram_id = %s) c, LATERAL ("
+            f"    SELECT * FROM users u WHERE {spec['where']} AND ({row_key}) {direction} ({cursor_key})"
+            f"    ORDER BY {order} LIMIT %s"
+            f") u",
+            (after, group_id, USERS_PAGE_SIZE + 1), fetch=True
+        )
+    has_more = len(rows) > USERS_PAGE_SIZE
+    rows = rows[:USERS_PAGE_SIZE]
+    if descending:
+        rows.reverse()
+    return rows, has_more
+
+USER_LIST_TITLE = Template("**{title}** ({total}, стр. {page} из {pages})\n\n")
+USER_LINE = Template("• {name:.100}{admin} — `{tg_id}` — {joined}\n")
+BIRTHDAY_LINE = Template("• {name:.100} (`{tg_id}`) — {birth_date}\n")
+
+@fragment
+def user_list_line(kind: str, row) -> str:
+    if kind in ("users", "unassigned"):
+        name, tg_id, joined, is_admin = row
+        return USER_LINE(
+            name=name or "ФИО не указано", admin=" (✅ админ)" if is_admin else "",
+            tg_id=tg_id, joined=f"{joined:%Y-%m-%d}" if joined else "?"
+        )
+    name, tg_id, bdate = row
+    return BIRTHDAY_LINE(name=name, tg_id=tg_id, birth_date=f"{bdate:%d.%m}" if bdate else "не указан")
+
+async def render_user_page(group_id: int, kind: str, page: int = 0, direction: str = ">", after=None):
+    rows, has_more = await fetch_user_page(group_id, kind, direction, after)
+    if not rows and after is not None:
+        # Пользователь из курсора удалён или список сократился — с начала
+        page, direction = 0, ">"
+        rows, has_more = await fetch_user_page(group_id, kind)
+    if not rows:
+        return None, None
+    
+    total = await user_list_count(group_id, kind)
+    pages = max(1, -(-total // USERS_PAGE_SIZE))
+    page = min(page, pages - 1)
+    builder = MessageBuilder(USER_LIST_TITLE(title=USER_LISTS[kind]["title"], total=total, page=page + 1, pages=pages))
+    text = builder.extend(user_list_line(kind, tuple(row)) for row in rows).first(more="…")
+    
+    has_prev = has_more if direction == "<" else page > 0
+    has_next = has_more if direction == ">" else True
+    code = USER_LISTS[kind]["code"]
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton(text="◀️", callback_data=f"ul:{code}:<:{rows[0][1]}:{page - 1}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton(text="▶️", callback_data=f"ul:{code}:>:{rows[-1][1]}:{page + 1}"))
+    return text, InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
 
 @dp.message(Command("birthdays"))
 async def cmd_birthdays_list(message: types.Message):
     if not await is_admin(message.from_user.id):
         await message.answer("🚫 Только админ")
         return
-
-    students = await execute_query(
-        "SELECT full_name, birth_date, telegram_id FROM users WHERE full_name IS NOT NULL ORDER BY full_name",
-        fetch=True
-    )
-
-    if not students:
+    
+    text, keyboard = await render_user_page(await user_group(message.from_user.id), "birthdays")
+    if text is None:
         await message.answer("Нет студентов в базе")
         return
-
-    text = "**Список студентов и ДР**\n\n"
-    for name, bdate, tg_id in students:
-        if bdate and len(bdate) >= 10:
-            bdate_str = f"{bdate[8:10]}.{bdate[5:7]}"
-        else:
-            bdate_str = "не указан"
-        text += f"• {name} (`{tg_id}`) — {bdate_str}\n"
-
-    await message.answer(text, parse_mode="Markdown")
+    await message.answer(text, parse_mode="Markdown", reply_markup=keyboard)
 
 @dp.message(Command("users"))
 async def cmd_users(message: types.Message):
     if not await is_admin(message.from_user.id):
         await message.answer("🚫 Только админ")
         return
-
-    all_users = await execute_query(
-        "SELECT full_name, telegram_id, joined_at, is_admin FROM users ORDER BY joined_at",
-        fetch=True
-    )
-
-    if not all_users:
+    
+    # /users none — старшему админу: кто ещё не выбрал группу
+    if message.text.replace("/users", "", 1).strip().lower() == "none" and is_super_admin(message.from_user.id):
+        text, keyboard = await render_user_page(None, "unassigned")
+        if text is None:
+            await message.answer("Все пользователи выбрали группу")
+            return
+        await message.answer(text, parse_mode="Markdown", reply_markup=keyboard)
+        return
+    
+    text, keyboard = await render_user_page(await user_group(message.from_user.id), "users")
+    if text is None:
         await message.answer("Пользователей нет")
         return
+    await message.answer(text, parse_mode="Markdown", reply_markup=keyboard)
 
-    text = "**Все пользователи**\n\n"
-    for name, tg_id, joined, is_admin in all_users:
-        name = name or "ФИО не указано"
-        admin_mark = " (✅ админ)" if is_admin else ""
-        joined_str = joined[:10] if joined else "?"
-        text += f"• {name}{admin_mark} — `{tg_id}` — {joined_str}\n"
-
-    if len(text) > 3900:
-        parts = [text[i:i+3900] for i in range(0, len(text), 3900)]
-        for part in parts:
-            await message.answer(part, parse_mode="Markdown")
+@dp.callback_query(F.data.startswith("ul:"))
+async def user_list_page(callback: types.CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        await callback.answer("🚫 Только админ", show_alert=True)
+        return
+    
+    # callback_data присылает клиент: direction подставляется в SQL, поэтому только из кнопок
+    try:
+        _, code, direction, after, page = callback.data.split(":")
+        after, page = int(after), max(int(page), 0)
+    except ValueError:
+        await callback.answer()
+        return
+    kind = USER_LIST_CODES.get(code)
+    if direction not in (">", "<") or kind is None:
+        await callback.answer()
+        return
+    if kind == "unassigned":
+        if not is_super_admin(callback.from_user.id):
+            await callback.answer()
+            return
+        group_id = None
     else:
-        await message.answer(text, parse_mode="Markdown")
+        group_id = await user_group(callback.from_user.id)
+    text, keyboard = await render_user_page(group_id, kind, page, direction, after)
+    try:
+        await callback.message.edit_text(text or "Список пуст", parse_mode="Markdown", reply_markup=keyboard)
+    except TelegramBadRequest:
+        pass  # message is not modified
+    await callback.answer()
 
 @dp.message(Command("clear_homework"))
 async def clear_homework_start(message: types.Message, state: FSMContext):
@@ -721,12 +3190,14 @@ async def clear_homework_start(message: types.Message, state: FSMContext):
         await message.answer("🚫 Только админ")
         return
     
-    count = await execute_query("SELECT COUNT(*) FROM homework", fetch=True)
+    count = await execute_query(
+        "SELECT COUNT(*) FROM homework WHERE group_id = %s", (await user_group(message.from_user.id),), fetch=True
+    )
     total = count[0][0] if count else 0
     
     await message.answer(
         f"⚠️ <b>Внимание!</b>\n\n"
-        f"Вы собираетесь удалить <b>все домашние задания</b> ({total} записей).\n\n"
+        f"Вы собираетесь удалить <b>все домашние задания группы</b> ({total} записей).\n\n"
         "Это действие нельзя отменить!\n\n"
         "Подтвердите удаление, отправив: <code>ДА, УДАЛИТЬ ДЗ</code>",
         parse_mode="HTML",
@@ -741,7 +3212,10 @@ async def clear_homework_start(message: types.Message, state: FSMContext):
 @dp.message(ClearHomework.confirming)
 async def clear_homework_confirm(message: types.Message, state: FSMContext):
     if message.text == "ДА, УДАЛИТЬ ДЗ":
-        result = await execute_query("DELETE FROM homework")
+        group_id = await user_group(message.from_user.id)
+        result = await execute_query("DELETE FROM homework WHERE group_id = %s", (group_id,))
+        homework_views[group_id].clear()
+        await invalidate("homework", group_id)
         await message.answer(
             f"✅ <b>Домашние задания очищены!</b>\n\n"
             f"Удалено записей: {result}",
@@ -763,12 +3237,14 @@ async def clear_schedule_start(message: types.Message, state: FSMContext):
         await message.answer("🚫 Только админ")
         return
     
-    count = await execute_query("SELECT COUNT(*) FROM schedule", fetch=True)
+    count = await execute_query(
+        "SELECT COUNT(*) FROM schedule WHERE group_id = %s", (await user_group(message.from_user.id),), fetch=True
+    )
     total = count[0][0] if count else 0
     
     await message.answer(
         f"⚠️ <b>Внимание!</b>\n\n"
-        f"Вы собираетесь удалить <b>всё расписание</b> ({total} записей).\n\n"
+        f"Вы собираетесь удалить <b>всё расписание группы</b> ({total} записей).\n\n"
         "Это действие нельзя отменить!\n\n"
         "Подтвердите удаление, отправив: <code>ДА, УДАЛИТЬ ВСЁ</code>",
         parse_mode="HTML",
@@ -783,7 +3259,9 @@ async def clear_schedule_start(message: types.Message, state: FSMContext):
 @dp.message(ClearSchedule.confirming)
 async def clear_schedule_confirm(message: types.Message, state: FSMContext):
     if message.text == "ДА, УДАЛИТЬ ВСЁ":
-        result = await execute_query("DELETE FROM schedule")
+        group_id = await user_group(message.from_user.id)
+        result = await execute_query("DELETE FROM schedule WHERE group_id = %s", (group_id,))
+        await invalidate("schedule", group_id)
         await message.answer(
             f"✅ <b>Расписание очищено!</b>\n\n"
             f"Удалено записей: {result}",
@@ -833,16 +3311,62 @@ async def grant_admin_process(message: types.Message, state: FSMContext):
         await state.clear()
         return
     
+    # Админ управляет своей группой
+    if await user_group(target_id) is None:
+        await message.answer(f"❌ Пользователь с ID `{target_id}` ещё не выбрал группу (/group)", parse_mode="Markdown")
+        await state.clear()
+        return
+    
     # Делаем админом
     await execute_query(
         "UPDATE users SET is_admin = TRUE WHERE telegram_id = %s",
         (target_id,)
     )
+    await invalidate("users", target_id)
     
     await message.answer(f"✅ Пользователь с ID `{target_id}` успешно назначен админом!", parse_mode="Markdown")
     logger.critical(f"[SUPER_ADMIN] {message.from_user.id} назначил админа {target_id}")
     await state.clear()
 
+GROUP_LINE = Template("• {name} (id {group_id}): студентов {members}, админов {admins}\n")
+
+@dp.message(Command("groups"))
+async def cmd_groups(message: types.Message):
+    if not is_super_admin(message.from_user.id):
+        await message.answer("🚫 Эта команда только для старшего админа")
+        return
+    
+    groups = await execute_query(
+        "SELECT g.id, g.name, count(u.telegram_id), count(u.telegram_id) FILTER (WHERE u.is_admin) "
+        "FROM groups g LEFT JOIN users u ON u.group_id = g.id GROUP BY g.id ORDER BY g.name",
+        fetch=True
+    )
+    groups_text = MessageBuilder("**Группы**\n\n").extend(
+        GROUP_LINE(name=name, group_id=group_id, members=members, admins=admins)
+        for group_id, name, members, admins in groups
+    ).add("\nНовая группа: /add\\_group Название\nБез группы: /users none")
+    await answer_chunks(message, groups_text.chunks())
+
+@dp.message(Command("add_group"))
+async def cmd_add_group(message: types.Message):
+    if not is_super_admin(message.from_user.id):
+        await message.answer("🚫 Эта команда только для старшего админа")
+        return
+    
+    name = message.text.replace("/add_group", "", 1).strip()
+    if not name or len(name) > 100:
+        await message.answer("Использование: /add_group Название (до 100 символов)")
+        return
+    
+    row = await execute_query(
+        "INSERT INTO groups (name) VALUES (%s) ON CONFLICT (name) DO NOTHING RETURNING id", (name,), fetch=True
+    )
+    if row is None:
+        await message.answer("❌ Группа с таким названием уже есть")
+        return
+    await message.answer(f"✅ Группа «{name}» создана (id {row[0]}). Студенты выбирают её через /group")
+    logger.critical(f"[SUPER_ADMIN] {message.from_user.id} создал группу {row[0]} «{name}»")
+
 @dp.message(Command("revoke_admin"))
 async def revoke_admin_start(message: types.Message, state: FSMContext):
     if not is_super_admin(message.from_user.id):
@@ -880,6 +3404,7 @@ async def revoke_admin_process(message: types.Message, state: FSMContext):
         "UPDATE users SET is_admin = FALSE WHERE telegram_id = %s",
         (target_id,)
     )
+    await invalidate("users", target_id)
     
     await message.answer(f"✅ Пользователь с ID `{target_id}` успешно лишен прав админа!", parse_mode="Markdown")
     logger.critical(f"[SUPER_ADMIN] {message.from_user.id} лишил прав админа {target_id}")
@@ -915,6 +3440,114 @@ async def change_master_pass_process(message: types.Message, state: FSMContext):
     logger.critical(f"[SUPER_ADMIN] {message.from_user.id} изменил мастер-пароль")
     await state.clear()
 
+# РЕЗЕРВНОЕ КОПИРОВАНИЕ
+# Формат: части backup_*.partNN.ndjson.gz, каждая строка —
+# {"table": ..., "row": {...}}, плюс manifest.json с числом строк
+# и sha256 по таблицам и по файлам частей.
+BACKUP_FORMAT_VERSION = 1
+
+# Порядок важен для восстановления
+BACKUP_TABLES = {
+    "groups": ["id", "name", "created_at"],
+    "users": ["telegram_id", "full_name", "is_admin", "is_active", "birth_date", "joined_at", "group_id"],
+    "homework": ["id", "group_id", "subject", "description", "due_date", "added_by", "created_at"],
+    "schedule": ["group_id", "date", "lesson_number", "subject", "classroom", "start_time", "end_time", "lesson_type", "teacher"],
+    "attendance": ["user_id", "date", "status", "reason", "marked_by", "marked_at", "group_id"],
+}
+
+def _json_default(value):
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} не сериализуется в JSON")
+
+def _file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class BackupWriter:
+    """Пишет NDJSON в gzip-файлы, начиная новую часть, когда сжатый
+    размер текущей подходит к part_size."""
+
+    def __init__(self, directory: str, prefix: str, part_size: int):
+        self.directory = directory
+        self.prefix = prefix
+        self.part_size = part_size
+        self.parts = []
+        self._raw = None
+        self._gz = None
+        self._rows = 0
+
+    def _open(self):
+        name = f"{self.prefix}.part{len(self.parts) + 1:02d}.ndjson.gz"
+        path = os.path.join(self.directory, name)
+        self._raw = open(path, "wb")
+        self._gz = gzip.GzipFile(filename=name[:-3], mode="wb", fileobj=self._raw)
+        self._rows = 0
+        self.parts.append({"name": name, "path": path})
+
+    def _finish(self):
+        self._gz.close()
+        self._raw.close()
+        part = self.parts[-1]
+        part["rows"] = self._rows
+        part["bytes"] = os.path.getsize(part["path"])
+        part["sha256"] = _file_sha256(part["path"])
+        self._gz = self._raw = None
+
+    def write(self, data: bytes, rows: int):
+        if self._raw is None:
+            self._open()
+        self._gz.write(data)
+        self._rows += rows
+        # Запас в 1 МБ на то, что zlib ещё держит в буфере и допишет при закрытии
+        if self._raw.tell() >= self.part_size - 1024 * 1024:
+            self._finish()
+
+    def close(self):
+        if self._raw is not None:
+            self._finish()
+        return self.parts
+
+async def export_backup(directory: str, prefix: str):
+    """Выгружает все таблицы через серверные курсоры в gzip-NDJSON.
+    Возвращает manifest. Все таблицы читаются из одного снимка базы."""
+    writer = BackupWriter(directory, prefix, BACKUP_PART_SIZE)
+    manifest = {
+        "format": "school_bot-ndjson",
+        "version": BACKUP_FORMAT_VERSION,
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "tables": {},
+        "parts": [],
+    }
+    async with db_pool.connection() as conn:
+        await conn.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+        for table, columns in BACKUP_TABLES.items():
+            digest = hashlib.sha256()
+            count = 0
+            async with conn.cursor(name=f"backup_{table}") as cursor:
+                await cursor.execute(f"SELECT {', '.join(columns)} FROM {table}")
+                while rows := await cursor.fetchmany(BACKUP_BATCH_SIZE):
+                    data = "".join(
+                        json.dumps({"table": table, "row": dict(zip(columns, row))},
+                                   ensure_ascii=False, default=_json_default) + "\n"
+                        for row in rows
+                    ).encode("utf-8")
+                    digest.update(data)
+                    count += len(rows)
+                    # Сжатие и запись на диск — в потоке, чтобы не держать event loop
+                    await asyncio.to_thread(writer.write, data, len(rows))
+            manifest["tables"][table] = {"columns": columns, "rows": count, "sha256": digest.hexdigest()}
+    
+    parts = await asyncio.to_thread(writer.close)
+    manifest["parts"] = [
+        {"name": p["name"], "rows": p["rows"], "bytes": p["bytes"], "sha256": p["sha256"]}
+        for p in parts
+    ]
+    return manifest, [p["path"] for p in parts]
+
 @dp.message(Command("backup_db"))
 async def backup_db(message: types.Message):
     if not is_super_admin(message.from_user.id):
@@ -922,70 +3555,284 @@ async def backup_db(message: types.Message):
         return
     
     try:
-        # Экспортируем данные в JSON
-        users = await execute_query("SELECT telegram_id, full_name, is_admin, birth_date, joined_at FROM users", fetch=True)
-        homework = await execute_query("SELECT subject, description, due_date, added_by, created_at FROM homework", fetch=True)
-        schedule = await execute_query("SELECT date, lesson_number, subject, classroom, start_time, end_time, lesson_type, teacher FROM schedule", fetch=True)
-        attendance = await execute_query("SELECT user_id, date, status, reason, marked_by, marked_at FROM attendance", fetch=True)
-        
-        backup_data = {
-            "backup_date": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "users": [
-                {
-                    "telegram_id": user[0],
-                    "full_name": user[1],
-                    "is_admin": user[2],
-                    "birth_date": user[3],
-                    "joined_at": user[4]
-                } for user in users
-            ],
-            "homework": [
-                {
-                    "subject": hw[0],
-                    "description": hw[1],
-                    "due_date": hw[2],
-                    "added_by": hw[3],
-                    "created_at": hw[4]
-                } for hw in homework
-            ],
-            "schedule": [
-                {
-                    "date": sch[0],
-                    "lesson_number": sch[1],
-                    "subject": sch[2],
-                    "classroom": sch[3],
-                    "start_time": sch[4],
-                    "end_time": sch[5],
-                    "lesson_type": sch[6],
-                    "teacher": sch[7]
-                } for sch in schedule
-            ],
-            "attendance": [
-                {
-                    "user_id": att[0],
-                    "date": att[1],
-                    "status": att[2],
-                    "reason": att[3],
-                    "marked_by": att[4],
-                    "marked_at": att[5]
-                } for att in attendance
-            ]
-        }
+        status = await message.answer("⏳ Создаю резервную копию...")
+        prefix = f"backup_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
         
-        # Создаем файл
-        json_str = json.dumps(backup_data, ensure_ascii=False, indent=2)
-        buffer = io.BytesIO(json_str.encode('utf-8'))
-        buffer.name = f"backup_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+        # Части и manifest пишутся во временный каталог и удаляются после отправки
+        with tempfile.TemporaryDirectory(prefix="school_bot_backup_") as directory:
+            manifest, paths = await export_backup(directory, prefix)
+            
+            for i, path in enumerate(paths, 1):
+                await message.answer_document(
+                    FSInputFile(path, filename=os.path.basename(path)),
+                    caption=f"Часть {i}/{len(paths)}"
+                )
+            
+            manifest_path = os.path.join(directory, f"{prefix}.manifest.json")
+            with open(manifest_path, "w", encoding="utf-8") as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=2)
+            
+            summary = "\n".join(f"• {table}: {info['rows']}" for table, info in manifest["tables"].items())
+            await message.answer_document(
+                FSInputFile(manifest_path, filename=os.path.basename(manifest_path)),
+                caption=f"✅ Резервная копия базы данных создана!\n\n{summary}"
+            )
         
-        # Отправляем файл
-        document = FSInputFile(buffer, filename=buffer.name)
-        await message.answer_document(document, caption="✅ Резервная копия базы данных создана!")
+        await status.delete()
         logger.critical(f"[SUPER_ADMIN] {message.from_user.id} создал резервную копию базы данных")
         
     except Exception as e:
         logger.error(f"Ошибка при создании бэкапа: {str(e)}")
         await message.answer(f"❌ Ошибка при создании бэкапа: {str(e)}")
 
+# ВОССТАНОВЛЕНИЕ ИЗ РЕЗЕРВНОЙ КОПИИ
+# Ключи для режима merge: строки с тем же ключом обновляются
+RESTORE_KEYS = {
+    "groups": ["id"],
+    "users": ["telegram_id"],
+    "homework": ["id"],
+    "schedule": ["group_id", "date", "lesson_number"],
+    "attendance": ["user_id", "date"],
+}
+TELEGRAM_DOWNLOAD_LIMIT = 20 * 1024 * 1024
+
+class RestoreError(Exception):
+    pass
+
+async def validate_manifest(manifest) -> None:
+    """Проверяет manifest против текущей схемы базы (см. init_db)."""
+    if manifest.get("format") != "school_bot-ndjson" or manifest.get("version") != BACKUP_FORMAT_VERSION:
+        raise RestoreError("неизвестный формат резервной копии")
+    if not manifest.get("parts"):
+        raise RestoreError("в manifest нет частей")
+    
+    rows = await execute_query(
+        "SELECT table_name, column_name FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name = ANY(%s)",
+        (list(BACKUP_TABLES),), fetch=True
+    )
+    schema = {}
+    for table, column in rows:
+        schema.setdefault(table, set()).add(column)
+    
+    for table, info in manifest.get("tables", {}).items():
+        if table not in BACKUP_TABLES:
+            raise RestoreError(f"неизвестная таблица {table}")
+        unknown = set(info["columns"]) - schema.get(table, set())
+        if unknown:
+            raise RestoreError(f"{table}: нет колонок {', '.join(sorted(unknown))}")
+        # В копиях до появления групп group_id нет — подставляется группа по умолчанию
+        missing_keys = set(RESTORE_KEYS[table]) - set(info["columns"]) - {"group_id"}
+        if missing_keys:
+            raise RestoreError(f"{table}: нет ключевых колонок {', '.join(sorted(missing_keys))}")
+
+async def restore_backup(manifest, part_paths, mode: str):
+    """Загружает части через COPY FROM STDIN в одной транзакции.
+    replace — таблицы очищаются, merge — строки сливаются по RESTORE_KEYS.
+    Число строк и sha256 каждой таблицы сверяются с manifest, при
+    расхождении транзакция откатывается."""
+    tables = manifest["tables"]
+    counts = {table: 0 for table in tables}
+    digests = {table: hashlib.sha256() for table in tables}
+    # Копии до появления групп: новые строки попадают в DEFAULT_GROUP_ID,
+    # а у существующих группа не меняется
+    legacy = {table for table, info in tables.items() if table in GROUP_TABLES and "group_id" not in info["columns"]}
+    columns_for = {
+        table: info["columns"] + (["group_id"] if table in legacy else [])
+        for table, info in tables.items()
+    }
+    
+    async with db_pool.connection() as conn:
+        async with conn.transaction():
+            cursor = conn.cursor()
+            if mode == "replace":
+                await cursor.execute(f"TRUNCATE {', '.join(BACKUP_TABLES)} RESTART IDENTITY")
+                if "groups" not in tables:
+                    await cursor.execute(
+                        "INSERT INTO groups (id, name) VALUES (%s, %s)", (DEFAULT_GROUP_ID, DEFAULT_GROUP_NAME)
+                    )
+                targets = {table: table for table in tables}
+            else:
+                targets = {table: f"restore_{table}" for table in tables}
+                for table, target in targets.items():
+                    await cursor.execute(f"CREATE TEMP TABLE {target} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP")
+            
+            for path in part_paths:
+                with gzip.open(path, "rb") as f:
+                    while lines := await asyncio.to_thread(f.readlines, 4 * 1024 * 1024):
+                        # Строки одной таблицы идут подряд — один COPY на каждый такой отрезок
+                        segments = []
+                        for line in lines:
+                            record = json.loads(line)
+                            table = record["table"]
+                            if table not in tables:
+                                raise RestoreError(f"строка таблицы {table}, которой нет в manifest")
+                            digests[table].update(line)
+                            if not segments or segments[-1][0] != table:
+                                segments.append((table, []))
+                            segments[-1][1].append(record["row"])
+                        
+                        for table, rows in segments:
+                            columns = columns_for[table]
+                            async with cursor.copy(
+                                f"COPY {targets[table]} ({', '.join(columns)}) FROM STDIN"
+                            ) as copy:
+                                for row in rows:
+                                    if table in legacy:
+                                        row["group_id"] = DEFAULT_GROUP_ID
+                                    await copy.write_row([row.get(column) for column in columns])
+                            counts[table] += len(rows)
+            
+            for table, info in tables.items():
+                if counts[table] != info["rows"] or digests[table].hexdigest() != info["sha256"]:
+                    raise RestoreError(f"{table}: данные не совпадают с manifest")
+            
+            if mode == "merge":
+                if "groups" in tables:
+                    # Группа с тем же названием уже есть под другим id — строки копии переносятся в неё
+                    await cursor.execute(
+                        "CREATE TEMP TABLE restore_group_map ON COMMIT DROP AS "
+                        f"SELECT r.id AS backup_id, g.id AS group_id FROM {targets['groups']} r "
+                        "JOIN groups g ON g.name = r.name AND g.id <> r.id"
+                    )
+                    for table in tables:
+                        if table in GROUP_TABLES and table not in legacy:
+                            await cursor.execute(
+                                f"UPDATE {targets[table]} t SET group_id = m.group_id "
+                                "FROM restore_group_map m WHERE t.group_id = m.backup_id"
+                            )
+                    await cursor.execute(
+                        f"DELETE FROM {targets['groups']} r USING restore_group_map m WHERE r.id = m.backup_id"
+                    )
+                
+                for table in tables:
+                    columns = columns_for[table]
+                    keys = RESTORE_KEYS[table]
+                    updates = [
+                        column for column in columns
+                        if column not in keys and not (table in legacy and column == "group_id")
+                    ]
+                    conflict = (
+                        "DO UPDATE SET " + ", ".join(f"{column} = EXCLUDED.{column}" for column in updates)
+                        if updates else "DO NOTHING"
+                    )
+                    await cursor.execute(
+                        f"INSERT INTO {table} ({', '.join(columns)}) "
+                        f"SELECT {', '.join(columns)} FROM {targets[table]} "
+                        f"ON CONFLICT ({', '.join(keys)}) {conflict}"
+                    )
+            
+            # id заданий и групп восстановлены явно — сдвигаем последовательности за максимум
+            for table in ("homework", "groups"):
+                await cursor.execute(
+                    f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE(MAX(id), 0) + 1, false) FROM {table}"
+                )
+    return counts
+
+@dp.message(Command("restore_db"))
+async def restore_db_start(message: types.Message, state: FSMContext):
+    if not is_super_admin(message.from_user.id):
+        await message.answer("🚫 Эта команда только для старшего админа")
+        return
+    
+    mode = message.text.replace("/restore_db", "", 1).strip().lower() or "merge"
+    if mode not in ("merge", "replace"):
+        await message.answer("Использование: /restore_db [merge|replace]")
+        return
+    
+    await state.set_state(RestoreDB.waiting_for_files)
+    await state.set_data({"mode": mode, "manifest": None, "files": {}})
+    await message.answer(
+        f"♻️ <b>Восстановление базы</b> (режим <code>{mode}</code>)\n\n"
+        "Отправьте файл <code>*.manifest.json</code> и все части <code>*.ndjson.gz</code> из /backup_db.\n"
+        + ("⚠️ В режиме replace текущие данные будут удалены!\n" if mode == "replace" else
+           "В режиме merge совпадающие записи обновляются, остальные сохраняются.\n")
+        + "\nДля отмены напишите «Отмена».",
+        parse_mode="HTML"
+    )
+
+@dp.message(RestoreDB.waiting_for_files)
+async def restore_db_file(message: types.Message, state: FSMContext):
+    if not is_super_admin(message.from_user.id):
+        await state.clear()
+        return
+    
+    if not message.document:
+        if message.text == "Отмена":
+            await state.clear()
+            await message.answer("❌ Восстановление отменено")
+        else:
+            await message.answer("Отправьте файлы резервной копии или «Отмена»")
+        return
+    
+    document = message.document
+    if document.file_size and document.file_size > TELEGRAM_DOWNLOAD_LIMIT:
+        await message.answer("❌ Файл больше 20 МБ — бот не может его скачать")
+        return
+    
+    data = await state.get_data()
+    name = document.file_name or ""
+    
+    if name.endswith(".manifest.json"):
+        buffer = await bot.download(document)
+        try:
+            manifest = json.loads(buffer.read().decode("utf-8"))
+            await validate_manifest(manifest)
+        except (ValueError, KeyError, RestoreError) as e:
+            await message.answer(f"❌ Неверный manifest: {e}")
+            return
+        data["manifest"] = manifest
+    elif name.endswith(".ndjson.gz"):
+        data["files"][name] = document.file_id
+    else:
+        await message.answer("❌ Ожидаются файлы *.manifest.json и *.ndjson.gz")
+        return
+    await state.set_data(data)
+    
+    manifest = data["manifest"]
+    if manifest is None:
+        await message.answer(f"📥 Получено частей: {len(data['files'])}. Жду manifest.json")
+        return
+    missing = [part["name"] for part in manifest["parts"] if part["name"] not in data["files"]]
+    if missing:
+        await message.answer(f"📥 Осталось частей: {len(missing)} ({', '.join(missing[:5])})")
+        return
+    
+    await state.clear()
+    status = await message.answer("⏳ Восстанавливаю базу...")
+    started = time.monotonic()
+    try:
+        with tempfile.TemporaryDirectory(prefix="school_bot_restore_") as directory:
+            paths = []
+            for part in manifest["parts"]:
+                path = os.path.join(directory, part["name"])
+                await bot.download(data["files"][part["name"]], destination=path)
+                if _file_sha256(path) != part["sha256"]:
+                    raise RestoreError(f"{part['name']}: контрольная сумма не совпадает")
+                paths.append(path)
+            counts = await restore_backup(manifest, paths, data["mode"])
+    except Exception as e:
+        logger.error(f"Ошибка восстановления базы: {e}")
+        await status.edit_text(f"❌ Восстановление не выполнено, база не изменена: {e}")
+        return
+    
+    # Все кэши построены на старых данных
+    for cache in ("users", "schedule", "attendance"):
+        await invalidate(cache)
+    homework_views.drop()
+    await invalidate("homework")
+    
+    elapsed = time.monotonic() - started
+    total = sum(counts.values())
+    summary = "\n".join(f"• {table}: {count}" for table, count in counts.items())
+    await status.edit_text(
+        f"✅ База восстановлена ({data['mode']})\n\n{summary}\n\n"
+        f"⏱ {elapsed:.1f} сек, {total / elapsed if elapsed else total:.0f} строк/сек"
+    )
+    logger.critical(f"[SUPER_ADMIN] {message.from_user.id} восстановил базу из резервной копии ({data['mode']}, {total} строк)")
+
+ADMIN_LINE = Template("• {name} (`{tg_id}`) — {group}\n")
+
 @dp.message(Command("admin_list"))
 async def admin_list(message: types.Message):
     if not is_super_admin(message.from_user.id):
@@ -993,7 +3840,8 @@ async def admin_list(message: types.Message):
         return
     
     admins = await execute_query(
-        "SELECT telegram_id, full_name FROM users WHERE is_admin = TRUE",
+        "SELECT u.telegram_id, u.full_name, g.name FROM users u LEFT JOIN groups g ON g.id = u.group_id "
+        "WHERE u.is_admin = TRUE ORDER BY g.name, u.full_name",
         fetch=True
     )
     
@@ -1001,11 +3849,177 @@ async def admin_list(message: types.Message):
         await message.answer("❌ Админы не найдены")
         return
     
-    text = "**Список администраторов**\n\n"
-    for tg_id, name in admins:
-        text += f"• {name or 'ФИО не указано'} (`{tg_id}`)\n"
+    admins_text = MessageBuilder("**Список администраторов**\n\n").extend(
+        ADMIN_LINE(name=name or "ФИО не указано", tg_id=tg_id, group=group or "без группы")
+        for tg_id, name, group in admins
+    )
+    await answer_chunks(message, admins_text.chunks())
+
+CACHE_LINE = Template(
+    "• {name}: {size} записей, попаданий {hits}, промахов {misses} ({rate:.1f}%), ~{kb:.1f} КБ\n"
+)
+
+@dp.message(Command("cache_stats"))
+async def cache_stats(message: types.Message):
+    if not is_super_admin(message.from_user.id):
+        await message.answer("🚫 Эта команда только для старшего админа")
+        return
+    
+    stats = MessageBuilder("**Кэш**\n\n").extend(
+        CACHE_LINE(
+            name=name, size=len(cache), hits=cache.hits, misses=cache.misses,
+            rate=cache.hit_rate, kb=cache.memory_usage() / 1024
+        )
+        for name, cache in caches.items()
+    )
+    await answer_chunks(message, stats.chunks())
+
+@dp.message(Command("queue_stats"))
+async def queue_stats(message: types.Message):
+    if not is_super_admin(message.from_user.id):
+        await message.answer("🚫 Эта команда только для старшего админа")
+        return
+    
+    q = update_queue
+    await message.answer(
+        "**Очередь апдейтов**\n\n"
+        f"• В очереди: {q.depth} из {q.maxsize} (максимум {q.max_depth})\n"
+        f"• Обрабатывается: {q.active} из {q.concurrency}, чатов с апдейтами: {q.chats}\n"
+        f"• Принято: {q.accepted}, отклонено: {q.rejected}\n"
+        f"• Обработано: {q.processed}, с ошибкой: {q.failed}\n"
+        f"• Среднее ожидание: {q.avg_wait * 1000:.0f} мс, обработка: {q.avg_handle * 1000:.0f} мс",
+        parse_mode="Markdown"
+    )
+
+SLOW_QUERIES_TITLE = Template("**Медленные запросы** (порог {threshold:.0f} мс, новые сверху)\n\n")
+SLOW_QUERY_LINE = Template("{number}. {at:%d.%m %H:%M:%S} — {ms:.0f} мс, `{site!e}`{plan}\n`{query!e:.120}`\n")
+SLOW_QUERY_TITLE = Template("**Медленный запрос #{number}**\n{at:%d.%m %H:%M:%S} UTC, {ms:.0f} мс\nМесто: `{site!e}`{handler}\n\n")
+SLOW_QUERY_HANDLER = Template(", обработчик `{handler!e}`")
+SLOW_QUERY_PARAMS = Template("Параметры: `{params!e}`\n\n")
+
+@dp.message(Command("slow_queries"))
+async def cmd_slow_queries(message: types.Message):
+    if not is_super_admin(message.from_user.id):
+        await message.answer("🚫 Эта команда только для старшего админа")
+        return
+    
+    entries = list(reversed(slow_queries))
+    if not entries:
+        await message.answer(f"✅ Запросов дольше {SLOW_QUERY_MS:.0f} мс не было")
+        return
+    
+    arg = message.text.replace("/slow_queries", "", 1).strip()
+    if arg:
+        # Подробно: /slow_queries N — запрос, параметры и план
+        if not arg.isdigit() or not 1 <= int(arg) <= len(entries):
+            await message.answer(f"❌ Укажите номер от 1 до {len(entries)}")
+            return
+        entry = entries[int(arg) - 1]
+        handler = SLOW_QUERY_HANDLER(handler=entry.handler) if entry.handler else ""
+        detail = MessageBuilder(SLOW_QUERY_TITLE(
+            number=arg, at=entry.at, ms=entry.duration * 1000, site=entry.site, handler=Markup(handler)
+        ))
+        detail.add(code_block(entry.query.strip(), "sql") + "\n")
+        detail.add(SLOW_QUERY_PARAMS(params=entry.params))
+        detail.add(code_block(entry.plan or "EXPLAIN не снимался (выборка SLOW_QUERY_EXPLAIN_RATE)"))
+        await answer_chunks(message, detail.chunks())
+        return
     
-    await message.answer(text, parse_mode="Markdown")
+    footer = "\nПодробно с планом: /slow\\_queries N"
+    summary = MessageBuilder(SLOW_QUERIES_TITLE(threshold=SLOW_QUERY_MS)).extend(
+        SLOW_QUERY_LINE(
+            number=number, at=entry.at, ms=entry.duration * 1000, site=entry.site,
+            plan=" 📋" if entry.plan else "", query=" ".join(entry.query.split())
+        )
+        for number, entry in enumerate(entries, 1)
+    )
+    await message.answer(summary.first(limit=MESSAGE_LIMIT - len(footer)) + footer, parse_mode="Markdown")
+
+# Консоль запросов. Запрос выполняется на отдельном соединении вне пула
+# (см. dedicated_connection), в явной транзакции только для чтения и с statement_timeout, поэтому не
+# занимает соединения обработчиков и не может ничего изменить.
+# Строки читаются серверным курсором — ровно столько, сколько нужно
+DEBUG_USAGE = (
+    "Использование:\n"
+    "/debug SELECT ... — первые строки результата\n"
+    "/debug explain SELECT ... — план запроса\n"
+    "/debug analyze SELECT ... — план с фактическим выполнением\n"
+    "/debug csv SELECT ... — выгрузка в CSV\n"
+    "/debug ndjson SELECT ... — выгрузка в NDJSON"
+)
+DEBUG_MODES = ("explain", "analyze", "csv", "ndjson")
+
+# Отладочные запросы: сессия по умолчанию только для чтения, а запрос
+# уходит одной командой (расширенный протокол), поэтому «; COMMIT; ...»
+# не выйдет из транзакции READ ONLY
+async def debug_connection():
+    return await dedicated_connection(options="-c default_transaction_read_only=on")
+
+async def debug_transaction(conn, timeout: float):
+    await conn.execute("SET TRANSACTION READ ONLY")
+    await conn.execute("SELECT set_config('statement_timeout', %s, true)", (str(int(timeout * 1000)),))
+    await conn.execute("SELECT set_config('lock_timeout', '1000', true)")
+
+def _debug_value(value) -> str:
+    return "NULL" if value is None else str(value)
+
+async def debug_preview(query: str):
+    conn = await debug_connection()
+    try:
+        async with conn.transaction():
+            await debug_transaction(conn, DEBUG_STATEMENT_TIMEOUT)
+            async with conn.cursor(name="debug_preview") as cursor:
+                await cursor.execute(query)
+                rows = await cursor.fetchmany(DEBUG_PREVIEW_ROWS + 1)
+                columns = [column.name for column in cursor.description]
+    finally:
+        await conn.close()
+    return columns, rows[:DEBUG_PREVIEW_ROWS], len(rows) > DEBUG_PREVIEW_ROWS
+
+async def debug_explain(query: str, analyze: bool) -> str:
+    conn = await debug_connection()
+    try:
+        async with conn.transaction():
+            await debug_transaction(conn, DEBUG_STATEMENT_TIMEOUT)
+            options = "ANALYZE, BUFFERS" if analyze else "COSTS"
+            # prepare=True: подготовленный оператор не допускает нескольких команд
+            cursor = await conn.execute(f"EXPLAIN ({options}) {query}", prepare=True)
+            return "\n".join(row[0] for row in await cursor.fetchall())
+    finally:
+        await conn.close()
+
+async def debug_export(query: str, fmt: str, path: str):
+    """Пишет результат в файл пачками. Возвращает (строк, обрезан ли)."""
+    rows_written = 0
+    truncated = False
+    conn = await debug_connection()
+    try:
+        async with conn.transaction():
+            await debug_transaction(conn, DEBUG_EXPORT_TIMEOUT)
+            async with conn.cursor(name="debug_export") as cursor:
+                await cursor.execute(query)
+                columns = [column.name for column in cursor.description]
+                with open(path, "w", encoding="utf-8", newline="") as f:
+                    writer = csv.writer(f) if fmt == "csv" else None
+                    if writer:
+                        writer.writerow(columns)
+                    while True:
+                        rows = await cursor.fetchmany(min(BACKUP_BATCH_SIZE, DEBUG_EXPORT_MAX_ROWS - rows_written))
+                        if not rows:
+                            break
+                        for row in rows:
+                            if writer:
+                                writer.writerow(row)
+                            else:
+                                f.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False,
+                                                   default=_json_default) + "\n")
+                        rows_written += len(rows)
+                        if rows_written >= DEBUG_EXPORT_MAX_ROWS or f.tell() >= DEBUG_EXPORT_MAX_BYTES:
+                            truncated = bool(await cursor.fetchmany(1))
+                            break
+    finally:
+        await conn.close()
+    return rows_written, truncated
 
 @dp.message(Command("debug"))
 async def debug_command(message: types.Message):
@@ -1015,31 +4029,51 @@ async def debug_command(message: types.Message):
     
     query = message.text.replace("/debug", "", 1).strip()
     if not query:
-        await message.answer("❌ Укажите SQL-запрос после команды")
+        await message.answer(DEBUG_USAGE)
         return
     
-    # Допускаем только SELECT-запросы для безопасности
-    if not query.upper().startswith("SELECT"):
+    mode = "preview"
+    first, _, rest = query.partition(" ")
+    if first.lower() in DEBUG_MODES:
+        mode, query = first.lower(), rest.strip()
+    query = query.rstrip().rstrip(";")
+    
+    # Изменения не пропустит debug_connection(), проверка лишь даёт понятную ошибку
+    if not re.match(r"(SELECT|WITH|TABLE|VALUES)\b", query, re.IGNORECASE):
         await message.answer("❌ Разрешены только SELECT-запросы для безопасности")
         return
     
+    logger.critical(f"[SUPER_ADMIN] {message.from_user.id} выполнил отладочный запрос ({mode}): {query}")
     try:
-        result = await execute_query(query, fetch=True)
-        if not result:
-            await message.answer("🔍 Результат пуст")
-            return
-        
-        # Формируем ответ
-        text = f"**Результат запроса:**\n```sql\n{query}\n```\n\n"
-        for row in result[:10]:  # Ограничиваем 10 строками
-            text += " | ".join(str(x) for x in row) + "\n"
+        if mode in ("explain", "analyze"):
+            plan = await debug_explain(query, analyze=mode == "analyze")
+            await answer_chunks(message, MessageBuilder().add(code_block(plan)).chunks())
         
-        if len(result) > 10:
-            text += f"\n... и еще {len(result) - 10} строк"
-        
-        await message.answer(text, parse_mode="Markdown")
-        logger.critical(f"[SUPER_ADMIN] {message.from_user.id} выполнил отладочный запрос: {query}")
+        elif mode in ("csv", "ndjson"):
+            status = await message.answer("⏳ Выгружаю результат...")
+            with tempfile.TemporaryDirectory(prefix="school_bot_debug_") as directory:
+                filename = f"debug_{datetime.datetime.now():%Y%m%d_%H%M%S}.{mode}"
+                path = os.path.join(directory, filename)
+                rows, truncated = await debug_export(query, mode, path)
+                caption = f"✅ Строк: {rows}"
+                if truncated:
+                    caption += " (выгрузка обрезана по лимиту)"
+                await message.answer_document(FSInputFile(path, filename=filename), caption=caption)
+            await status.delete()
         
+        else:
+            columns, rows, more = await debug_preview(query)
+            if not rows:
+                await message.answer("🔍 Результат пуст")
+                return
+            lines = [" | ".join(columns)] + [" | ".join(_debug_value(x) for x in row) for row in rows]
+            footer = f"\nПоказаны первые {DEBUG_PREVIEW_ROWS} строк. Все строки: /debug csv ..." if more else ""
+            preview = MessageBuilder("**Результат запроса:**\n")
+            preview.add(code_block(query[:500], "sql") + "\n").add(code_block("\n".join(lines)))
+            await message.answer(preview.first(more="\n…", limit=MESSAGE_LIMIT - len(footer)) + footer, parse_mode="Markdown")
+    
+    except psycopg.errors.QueryCanceled:
+        await message.answer("⏱ Запрос прерван по таймауту")
     except Exception as e:
         logger.error(f"Ошибка в отладочном запросе: {str(e)}")
         await message.answer(f"❌ Ошибка выполнения запроса: {str(e)}")
@@ -1075,8 +4109,8 @@ async def emergency_stop_confirm(message: types.Message, state: FSMContext):
         )
         logger.critical(f"[SUPER_ADMIN] {message.from_user.id} ИНИЦИИРОВАЛ ЭКСТРЕННУЮ ОСТАНОВКУ СЕРВИСА")
         
-        # Запускаем остановку в фоне
-        asyncio.create_task(shutdown(signal.SIGTERM, asyncio.get_running_loop()))
+        # Штатная остановка через SIGTERM (см. main)
+        request_shutdown()
     else:
         await message.answer(
             "✅ Экстренная остановка отменена",
@@ -1085,94 +4119,606 @@ async def emergency_stop_confirm(message: types.Message, state: FSMContext):
     
     await state.clear()
 
-# Ежедневная задача: поздравление с ДР
-async def birthday_task():
-    while True:
-        now = datetime.datetime.now()
-        next_run = (now + datetime.timedelta(days=1)).replace(hour=9, minute=0, second=0, microsecond=0)
-        sleep_time = (next_run - now).total_seconds()
-        if sleep_time < 0:
-            sleep_time = 0
-        await asyncio.sleep(sleep_time)
+# ПЛАНИРОВЩИК ЗАДАЧ
+class CronSpec:
+    """Cron из пяти полей: минуты, часы, дни месяца, месяцы, дни недели
+    (0 и 7 — воскресенье). Поддерживаются *, списки, диапазоны и шаги."""
 
-        today = datetime.date.today()
-        today_str = today.strftime("%m-%d")
+    BOUNDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
 
-        birthdays = await execute_query(
-            "SELECT telegram_id, full_name FROM users WHERE birth_date IS NOT NULL AND SUBSTRING(birth_date FROM 6 FOR 5) = %s",
-            (today_str,), fetch=True
+    def __init__(self, spec: str):
+        fields = spec.split()
+        if len(fields) != 5:
+            raise ValueError(f"cron должен содержать 5 полей: {spec!r}")
+        self.spec = spec
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            self._parse(field, low, high) for field, (low, high) in zip(fields, self.BOUNDS)
         )
+        self.weekdays = {day % 7 for day in weekdays}
+        # Как в cron: если заданы и дни месяца, и дни недели — подходит любое из условий
+        self._days_restricted = fields[2] != "*"
+        self._weekdays_restricted = fields[4] != "*"
+
+    @staticmethod
+    def _parse(field: str, low: int, high: int):
+        values = set()
+        for part in field.split(","):
+            value_range, _, step = part.partition("/")
+            if value_range == "*":
+                first, last = low, high
+            elif "-" in value_range:
+                first, last = (int(v) for v in value_range.split("-", 1))
+            else:
+                first = last = int(value_range)
+                if step:
+                    last = high
+            if not low <= first <= last <= high:
+                raise ValueError(f"значение вне диапазона {low}-{high}: {part!r}")
+            values.update(range(first, last + 1, int(step) if step else 1))
+        return values
+
+    def _day_matches(self, day: datetime.date) -> bool:
+        if day.month not in self.months:
+            return False
+        by_day = day.day in self.days
+        by_weekday = day.isoweekday() % 7 in self.weekdays
+        if self._days_restricted and self._weekdays_restricted:
+            return by_day or by_weekday
+        return by_day and by_weekday
+
+    def next_after(self, moment: datetime.datetime, tz: ZoneInfo) -> datetime.datetime:
+        """Ближайшее время срабатывания строго после moment (с часовым поясом)."""
+        local = moment.astimezone(tz)
+        day = local.date()
+        for _ in range(366 * 5):
+            if self._day_matches(day):
+                for hour in sorted(self.hours):
+                    for minute in sorted(self.minutes):
+                        candidate = datetime.datetime.combine(day, datetime.time(hour, minute), tz)
+                        if candidate > moment:
+                            return candidate
+            day += datetime.timedelta(days=1)
+        raise ValueError(f"cron {self.spec!r} никогда не срабатывает")
+
+class Job:
+    def __init__(self, name: str, spec: str, func, timezone: str = BOT_TIMEZONE,
+                 catchup: float = 3600, jitter: float = 0):
+        self.name = name
+        self.cron = CronSpec(spec)
+        self.func = func  # async func(scheduled_for: datetime)
+        self.tz = ZoneInfo(timezone)
+        self.catchup = catchup  # сек: насколько поздно ещё можно выполнить пропущенный запуск
+        self.jitter = jitter  # сек: случайная задержка перед запуском
+
+class Scheduler:
+    """Задачи по расписанию с сохранением в базе.
 
-        for tg_id, name in birthdays:
+    Для каждой задачи хранится last_run_at — время последнего успешного
+    запуска. После перезапуска пропущенный запуск выполняется, если он
+    опоздал не больше чем на job.catchup; несколько пропущенных
+    объединяются в один. Каждый запуск сначала записывается в job_runs,
+    поэтому одно и то же время не выполнится дважды, даже если процессов
+    несколько. Запуск, не завершившийся за JOB_STALE_AFTER, можно взять снова.
+    Упавший запуск повторяется с растущей паузой, пока не выйдет за job.catchup
+    или не наступит следующий."""
+
+    def __init__(self):
+        self.jobs = {}
+        self._next = {}
+        self._retries = {}  # job.name -> (scheduled_for, retry_at, attempt)
+        self._running = set()
+        self._semaphore = asyncio.Semaphore(SCHEDULER_CONCURRENCY)
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def register(self, job: Job):
+        self.jobs[job.name] = job
+
+    async def start(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for job in self.jobs.values():
+            row = await execute_query(
+                "INSERT INTO scheduled_jobs (name, spec, timezone) VALUES (%s, %s, %s) "
+                "ON CONFLICT (name) DO UPDATE SET spec = EXCLUDED.spec, timezone = EXCLUDED.timezone "
+                "RETURNING last_run_at",
+                (job.name, job.cron.spec, job.tz.key), fetch=True
+            )
+            watermark = row[0] or now - datetime.timedelta(seconds=job.catchup)
+            self._next[job.name] = job.cron.next_after(watermark, job.tz)
+            logger.info(f"⏰ Задача {job.name}: следующий запуск {self._next[job.name].isoformat()}")
+        self._task = asyncio.create_task(self._loop())
+
+    def stop(self):
+        """Останавливает цикл; уже запущенные задачи доработают сами."""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        self._next.clear()
+        self._retries.clear()
+
+    async def _loop(self):
+        while True:
+            now = datetime.datetime.now(datetime.timezone.utc)
             try:
-                await bot.send_message(
-                    tg_id,
-                    f"**С ДНЁМ РОЖДЕНИЯ, {name}!**\n\n"
-                    f"Пусть этот день будет полон радости, улыбок и хорошего настроения!\n"
-                    f"Желаем успехов в учёбе и всего самого лучшего!",
-                    parse_mode="Markdown"
+                self._tick(now)
+            except Exception as e:
+                # Задача цикла никем не ожидается: без этого ошибка молча остановила бы планировщик
+                logger.exception(f"❌ Ошибка в цикле планировщика: {e}")
+            
+            wakeups = list(self._next.values()) + [retry_at for _, retry_at, _ in self._retries.values()]
+            sleep_for = min((t - now).total_seconds() for t in wakeups) if wakeups else 60
+            # Не спим дольше минуты: переживаем перевод часов и сон контейнера
+            await asyncio.sleep(min(max(sleep_for, 0.5), 60))
+
+    def _tick(self, now: datetime.datetime):
+        for job in self.jobs.values():
+            if job.name in self._running:
+                continue
+            due = self._next[job.name]
+            if due > now:
+                retry = self._retries.get(job.name)
+                if retry and retry[1] <= now:
+                    scheduled_for, _, attempt = self._retries.pop(job.name)
+                    if (now - scheduled_for).total_seconds() > job.catchup:
+                        logger.warning(f"⏰ Задача {job.name}: запуск {scheduled_for.isoformat()} не удался, "
+                                       f"повторы прекращены (слишком поздно)")
+                        continue
+                    self._running.add(job.name)
+                    run_in_background(self._run(job, scheduled_for, attempt))
+                continue
+            # Новый запуск заменяет ещё не выполненный повтор
+            self._retries.pop(job.name, None)
+            # Несколько пропущенных запусков — выполняем только последний
+            while (following := job.cron.next_after(due, job.tz)) <= now:
+                due = following
+            self._next[job.name] = job.cron.next_after(due, job.tz)
+            if (now - due).total_seconds() > job.catchup:
+                logger.warning(f"⏰ Задача {job.name}: запуск {due.isoformat()} пропущен (слишком поздно)")
+                continue
+            self._running.add(job.name)
+            run_in_background(self._run(job, due))
+
+    def _schedule_retry(self, job: Job, scheduled_for: datetime.datetime, attempt: int):
+        delay = min(JOB_RETRY_DELAY * 2 ** attempt, JOB_RETRY_MAX_DELAY)
+        retry_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=delay)
+        self._retries[job.name] = (scheduled_for, retry_at, attempt + 1)
+        logger.info(f"⏰ Задача {job.name}: повтор запуска {scheduled_for.isoformat()} через {delay} сек")
+
+    async def _run(self, job: Job, scheduled_for: datetime.datetime, attempt: int = 0):
+        try:
+            async with self._semaphore:
+                if job.jitter:
+                    await asyncio.sleep(random.uniform(0, job.jitter))
+                claimed = await execute_query(
+                    "INSERT INTO job_runs (job_name, scheduled_for) VALUES (%s, %s) "
+                    "ON CONFLICT (job_name, scheduled_for) DO UPDATE SET started_at = CURRENT_TIMESTAMP, error = NULL "
+                    "WHERE job_runs.finished_at IS NULL AND (job_runs.error IS NOT NULL "
+                    "OR job_runs.started_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 second') "
+                    "RETURNING job_name",
+                    (job.name, scheduled_for, JOB_STALE_AFTER), fetch=True
                 )
-                logger.info(f"🎉 Поздравил {name} ({tg_id}) с ДР")
+                if not claimed:
+                    logger.info(f"⏰ Задача {job.name} на {scheduled_for.isoformat()} уже выполнена или выполняется")
+                    return
+                
+                logger.info(f"⏰ Запуск задачи {job.name} ({scheduled_for.isoformat()})")
+                try:
+                    await job.func(scheduled_for)
+                except Exception as e:
+                    logger.exception(f"❌ Задача {job.name} завершилась с ошибкой: {e}")
+                    self._schedule_retry(job, scheduled_for, attempt)
+                    await execute_query(
+                        "UPDATE job_runs SET error = %s WHERE job_name = %s AND scheduled_for = %s",
+                        (str(e), job.name, scheduled_for)
+                    )
+                    return
+                
+                await execute_query(
+                    "UPDATE job_runs SET finished_at = CURRENT_TIMESTAMP WHERE job_name = %s AND scheduled_for = %s",
+                    (job.name, scheduled_for)
+                )
+                await execute_query(
+                    "UPDATE scheduled_jobs SET last_run_at = GREATEST(last_run_at, %s) WHERE name = %s",
+                    (scheduled_for, job.name)
+                )
+        except Exception as e:
+            # База недоступна при захвате или отметке запуска
+            logger.exception(f"❌ Задача {job.name}: ошибка планировщика: {e}")
+            self._schedule_retry(job, scheduled_for, attempt)
+        finally:
+            self._running.discard(job.name)
+
+scheduler = Scheduler()
+
+BIRTHDAY_GREETING = Template(
+    "**С ДНЁМ РОЖДЕНИЯ, {name}!**\n\n"
+    "Пусть этот день будет полон радости, улыбок и хорошего настроения!\n"
+    "Желаем успехов в учёбе и всего самого лучшего!"
+)
+
+# Задача: поздравление с ДР
+async def birthday_job(scheduled_for: datetime.datetime):
+    today = scheduled_for.astimezone(ZoneInfo(BOT_TIMEZONE)).date()
+
+    # Отмечаем поздравляемых до отправки: при повторном запуске
+    # уже отмеченные не попадут в выборку. Выражения совпадают с idx_users_birthday
+    birthdays = await execute_query(
+        "WITH candidates AS ("
+        "    SELECT telegram_id, full_name FROM users WHERE birth_date IS NOT NULL AND is_active "
+        "    AND EXTRACT(MONTH FROM birth_date) = %s AND EXTRACT(DAY FROM birth_date) = %s"
+        "), claimed AS ("
+        "    INSERT INTO birthday_greetings (telegram_id, greeted_on) SELECT telegram_id, %s FROM candidates "
+        "    ON CONFLICT DO NOTHING RETURNING telegram_id"
+        ") SELECT c.telegram_id, c.full_name FROM candidates c JOIN claimed USING (telegram_id)",
+        (today.month, today.day, today), fetch=True
+    )
+
+    messages = [(tg_id, BIRTHDAY_GREETING(name=name)) for tg_id, name in birthdays]
+    stats = await broadcast(messages, parse_mode="Markdown")
+    logger.info(f"🎉 Поздравления с ДР: отправлено {stats.sent}, "
+                f"заблокировали {len(stats.blocked)}, ошибок {stats.failed}")
+
+async def digest_text(group_id: int, today: datetime.date) -> str:
+    schedule = await get_schedule(group_id, today)
+    homework = await homework_views[group_id].due_on(today + datetime.timedelta(days=1))
+    digest = MessageBuilder("☀️ Доброе утро!\n\n").add(schedule.header).extend(schedule.blocks)
+    if not schedule:
+        digest.add("\n\n")
+    digest.add("📚 **ДЗ на завтра**\n\n").extend(homework or ["Нет ДЗ на завтра"])
+    # В рассылке одно сообщение: остальное доступно через /schedule и /homework
+    return digest.first(more="\n…")
+
+# Задача: утренняя рассылка. Текст считается один раз на группу,
+# все группы уходят одной рассылкой с общим лимитом скорости
+async def digest_job(scheduled_for: datetime.datetime):
+    today = scheduled_for.astimezone(ZoneInfo(BOT_TIMEZONE)).date()
+    
+    subscribers = await execute_query(
+        "SELECT group_id, array_agg(telegram_id) FROM users "
+        "WHERE digest_enabled AND is_active AND group_id IS NOT NULL GROUP BY group_id",
+        fetch=True
+    )
+    messages = []
+    for group_id, chat_ids in subscribers:
+        text = await digest_text(group_id, today)
+        messages.extend((tg_id, text) for tg_id in chat_ids)
+    stats = await broadcast(messages, parse_mode="Markdown")
+    logger.info(f"☀️ Утренняя рассылка: отправлено {stats.sent}, "
+                f"заблокировали {len(stats.blocked)}, ошибок {stats.failed}")
+
+# Поздравлять можно до вечера, если бот был недоступен утром
+scheduler.register(Job("birthdays", BIRTHDAY_CRON, birthday_job, catchup=12 * 3600, jitter=30))
+# Рассылка после первой пары уже не нужна
+scheduler.register(Job("morning_digest", DIGEST_CRON, digest_job, catchup=2 * 3600))
+
+# Журнал апдейтов нужен, пока Telegram может повторить доставку
+async def purge_update_ledger(scheduled_for: datetime.datetime):
+    await execute_query(
+        "DELETE FROM processed_updates WHERE received_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 second'",
+        (UPDATE_LEDGER_TTL,)
+    )
+
+scheduler.register(Job("purge_update_ledger", "15 * * * *", purge_update_ledger))
+
+# Ежедневная задача: прогрев кэша расписания после полуночи
+async def schedule_warmup_task():
+    while True:
+        now = datetime.datetime.now()
+        next_run = (now + datetime.timedelta(days=1)).replace(hour=0, minute=0, second=5, microsecond=0)
+        await asyncio.sleep((next_run - now).total_seconds())
+        try:
+            await warm_schedule_cache()
+        except Exception as e:
+            logger.error(f"❌ Не удалось прогреть кэш расписания: {e}")
+
+# НЕСКОЛЬКО ВОРКЕРОВ
+# Каждый update_id обрабатывается один раз, даже если Telegram повторил
+# доставку или апдейт попал в другой воркер. Вебхук отвечает 200 ещё до
+# обработки, поэтому Telegram апдейт не повторяет: упавший обработчик
+# только пишет ошибку в лог, пользователь повторяет команду сам
+@dp.update.outer_middleware()
+async def deduplicate_updates(handler, event: types.Update, data):
+    claimed = await execute_query(
+        "INSERT INTO processed_updates (update_id) VALUES (%s) ON CONFLICT DO NOTHING RETURNING update_id",
+        (event.update_id,), fetch=True
+    )
+    if not claimed:
+        logger.info(f"🔁 Апдейт {event.update_id} уже обработан, пропускаем")
+        return None
+    return await handler(event, data)
+
+async def dedicated_connection(**kwargs):
+    """Отдельное соединение вне пула: advisory lock и LISTEN живут, пока оно открыто."""
+    return await psycopg.AsyncConnection.connect(
+        DATABASE_URL, sslmode=DB_SSLMODE, connect_timeout=10, autocommit=True, **kwargs
+    )
+
+# Ведущий воркер ставит webhook и запускает планировщик. Блокировка
+# держится на соединении: если процесс упал, её забирает другой
+async def leader_loop():
+    while True:
+        conn = None
+        try:
+            conn = await dedicated_connection()
+            while True:
+                cursor = await conn.execute("SELECT pg_try_advisory_lock(%s)", (LEADER_LOCK_ID,))
+                if (await cursor.fetchone())[0]:
+                    break
+                await asyncio.sleep(LEADER_RETRY_INTERVAL)
+            
+            logger.info(f"👑 Воркер {os.getpid()} стал ведущим")
+            try:
+                await bot.set_webhook(WEBHOOK_URL)
+                logger.info(f"✅ Webhook установлен на {WEBHOOK_URL}")
+            except Exception as e:
+                # Прежний webhook продолжает работать, лидерство не отдаём
+                logger.error(f"❌ Не удалось установить webhook: {e}")
+            await scheduler.start()
+            # Потеряли соединение — потеряли и блокировку
+            while True:
+                await asyncio.sleep(LEADER_RETRY_INTERVAL)
+                await conn.execute("SELECT 1")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Ошибка выбора ведущего воркера: {e}")
+        finally:
+            scheduler.stop()
+            if conn is not None:
+                await conn.close()
+        await asyncio.sleep(LEADER_RETRY_INTERVAL)
+
+# Сбросы кэшей от других воркеров (см. invalidate)
+async def cache_listener():
+    reconnect = False
+    while True:
+        try:
+            async with await dedicated_connection() as conn:
+                await conn.execute(f"LISTEN {CACHE_CHANNEL}")
+                if reconnect:
+                    # Пока соединения не было, сбросы могли пройти мимо
+                    for cache in ("users", "attendance", "schedule", "homework"):
+                        apply_invalidation(cache, [], remote=True)
+                reconnect = True
+                async for notify in conn.notifies():
+                    payload = json.loads(notify.payload)
+                    if payload["from"] != INSTANCE_ID:
+                        apply_invalidation(payload["cache"], payload["keys"], remote=True)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Потеряно соединение для сброса кэшей: {e}")
+        await asyncio.sleep(5)
+
+# ОЧЕРЕДЬ АПДЕЙТОВ
+def update_chat_key(update: dict):
+    """Чат, к которому относится апдейт: внутри чата порядок сохраняется."""
+    for name, value in update.items():
+        if name == "update_id" or not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        user = value.get("from") or value.get("user")
+        if user:
+            return user["id"]
+    return ("update", update.get("update_id"))
+
+class UpdateQueue:
+    """Ограниченная очередь апдейтов с обработкой в concurrency задачах.
+
+    Апдейты одного чата выполняются строго по очереди (на это рассчитаны
+    FSM-диалоги), разные чаты — параллельно. Чат с апдейтами стоит в
+    _ready не больше одного раза; после каждого апдейта он встаёт в конец,
+    чтобы активный чат не занимал обработчик целиком. Когда места нет,
+    put ждёт до timeout и возвращает False — webhook отвечает 503,
+    и Telegram повторит доставку позже."""
+
+    def __init__(self, process, maxsize: int, concurrency: int):
+        self.process = process  # async process(update: dict)
+        self.maxsize = maxsize
+        self.concurrency = concurrency
+        self._slots = asyncio.Semaphore(maxsize)
+        self._chats = {}  # чат -> deque[(update, время постановки)]
+        self._ready = asyncio.Queue()
+        self._workers = []
+        self.closed = False
+        # Метрики
+        self.depth = 0
+        self.max_depth = 0
+        self.active = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.wait_time = 0.0
+        self.handle_time = 0.0
+
+    def start(self):
+        self.closed = False
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def put(self, update: dict, timeout: float) -> bool:
+        if self.closed:
+            self.rejected += 1
+            return False
+        if self._slots.locked():
+            try:
+                await asyncio.wait_for(self._slots.acquire(), timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                return False
+        else:
+            await self._slots.acquire()
+        
+        key = update_chat_key(update)
+        pending = self._chats.get(key)
+        if pending is None:
+            pending = self._chats[key] = deque()
+            self._ready.put_nowait(key)
+        pending.append((update, time.monotonic()))
+        self.accepted += 1
+        self.depth += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        return True
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            pending = self._chats[key]
+            update, enqueued_at = pending.popleft()
+            started = time.monotonic()
+            self.wait_time += started - enqueued_at
+            self.active += 1
+            try:
+                await self.process(update)
+                self.processed += 1
             except Exception as e:
-                logger.error(f"❌ Не удалось поздравить {tg_id}: {e}")
+                self.failed += 1
+                logger.exception(f"❌ Ошибка обработки апдейта {update.get('update_id')}: {e}")
+            finally:
+                self.active -= 1
+                self.handle_time += time.monotonic() - started
+                self.depth -= 1
+                self._slots.release()
+                if pending:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._chats[key]
+
+    async def close(self, timeout: float):
+        """Перестаёт принимать апдейты и ждёт, пока обработаются принятые."""
+        self.closed = True
+        deadline = time.monotonic() + timeout
+        while self.depth and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.depth:
+            logger.warning(f"⚠️ Остановка: не обработано апдейтов — {self.depth}")
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    @property
+    def chats(self) -> int:
+        return len(self._chats)
+
+    @property
+    def avg_wait(self) -> float:
+        done = self.processed + self.failed
+        return self.wait_time / done if done else 0.0
+
+    @property
+    def avg_handle(self) -> float:
+        done = self.processed + self.failed
+        return self.handle_time / done if done else 0.0
+
+async def process_update(update: dict):
+    result = await dp.feed_raw_update(bot, update)
+    if isinstance(result, TelegramMethod):
+        await dp.silent_call_request(bot, result)
+
+update_queue = UpdateQueue(process_update, UPDATE_QUEUE_SIZE, UPDATE_CONCURRENCY)
+
+class QueuedRequestHandler(SimpleRequestHandler):
+    """Webhook ставит апдейт в update_queue и сразу отвечает 200."""
+
+    async def handle(self, request: web.Request) -> web.Response:
+        bot = await self.resolve_bot(request)
+        if not self.verify_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), bot):
+            return web.Response(body="Unauthorized", status=401)
+        update = await request.json(loads=bot.session.json_loads)
+        if not await update_queue.put(update, UPDATE_QUEUE_WAIT):
+            logger.warning(f"⚠️ Очередь апдейтов заполнена, апдейт {update.get('update_id')} отклонён")
+            return web.Response(text="Busy", status=503)
+        return web.json_response({})
+
+    async def close(self) -> None:
+        # Вызывается первым в on_shutdown: дообрабатываем принятые
+        # апдейты, пока открыты сессия бота и пул соединений
+        await update_queue.close(UPDATE_DRAIN_TIMEOUT)
+        await super().close()
 
 # ВЕБ-СЕРВЕР ДЛЯ RENDER (ВЕБХУК-РЕЖИМ)
 async def on_startup(app):
-    # Удаляем старый webhook (на всякий случай)
-    await bot.delete_webhook(drop_pending_updates=True)
-    # Устанавливаем новый webhook
-    await bot.set_webhook(WEBHOOK_URL)
-    logger.info(f"✅ Webhook установлен на {WEBHOOK_URL}")
-    # Инициализируем БД
-    init_db()
+    # Открываем пул соединений до первого запроса к БД
+    await db_pool.open(wait=True)
+    logger.info(f"✅ Пул соединений открыт ({DB_POOL_MIN_SIZE}-{DB_POOL_MAX_SIZE})")
+    # Инициализируем БД (воркеры делают это по очереди, см. INIT_LOCK_ID)
+    await init_db()
     logger.info("✅ База данных инициализирована")
+    await warm_schedule_cache()
+    for group_id in await group_ids():
+        await homework_views[group_id].load()
+    if isinstance(storage, PostgresStorage):
+        storage.start()
+    update_queue.start()
 
 async def on_shutdown(app):
-    # Удаляем webhook при остановке
-    await bot.delete_webhook()
-    logger.info("✅ Webhook удален при остановке")
+    # Webhook не удаляем: остальные воркеры и новая версия при деплое
+    # продолжают принимать апдейты
+    # Сохраняем несохранённые состояния диалогов
+    await storage.close()
+    await db_pool.close()
+    logger.info("✅ Пул соединений закрыт")
 
 async def main():
     # Создаем веб-приложение
     app = web.Application()
     
     # Регистрируем обработчик для webhook
-    SimpleRequestHandler(
+    QueuedRequestHandler(
         dispatcher=dp,
         bot=bot,
     ).register(app, path=WEBHOOK_PATH)
     
     # Регистрируем обработчик для health-check
     app.router.add_get("/", lambda request: web.Response(text="OK"))
+    app.router.add_get("/metrics", metrics_endpoint)
     
     # Регистрируем события запуска и остановки
     app.on_startup.append(on_startup)
     app.on_shutdown.append(on_shutdown)
     
-    # Запускаем веб-сервер
+    # SIGTERM от Render или супервизора: останавливаемся штатно,
+    # чтобы on_shutdown сохранил состояния диалогов
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    
+    # Запускаем веб-сервер. Воркеры слушают один порт через SO_REUSEPORT,
+    # ядро распределяет соединения между ними
     port = int(os.getenv("PORT", 10000))
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, "0.0.0.0", port)
-    logger.info(f"🚀 Веб-сервер запущен на порту {port}")
+    site = web.TCPSite(runner, "0.0.0.0", port, reuse_port=WEB_WORKERS > 1)
     await site.start()
+    logger.info(f"🚀 Воркер {os.getpid()} запущен на порту {port}")
     
-    # Запускаем задачу для поздравлений с ДР в фоне
-    asyncio.create_task(birthday_task())
+    tasks = [
+        # Webhook и планировщик — только у ведущего воркера
+        asyncio.create_task(leader_loop()),
+        asyncio.create_task(cache_listener()),
+        # Прогрев кэша расписания на новый день
+        asyncio.create_task(schedule_warmup_task()),
+    ]
     
-    # Бесконечно ждем
-    while True:
-        await asyncio.sleep(3600)  # Спим час и проверяем
-
-# Обработка SIGTERM для Render
-async def shutdown(signal, loop):
-    logger.info(f"Получен сигнал {signal.name}...")
-    tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
-    [task.cancel() for task in tasks]
+    await stop.wait()
+    logger.info("Получен сигнал остановки...")
+    for task in tasks:
+        task.cancel()
     await asyncio.gather(*tasks, return_exceptions=True)
-    loop.stop()
+    await runner.cleanup()
 
-if __name__ == "__main__":
+def request_shutdown():
+    # В режиме воркеров останавливаем супервизор, иначе он перезапустит процесс
+    os.kill(os.getppid() if WEB_WORKERS > 1 else os.getpid(), signal.SIGTERM)
+
+def run_worker():
+    global INSTANCE_ID
+    # После fork у воркеров должен быть свой идентификатор для NOTIFY
+    INSTANCE_ID = uuid.uuid4().hex
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
@@ -1180,3 +4726,48 @@ if __name__ == "__main__":
     except Exception as e:
         logger.exception(f"Критическая ошибка: {e}")
         raise
+
+def run_workers(count: int):
+    """Pre-fork супервизор: запускает count воркеров, перезапускает упавшие
+    и передаёт им SIGTERM при остановке."""
+    context = multiprocessing.get_context("fork")
+    workers = {}
+    stopping = False
+
+    def spawn(index: int):
+        process = context.Process(target=run_worker, name=f"worker-{index}")
+        process.start()
+        workers[index] = process
+        logger.info(f"👷 Воркер {index} запущен (pid {process.pid})")
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process in workers.values():
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(count):
+        spawn(index)
+
+    while True:
+        alive = False
+        for index, process in list(workers.items()):
+            if process.is_alive():
+                alive = True
+            elif not stopping:
+                logger.warning(f"⚠️ Воркер {index} завершился с кодом {process.exitcode}, перезапускаем")
+                spawn(index)
+                alive = True
+        if stopping and not alive:
+            break
+        time.sleep(1)
+    logger.info("Все воркеры остановлены")
+
+if __name__ == "__main__":
+    if WEB_WORKERS > 1:
+        run_workers(WEB_WORKERS)
+    else:
+        run_worker()